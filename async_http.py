@@ -0,0 +1,401 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" An HTTP/1.1 client running on a single event loop thread (asyncore).
+
+The connections are kept alive and reused by the following requests to the
+same host, and the response body is written to the request's sink as it
+arrives. Any thread may start a request and wait for it.
+"""
+
+import argparse
+import asynchat
+import asyncore
+import BaseHTTPServer
+import collections
+import logging
+import os
+import socket
+import SocketServer
+import StringIO
+import threading
+import time
+import urllib2
+import urlparse
+
+import flags
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--max_connections_per_host', type=int, default=16,
+    help='The max number of connections to a host in the async fetch engine.')
+
+
+class HttpRequest(object):
+  """ A GET request and its state. """
+  def __init__(self, url, sink, headers, on_finish=None):
+    parsed = urlparse.urlsplit(url)
+    self.url = url
+    self.host = parsed.hostname
+    self.port = parsed.port or 80
+    self.path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+    self.headers = headers
+    self.sink = sink  # the file-like object to write the body into
+    self.status = None
+    self.response_headers = {}
+    self.retried = False
+    # called with the error or None in the event loop thread once it completes.
+    self.__on_finish = on_finish
+    self.__error = None
+    self.__done = threading.Event()
+
+  def Wait(self):
+    """ Blocks till the response completes. Returns the http status, or
+    raises urllib2.URLError (urllib2.HTTPError for a status other than 2xx).
+    """
+    self.__done.wait()
+    if self.__error:
+      raise self.__error
+    return self.status
+
+  def _Finish(self, error=None):
+    if error is None and not (200 <= self.status < 300):
+      error = urllib2.HTTPError(self.url, self.status, 'Http error', self.response_headers, None)
+    self.__error = error
+    if self.__on_finish:
+      try:
+        self.__on_finish(error)
+      except Exception, e:
+        logging.error('Error in finishing %s: %s', self.url, e)
+    self.__done.set()
+
+
+class _Trigger(asyncore.file_dispatcher):
+  """ Wakes up the event loop from other threads. """
+  def __init__(self, socket_map):
+    read_fd, self.__write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+    os.close(read_fd)  # file_dispatcher keeps a dup of it
+
+  def Pull(self):
+    os.write(self.__write_fd, 'x')
+
+  def readable(self):
+    return True
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(8192)
+    except OSError:
+      pass
+
+
+class _HttpConnection(asynchat.async_chat):
+  """ A keep-alive connection serving one request at a time. """
+  def __init__(self, client, key, address, socket_map):
+    asynchat.async_chat.__init__(self, map=socket_map)
+    self.key = key  # (host, port)
+    self.request = None
+    self.last_activity = time.time()
+    self.__client = client
+    self.__served = 0  # the number of completed requests
+    self.__received = False
+    self.__state = None
+    self.__buffer = []
+    self.__keep_alive = False
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.connect(address)
+
+  def Start(self, request):
+    self.request = request
+    self.last_activity = time.time()
+    self.__received = False
+    self.__buffer = []
+    self.__state = 'headers'
+    self.set_terminator('\r\n\r\n')
+    lines = ['GET %s HTTP/1.1' % request.path,
+             'Host: %s' % request.host,
+             'Connection: keep-alive',
+             'Accept: */*']
+    lines += ['%s: %s' % (k, v) for k, v in request.headers.iteritems()]
+    self.push('\r\n'.join(lines) + '\r\n\r\n')
+
+  def reused(self):
+    return self.__served > 0
+
+  def collect_incoming_data(self, data):
+    self.last_activity = time.time()
+    self.__received = True
+    if self.__state in ('body', 'chunk_data', 'until_close'):
+      self.request.sink.write(data)
+    else:
+      self.__buffer.append(data)
+
+  def found_terminator(self):
+    data = ''.join(self.__buffer)
+    self.__buffer = []
+    if self.__state == 'headers':
+      self.__ParseHeaders(data)
+    elif self.__state == 'body':
+      self.__Complete()
+    elif self.__state == 'chunk_size':
+      size = int(data.split(';', 1)[0].strip(), 16)
+      if size == 0:
+        self.__state = 'trailer'
+        self.set_terminator('\r\n')
+      else:
+        self.__state = 'chunk_data'
+        self.set_terminator(size)
+    elif self.__state == 'chunk_data':
+      self.__state = 'chunk_end'
+      self.set_terminator('\r\n')
+    elif self.__state == 'chunk_end':
+      self.__state = 'chunk_size'
+      self.set_terminator('\r\n')
+    elif self.__state == 'trailer':
+      if not data:  # the empty line ends the trailers
+        self.__Complete()
+
+  def __ParseHeaders(self, data):
+    lines = data.split('\r\n')
+    version, status = lines[0].split(' ', 2)[:2]
+    self.request.status = int(status)
+    headers = {}
+    for line in lines[1:]:
+      if ':' in line:
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    self.request.response_headers = headers
+
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+      self.__keep_alive = connection != 'close'
+    else:
+      self.__keep_alive = connection == 'keep-alive'
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+      self.__state = 'chunk_size'
+      self.set_terminator('\r\n')
+    elif 'content-length' in headers:
+      length = int(headers['content-length'])
+      self.__state = 'body'
+      if length > 0:
+        self.set_terminator(length)
+      else:
+        self.__Complete()
+    else:
+      # the body ends when the server closes the connection.
+      self.__keep_alive = False
+      self.__state = 'until_close'
+      self.set_terminator(None)
+
+  def __Complete(self):
+    request = self.request
+    self.request = None
+    self.__state = None
+    self.__served += 1
+    self.set_terminator(None)
+    self.__client._Release(self, self.__keep_alive)
+    request._Finish()
+
+  def Fail(self, error):
+    """ Fails the request in process and closes the connection. """
+    request = self.request
+    self.request = None
+    self.close()
+    self.__client._Remove(self)
+    if request:
+      request._Finish(error)
+
+  def handle_connect(self):
+    pass
+
+  def handle_close(self):
+    if self.request and self.__state == 'until_close':
+      self.__Complete()  # which also closes the connection
+      return
+    if not self.request:
+      self.close()
+      self.__client._Remove(self)
+      return
+    # The server may close an idle keep-alive connection just when we send a
+    # new request on it, so retry it once on a new connection.
+    request = self.request
+    self.request = None
+    self.close()
+    self.__client._Remove(self)
+    if self.reused() and not self.__received and not request.retried:
+      request.retried = True
+      self.__client._Retry(request)
+    else:
+      request._Finish(urllib2.URLError('connection closed by %s' % request.host))
+
+  def handle_error(self):
+    nil, error_type, error_value, traceback_info = asyncore.compact_traceback()
+    self.Fail(urllib2.URLError(error_value))
+
+
+class AsyncHttpClient(object):
+  """ Runs all connections on one event loop thread with a cap of
+  connections per host. The requests beyond the cap wait for a connection of
+  the same host to be released.
+  """
+  def __init__(self, max_connections_per_host, timeout=15):
+    assert max_connections_per_host > 0
+    self.__max_connections_per_host = max_connections_per_host
+    self.__timeout = timeout
+    self.__map = {}
+    self.__lock = threading.Lock()
+    self.__inbox = collections.deque()  # requests from other threads
+    # The states below are only touched in the event loop thread.
+    self.__pending = {}      # {(host, port) -> deque of requests}
+    self.__idle = {}         # {(host, port) -> list of idle connections}
+    self.__connections = {}  # {(host, port) -> set of all connections}
+    self.__addresses = {}    # {host -> ip}
+    self.__num_opened = 0    # the number of connections ever opened
+    self.__running = True
+    self.__trigger = _Trigger(self.__map)
+    self.__thread = threading.Thread(target=self.__Loop, name='AsyncHttpLoop')
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  def Fetch(self, url, sink, headers=None, on_finish=None):
+    """ Starts to fetch the url and returns the HttpRequest to wait for.
+    on_finish(error), if given, is called in the event loop thread once the
+    request completes, where error is None on success.
+    """
+    request = HttpRequest(url, sink, headers or {}, on_finish)
+    with self.__lock:
+      self.__inbox.append(request)
+    self.__trigger.Pull()
+    return request
+
+  def num_opened_connections(self):
+    return self.__num_opened
+
+  def Close(self):
+    self.__running = False
+    self.__trigger.Pull()
+    self.__thread.join()
+
+  def __Loop(self):
+    while self.__running:
+      asyncore.loop(timeout=0.5, use_poll=True, map=self.__map, count=1)
+      with self.__lock:
+        requests = list(self.__inbox)
+        self.__inbox.clear()
+      for request in requests:
+        self.__Enqueue(request)
+      self.__CheckTimeouts()
+    for connections in self.__connections.values():
+      for connection in list(connections):
+        connection.Fail(urllib2.URLError('client closed'))
+    self.__trigger.close()
+
+  def __Enqueue(self, request):
+    key = (request.host, request.port)
+    self.__pending.setdefault(key, collections.deque()).append(request)
+    self.__Dispatch(key)
+
+  def __Dispatch(self, key):
+    pending = self.__pending.get(key)
+    idle = self.__idle.setdefault(key, [])
+    connections = self.__connections.setdefault(key, set())
+    while pending and (idle or len(connections) < self.__max_connections_per_host):
+      request = pending.popleft()
+      if idle:
+        connection = idle.pop()
+      else:
+        try:
+          address = self.__addresses.get(key[0])
+          if not address:
+            address = self.__addresses[key[0]] = socket.gethostbyname(key[0])
+          connection = _HttpConnection(self, key, (address, key[1]), self.__map)
+        except socket.error, e:
+          request._Finish(urllib2.URLError(e))
+          continue
+        connections.add(connection)
+        self.__num_opened += 1
+      connection.Start(request)
+
+  def __CheckTimeouts(self):
+    now = time.time()
+    for connections in self.__connections.values():
+      for connection in list(connections):
+        if connection.request and now - connection.last_activity > self.__timeout:
+          connection.Fail(urllib2.URLError('timed out'))
+
+  def _Release(self, connection, keep_alive):
+    """ Called when a connection completes its request. """
+    if keep_alive:
+      self.__idle.setdefault(connection.key, []).append(connection)
+    else:
+      connection.close()
+      self._Remove(connection)
+    self.__Dispatch(connection.key)
+
+  def _Remove(self, connection):
+    """ Called when a connection is closed. """
+    self.__connections.get(connection.key, set()).discard(connection)
+    idle = self.__idle.get(connection.key, [])
+    if connection in idle:
+      idle.remove(connection)
+    self.__Dispatch(connection.key)
+
+  def _Retry(self, request):
+    self.__Enqueue(request)
+
+
+__shared_client = None
+__shared_client_lock = threading.Lock()
+
+def GetSharedClient():
+  """ Returns the client shared by all fetchers in this process. """
+  global __shared_client
+  with __shared_client_lock:
+    if __shared_client is None:
+      __shared_client = AsyncHttpClient(FLAGS.max_connections_per_host)
+    return __shared_client
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+
+  logging.basicConfig(level=logging.INFO)
+
+  # A local keep-alive server standing for the real one.
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def do_GET(self):
+      body = ('%s\r\n' % self.path) * 1000
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+    def log_message(self, *args):
+      pass
+  class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+  server = Server(('127.0.0.1', 0), Handler)
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+
+  client = AsyncHttpClient(FLAGS.max_connections_per_host)
+  start_ts = time.time()
+  requests = [client.Fetch('http://127.0.0.1:%d/page/%d' % (server.server_port, i),
+      StringIO.StringIO()) for i in range(1000)]
+  for i, request in enumerate(requests):
+    assert request.Wait() == 200
+    assert request.sink.getvalue() == ('/page/%d\r\n' % i) * 1000
+  logging.info('Fetched %d pages in %.2f seconds with %d connections', len(requests),
+      time.time() - start_ts, client.num_opened_connections())
+  client.Close()
+  server.shutdown()
+
+if __name__ == "__main__":
+  main()
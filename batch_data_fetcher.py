@@ -3,44 +3,137 @@
 
 import argparse
 import datetime
+import json
 import logging
+import os
 import threading
+import time
 import Queue
 
 import flags
+import cpu_workers
 import data_fetcher
+import perf_metrics
 import stock_info
 
 FLAGS = flags.FLAGS
 flags.ArgParser().add_argument('--num_fetcher_threads', type=int, default=1,
     help='The max number of data fetcher threads in parallel.')
+flags.ArgParser().add_argument('--stale_hours', type=float, default=24,
+    help='The stocks not fetched in these hours are fetched before the fresh ones.')
 
 Stock = stock_info.Stock
 
+_FETCH_SECONDS = perf_metrics.GetRegistry().GetHistogram('stock_fetch_seconds',
+    'The time of fetching the raw data of each stock.')
+_REFINE_SECONDS = perf_metrics.GetRegistry().GetHistogram('stock_refine_seconds',
+    'The time of refining each stock.')
+_STOCKS = perf_metrics.GetRegistry().GetCounter('stocks_fetched_total',
+    'The stocks fetched and refined, succeeded or failed.', ['result'])
+
+
+def _RefineStock(data_fetcher, stock):
+  """ Runs in a cpu worker process. """
+  data_fetcher.Refine(stock)
+
+
+class FetchSchedule(object):
+  """ Orders the stocks to fetch by the history of the previous runs:
+  the priority stocks, e.g. the portfolio, first, then the stale ones, the
+  stalest first, then the others. In each group the stocks expected to take
+  the longest go first, so that no slow stock starts at the end.
+
+  The history is {code -> [seconds of the last run, timestamp of the last
+  run]}, saved as json in history_file.
+  """
+  def __init__(self, history_file=None):
+    self.__history_file = history_file
+    self.__lock = threading.Lock()
+    self.__history = {}
+    if history_file and os.path.exists(history_file):
+      try:
+        with open(history_file) as f:
+          self.__history = json.load(f)
+      except ValueError, e:
+        logging.warning('Ignore the broken fetch history %s: %s', history_file, e)
+
+  def Order(self, stock_list, priority_codes=()):
+    """ Returns the stocks in the order to fetch. """
+    now = time.time()
+    stale_seconds = FLAGS.stale_hours * 3600
+    known_costs = sorted(seconds for (seconds, ts) in self.__history.itervalues())
+    # the stocks never fetched are expected to be as slow as a typical one.
+    default_cost = known_costs[len(known_costs) / 2] if known_costs else 0.0
+    priority_codes = set(priority_codes)
+
+    def Key(stock):
+      (cost, last_ts) = self.__history.get(stock.code(), (default_cost, 0))
+      if stock.code() in priority_codes:
+        return (0, 0, -cost)
+      age_days = int((now - last_ts) / 86400)
+      if now - last_ts >= stale_seconds:
+        return (1, -age_days, -cost)
+      return (2, 0, -cost)
+    return sorted(stock_list, key=Key)
+
+  def Record(self, stock, seconds):
+    with self.__lock:
+      self.__history[stock.code()] = [seconds, time.time()]
+
+  def Save(self):
+    if not self.__history_file:
+      return
+    with self.__lock:
+      content = json.dumps(self.__history)
+    with open(self.__history_file + '.tmp', 'w') as f:
+      f.write(content)
+    os.rename(self.__history_file + '.tmp', self.__history_file)
+
 
 class BatchDataFetcher:
-  def __init__(self, data_fetcher, max_threads):
+  def __init__(self, data_fetcher, max_threads, output_queue=None, cpu_pool=None,
+      schedule=None):
+    """ If output_queue is given, each successfully fetched stock is put into
+    it, so that the next stage can process it while fetching goes on.
+    If cpu_pool is given, the refining runs in its worker processes while the
+    threads only do the network I/O.
+    If schedule, a FetchSchedule, is given, the stocks are fetched in its order
+    and the time of each stock is recorded into it.
+    """
     assert 0 < max_threads and max_threads <= 100
     self.__max_threads = max_threads
     self.__data_fetcher = data_fetcher  # the real underlying data fetcher
+    self.__output_queue = output_queue
+    self.__cpu_pool = cpu_pool or cpu_workers.CpuWorkerPool(0)
+    self.__schedule = schedule or FetchSchedule()
 
     # all running threads
     self.__threads = []
-    # the stocks waiting for threads to process
-    self.__fetching_queue = Queue.Queue(max_threads)
-    # the flag indicating all stocks have been put into queue.
-    self.__all_stock_put = False;
+    # the stocks waiting for threads to process, in the order to fetch.
+    self.__fetching_queue = Queue.Queue()
 
-    # a few stats
+    # a few stats, updated by all threads.
+    self.__stats_lock = threading.Lock()
     self.__total_stock_num = 0
     self.__processed_stock = 0
     self.__success_stock = 0
     self.__fail_stock = 0
 
-  def Fetch(self, stock_list):
+  def Fetch(self, stock_list, priority_codes=()):
+    """ Fetches the stocks, the ones of priority_codes first. """
     if len(stock_list) == 0:
       return
 
+    # all stocks are queued before the threads start, so that a thread
+    # exits once the queue is empty.
+    for stock in self.__schedule.Order(stock_list, priority_codes):
+      self.__fetching_queue.put(stock)
+
+    start_ts = datetime.datetime.now()
+    self.__total_stock_num = len(stock_list)
+    reporter = perf_metrics.ProgressReporter('Fetching', len(stock_list),
+        self.__GetProcessedStockNum, FLAGS.progress_interval)
+    reporter.Start()
     num_threads = min(len(stock_list), self.__max_threads)
     for i in range(num_threads):
       t = threading.Thread(target=self.__RunThread, name=('FetchThread-%d' % i))
@@ -48,37 +141,52 @@ class BatchDataFetcher:
       t.start()
     logging.info('%d threads started', len(self.__threads))
 
-    start_ts = datetime.datetime.now()
-    for stock in stock_list:
-      self.__fetching_queue.put(stock, block=True)
-      self.__total_stock_num += 1
-
-    # all stocks put in the queue
-    self.__all_stock_put = True
-    self.__fetching_queue.join()  # block till all stocks fetched
+    for thread in self.__threads:
+      thread.join()  # block till all stocks fetched
+    reporter.Stop()
+    self.__schedule.Save()
 
     end_ts = datetime.datetime.now()
     logging.info('Total time elapsed in fetching data: %s', str(end_ts - start_ts))
     logging.info('Total stocks: %d, processed: %d, succeeded: %d, failed: %d',
         self.__total_stock_num, self.__processed_stock, self.__success_stock, self.__fail_stock)
 
-    for thread in self.__threads:
-      thread.join(timeout=10)  # ensure all threads exit
-      assert not thread.is_alive()
-
   def __RunThread(self):
-    while not self.__all_stock_put or not self.__fetching_queue.empty():
-      # block at most 10 seconds to get the next stock
-      stock = self.__fetching_queue.get(block=True, timeout=10)
-      self.__processed_stock += 1
+    while True:
       try:
-        self.__data_fetcher.Fetch(stock)
-        self.__success_stock += 1
+        stock = self.__fetching_queue.get_nowait()
+      except Queue.Empty:
+        return  # all stocks are taken
+      start_ts = time.time()
+      try:
+        with perf_metrics.Timer(_FETCH_SECONDS):
+          self.__data_fetcher.FetchRaw(stock)
+        with perf_metrics.Timer(_REFINE_SECONDS):
+          self.__cpu_pool.Run(_RefineStock, self.__data_fetcher, stock)
+        self.__schedule.Record(stock, time.time() - start_ts)
+        self.__CountStock(success=True)
       except Exception, e:
         logging.error('Error in fetching %s(%s): %s', stock.code(), stock.name(), e)
+        self.__CountStock(success=False)
+      else:
+        if self.__output_queue is not None:
+          self.__output_queue.put(stock, block=True)  # block if the next stage is busy
+
+  def __GetProcessedStockNum(self):
+    with self.__stats_lock:
+      return self.__processed_stock
+
+  def __CountStock(self, success):
+    _STOCKS.Inc(('success' if success else 'fail',))
+    with self.__stats_lock:
+      self.__processed_stock += 1
+      if success:
+        self.__success_stock += 1
+      else:
         self.__fail_stock += 1
-      finally:
-        self.__fetching_queue.task_done()  # decrease the queue item in process
+      logging.info('Progress: %d of %d stocks processed, %d succeeded, %d failed',
+          self.__processed_stock, self.__total_stock_num,
+          self.__success_stock, self.__fail_stock)
 
 
 def main():
@@ -0,0 +1,228 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Does the insights of DataInsights on all stocks at once.
+
+The refined metrics of all stocks are loaded into matrices of stocks x
+seasons, so that the means, CI and quantiles of all stocks come from a few
+vectorized calls instead of a stats.t.ppf and a stats.t.cdf per metrics of
+each stock.
+"""
+
+import argparse
+import csv
+import logging
+import math
+import numpy
+import sys
+from scipy import stats
+
+import flags
+import data_insights
+import stock_info
+
+Stock = stock_info.Stock
+InsightData = data_insights.InsightData
+
+FLAGS = flags.FLAGS
+
+_MV = u'MV'.encode('UTF8')
+_REVENUE_GROWTH = u'主营业务收入(万元)_growth'.encode('UTF8')
+_PE = u'PE_MV'.encode('UTF8')
+_PB = u'PB_MV'.encode('UTF8')
+
+# (metrics, the column at season, the latest column, the stats name, the digits to round)
+# in the same order of the columns of DataInsights.
+_STATS_CONFIGS = [
+    (_REVENUE_GROWTH, 'revenue_growth_at_season', None, 'revenue_growth', 2),
+    (_PE, 'PE_at_season', 'PE_latest', 'PE', 1),
+    (_PB, 'PB_at_season', 'PB_latest', 'PB', 1),
+]
+
+
+class SeasonalMatrix(object):
+  """ The values of a metrics of many stocks, where row i is the values of
+  stock i in its descending season order. NaN for missing values, and the
+  rows are padded by NaN so that any window after the insight season fits.
+  """
+  def __init__(self, num_stocks, num_seasons):
+    self.values = numpy.full((num_stocks, num_seasons), numpy.nan)
+
+  def SetRow(self, row, values):
+    self.values[row, :len(values)] = values
+
+  def GetAt(self, season_index):
+    """ Returns the value of each stock at its season_index, NaN if < 0. """
+    rows = numpy.arange(self.values.shape[0])
+    at = self.values[rows, numpy.maximum(season_index, 0)]
+    return numpy.where(season_index >= 0, at, numpy.nan)
+
+  def GetWindow(self, season_index, num):
+    """ Returns the matrix of stocks x num values just before season_index. """
+    rows = numpy.arange(self.values.shape[0])[:, numpy.newaxis]
+    columns = numpy.maximum(season_index, 0)[:, numpy.newaxis] + numpy.arange(1, num + 1)
+    return self.values[rows, columns]
+
+
+def PastAverageAndPercentInPast(season_metrics, past_metrics):
+  """ The vectorized DataInsights._PastAverageAndPercentInPast, where
+  season_metrics is a vector of the stocks and past_metrics is the matrix of
+  stocks x seasons. Returns (mean, lower, upper, quantile) vectors.
+  """
+  size = past_metrics.shape[1]
+  # sum in the same order as the builtin sum, so that the results are the same.
+  total = numpy.zeros(past_metrics.shape[0])
+  square_total = numpy.zeros(past_metrics.shape[0])
+  for i in range(size):
+    total += past_metrics[:, i]
+    square_total += past_metrics[:, i] ** 2
+  mean = total / float(size)
+  square_mean = square_total / float(size)
+  with numpy.errstate(invalid='ignore', divide='ignore'):
+    s = numpy.sqrt((square_mean - mean ** 2) * float(size) / float(size - 1))
+
+    # assume subject to t distribution, df=size-1, 95% confidence
+    t = stats.t.ppf(0.975, size - 1)
+    lower = mean - t * s / math.sqrt(size)
+    upper = mean + t * s / math.sqrt(size)
+
+    # s can be 0 when past_metrics are const.
+    point = numpy.where(numpy.abs(s) > 1e-6,
+        (season_metrics - mean) / (s / math.sqrt(size)),
+        (season_metrics - mean) * 100.0)
+    quantile = stats.t.cdf(point, size - 1) * 100.0
+  return (mean, lower, upper, quantile)
+
+
+def _Round(value, digits):
+  return round(float(value), digits) if not numpy.isnan(value) else None
+
+
+class BatchDataInsights(data_insights.DataInsights):
+  _num_past_seasons = 12  # number of pervious seasons to consider
+
+  def DoBatchStats(self, stocks):
+    """ Returns a list of InsightData, one for each insight season of each
+    stock with refined data.
+    """
+    logging.info('Insighting %d stocks on %d seasons ...', len(stocks), len(self._insight_seasons))
+    refined_data_map = data_insights.LoadAllRefinedData(
+        self._store, [s.code() for s in stocks], [_MV, _REVENUE_GROWTH, _PE, _PB])
+    loaded_stocks = [s for s in stocks if s.code() in refined_data_map]
+    all_refined_data = [refined_data_map[s.code()] for s in loaded_stocks]
+    if not loaded_stocks:
+      return []
+
+    # The matrices of all stocks, loaded once for all seasons.
+    num_stocks = len(loaded_stocks)
+    num_seasons = max(len(r.seasons) for r in all_refined_data) + self._num_past_seasons + 1
+    matrices = dict((m, SeasonalMatrix(num_stocks, num_seasons))
+        for m in [_MV, _REVENUE_GROWTH, _PE, _PB])
+    has_metrics = dict((m, numpy.zeros(num_stocks, dtype=bool)) for m in matrices)
+    for row, refined_data in enumerate(all_refined_data):
+      for metrics_name, values in zip(refined_data.metrics_names, refined_data.values):
+        matrices[metrics_name].SetRow(row, values)
+        has_metrics[metrics_name][row] = True
+    season_index_maps = [self._GetSeasonIndexMap(r.seasons) for r in all_refined_data]
+
+    # [(season, {column -> vector of stocks})]
+    all_columns = []
+    for insight_season in self._insight_seasons:
+      season = insight_season.isoformat()
+      # the index of the season of each stock.
+      season_index = numpy.array([m.get(season, -1) for m in season_index_maps], dtype=numpy.intp)
+      for row in numpy.flatnonzero(season_index < 0):
+        logging.warning('%s(%s) has no data on season %s.',
+            loaded_stocks[row].code(), loaded_stocks[row].name(), season)
+      all_columns.append((season, self._GetSeasonColumns(matrices, season_index)))
+
+    insights = []
+    for row, stock in enumerate(loaded_stocks):
+      for (season, columns) in all_columns:
+        insight_data = self._NewInsightData(stock, season)
+        if has_metrics[_MV][row]:
+          self._AddMarketValueInsight(insight_data, columns, row)
+        for config in _STATS_CONFIGS:
+          if has_metrics[config[0]][row]:
+            self._AddStatsInsight(insight_data, columns, row, config)
+        insights.append(insight_data)
+    logging.info('Insighting %d stocks done.', len(loaded_stocks))
+    return insights
+
+  def _GetSeasonColumns(self, matrices, season_index):
+    """ Returns {column -> vector of stocks} of the insights, where
+    season_index is the index of the insight season of each stock.
+    """
+    num_stocks = len(season_index)
+    columns = {}
+    mv = matrices[_MV]
+    columns['MarketValue_latest'] = mv.GetAt(numpy.zeros(num_stocks, dtype=numpy.intp))
+    columns['MarketValue_at_season'] = mv.GetAt(season_index)
+
+    num = self._num_past_seasons
+    for (metrics_name, at_column, latest_column, stats_name, digits) in _STATS_CONFIGS:
+      matrix = matrices[metrics_name]
+      at_season = matrix.GetAt(season_index)
+      columns[at_column] = at_season
+      if latest_column:
+        columns[latest_column] = matrix.GetAt(numpy.zeros(num_stocks, dtype=numpy.intp))
+
+      # only the stocks with a full window of non-zero past values.
+      past = matrix.GetWindow(season_index, num)
+      has_stats = (~numpy.isnan(at_season)
+          & numpy.all(~numpy.isnan(past) & (past != 0), axis=1))
+      (mean, lower, upper, quantile) = PastAverageAndPercentInPast(at_season, past)
+      for name, values in [('mean', mean), ('lower', lower), ('upper', upper), ('quantile', quantile)]:
+        columns['%dseasons_%s_%s' % (num, stats_name, name)] = numpy.where(has_stats, values, numpy.nan)
+    return columns
+
+  def _AddMarketValueInsight(self, insight_data, columns, row):
+    insight_data.AddColumns(['MarketValue_latest', 'MarketValue_at_season'])
+    season_mv = columns['MarketValue_at_season'][row]
+    if numpy.isnan(season_mv):
+      return
+    latest_mv = columns['MarketValue_latest'][row]
+    insight_data.UpdateData({
+      'MarketValue_latest': data_insights.ConvertMarketValue(
+          None if numpy.isnan(latest_mv) else float(latest_mv)),
+      'MarketValue_at_season': data_insights.ConvertMarketValue(float(season_mv)),
+    })
+
+  def _AddStatsInsight(self, insight_data, columns, row, config):
+    (metrics_name, at_column, latest_column, stats_name, digits) = config
+    num = self._num_past_seasons
+    value_columns = ([latest_column] if latest_column else []) + [at_column]
+    stats_columns = ['%dseasons_%s_%s' % (num, stats_name, name)
+        for name in ['mean', 'lower', 'upper', 'quantile']]
+    insight_data.AddColumns(value_columns + stats_columns)
+    if numpy.isnan(columns[at_column][row]):
+      return
+    data = dict((c, _Round(columns[c][row], digits)) for c in value_columns)
+    if not numpy.isnan(columns[stats_columns[0]][row]):
+      for c in stats_columns:
+        # the quantile is always in 1 digit.
+        data[c] = _Round(columns[c][row], 1 if c.endswith('quantile') else digits)
+    insight_data.UpdateData(data)
+    insight_data.UpdateExactData({at_column: float(columns[at_column][row])})
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+
+  logging.basicConfig(level=logging.INFO)
+  directory = './data/test'
+  stocks = [
+      Stock('000977', '浪潮信息', '医药', '2001-01-01'),
+      Stock('300652', 'N雷迪克', '制造业', '2017-05-16'),
+  ]
+  insighter = BatchDataInsights(directory)
+  insights = insighter.DoBatchStats(stocks)
+  if insights:
+    writer = csv.DictWriter(sys.stdout, fieldnames=insights[0].columns())
+    writer.writeheader()
+    for insight in insights:
+      writer.writerow(insight.data())
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of the fetch, refine and insight stages on synthetic stocks
+served by a local stand-in of the Netease server. Run from the repository
+root, first on a known good tree to save the baselines of this machine:
+
+  python2.7 -m benchmark.run_benchmarks --bench_sizes=10,100 --save_baseline
+  python2.7 -m benchmark.run_benchmarks --bench_sizes=10,100
+"""
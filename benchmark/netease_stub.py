@@ -0,0 +1,134 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" A local stand-in of the Netease server, which serves the pages of the
+synthetic stocks at the urls of NeteaseSeasonFetcher._SetupDataSources, e.g.
+
+  /service/zcfzb_600000.html                          -> 600000.balance.csv
+  /service/zycwzb_600000.html?type=report&part=ylnl   -> 600000.profit_metrics.csv
+  /service/chddata.html?code=0600000&start=...&end=...  the prices in the range
+
+Point the fetcher at it by --netease_url_base=http://127.0.0.1:<port>. The
+pages are gzipped if the request accepts gzip.
+"""
+
+import argparse
+import BaseHTTPServer
+import logging
+import os
+import re
+import SocketServer
+import threading
+import urlparse
+
+import data_store
+import flags
+from benchmark import synthetic_data
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--stub_port', type=int, default=8163,
+    help='The port of the stand-in server when run alone.')
+
+# {url page name -> page}, and {part of zycwzb -> page}
+_SHEET_PAGES = {'zcfzb': 'balance', 'lrb': 'income', 'xjllb': 'cash'}
+_METRICS_PAGES = {None: 'main_metrics', 'ylnl': 'profit_metrics', 'chnl': 'liability_metrics',
+    'cznl': 'growth_metrics', 'yynl': 'operating_metrics'}
+
+_PAGE_PATTERN = re.compile(r'^/service/(\w+?)_(\d{6})\.html$')
+
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    params = urlparse.parse_qs(url.query)
+    if url.path == '/service/chddata.html':
+      body = self.__GetPrices(params)
+    else:
+      body = self.__GetPage(url.path, params)
+    if body is None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/csv')
+    if 'gzip' in self.headers.get('Accept-Encoding', ''):
+      body = data_store.Compress(body)
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def __Read(self, code, page):
+    path = os.path.join(self.server.directory, '%s.%s.csv' % (code, page))
+    if not os.path.exists(path):
+      return None
+    with open(path) as f:
+      return f.read()
+
+  def __GetPage(self, path, params):
+    match = _PAGE_PATTERN.match(path)
+    if not match:
+      return None
+    (name, code) = match.groups()
+    if name == 'zycwzb':
+      page = _METRICS_PAGES.get(params.get('part', [None])[-1])
+    else:
+      page = _SHEET_PAGES.get(name)
+    return self.__Read(code, page) if page else None
+
+  def __GetPrices(self, params):
+    try:
+      # the first digit of the code is the exchange.
+      code = params['code'][-1][1:]
+      (start, end) = (params['start'][-1], params['end'][-1])
+    except KeyError:
+      return None
+    content = self.__Read(code, 'price_history')
+    if content is None:
+      return None
+    lines = content.splitlines()
+    # the dates are YYYY-MM-DD while start and end are YYYYMMDD.
+    rows = [line for line in lines[1:] if line and start <= line[:10].replace('-', '') <= end]
+    return '\r\n'.join(lines[:1] + rows) + '\r\n'
+
+  def log_message(self, format, *args):
+    logging.debug('%s', format % args)
+
+
+class NeteaseStub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """ Serves the pages in the directory on a local port in the background. """
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+  def __init__(self, directory, port=0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _StubHandler)
+    self.directory = directory
+    self.__thread = None
+
+  def url_base(self):
+    return 'http://127.0.0.1:%d' % self.server_port
+
+  def Start(self):
+    self.__thread = threading.Thread(target=self.serve_forever, name='NeteaseStub')
+    self.__thread.daemon = True
+    self.__thread.start()
+    logging.info('Netease stub serving %s at %s', self.directory, self.url_base())
+
+  def Stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+
+  logging.basicConfig(level=logging.INFO)
+  stub = NeteaseStub(FLAGS.synthetic_directory, FLAGS.stub_port)
+  logging.info('Serving %s at %s', FLAGS.synthetic_directory, stub.url_base())
+  stub.serve_forever()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,241 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Times the fetch, refine and insight throughput on synthetic stocks
+served by the local Netease stand-in, and a few hot functions, then compares
+the results with the saved baselines and flags the regressions.
+
+All results are the best seconds per stock or per call of a few rounds, so
+lower is better. The timings only compare on the same machine, so the
+baselines are saved locally by --save_baseline, e.g. on a known good tree. A
+result is a regression if it is slower than its baseline by more than
+--regression_tolerance. The exit code is 1 if there is any regression.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import Queue
+import random
+import shutil
+import sys
+import threading
+import time
+import timeit
+
+import flags
+import batch_data_fetcher
+import cpu_workers
+import data_fetcher
+import data_insights
+import date_util
+import parsed_page
+import stock_info
+from benchmark import netease_stub
+from benchmark import synthetic_data
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--benchmarks', default='micro,pipeline',
+    help='Comma separated benchmarks to run: micro, pipeline.')
+flags.ArgParser().add_argument('--bench_sizes', default='10,100,1000,5000',
+    help='Comma separated numbers of stocks of the pipeline benchmarks.')
+flags.ArgParser().add_argument('--bench_directory', default='./data/benchmark',
+    help='The directory of the fetched and refined data of the benchmarks.')
+flags.ArgParser().add_argument('--bench_baseline', default=None,
+    help='The json file of the baseline results saved on this machine, '
+    'baseline.json in --bench_directory by default.')
+flags.ArgParser().add_argument('--save_baseline', default=False, action='store_true',
+    help='Save the results as the new baselines.')
+flags.ArgParser().add_argument('--bench_rounds', type=int, default=5,
+    help='The rounds of each pipeline benchmark, of which the best is taken.')
+flags.ArgParser().add_argument('--regression_tolerance', type=float, default=0.25,
+    help='How much slower than the baseline is a regression, e.g. 0.25 for 25%%.')
+
+
+def _RefineStock(fetcher, stock):
+  """ Runs in a cpu worker process. """
+  fetcher.Refine(stock)
+
+
+def _RunInThreads(func, items, num_threads):
+  """ Runs func(item) for all items by num_threads threads. """
+  work_queue = Queue.Queue()
+  for item in items:
+    work_queue.put(item)
+
+  def Run():
+    while True:
+      try:
+        item = work_queue.get_nowait()
+      except Queue.Empty:
+        return
+      func(item)
+
+  threads = [threading.Thread(target=Run) for i in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+
+def _Time(func):
+  start_ts = time.time()
+  func()
+  return time.time() - start_ts
+
+
+def _BenchmarkPipeline(stub, cpu_pool, num_stocks):
+  """ Returns {name -> seconds per stock} of each stage on num_stocks stocks,
+  the best of --bench_rounds rounds, each from an empty directory.
+  """
+  FLAGS.stock_list = synthetic_data.Generate(FLAGS.synthetic_directory, num_stocks)
+  stocks = stock_info.LoadAllStocks().values()
+  directory = os.path.join(FLAGS.bench_directory, 'pipeline_%d' % num_stocks)
+  FLAGS.netease_url_base = stub.url_base()
+
+  # each round runs all stages, so a busy moment spoils one round at most.
+  all_seconds = {'fetch': [], 'refine': [], 'insight': []}
+  for i in range(max(1, FLAGS.bench_rounds)):
+    if os.path.exists(directory):
+      shutil.rmtree(directory)
+    os.makedirs(directory, 0755)
+    fetcher = data_fetcher.NeteaseSeasonFetcher(directory)
+    insighter = data_insights.DataInsights(directory)
+    all_seconds['fetch'].append(_Time(lambda: _RunInThreads(
+        fetcher.FetchRaw, stocks, FLAGS.num_fetcher_threads)))
+    all_seconds['refine'].append(_Time(lambda: _RunInThreads(
+        lambda stock: cpu_pool.Run(_RefineStock, fetcher, stock), stocks,
+        max(1, cpu_pool.num_workers()))))
+    all_seconds['insight'].append(_Time(lambda: [insighter.DoStats(stock) for stock in stocks]))
+  return dict(('pipeline_%d.%s' % (num_stocks, stage), min(seconds) / num_stocks)
+      for stage, seconds in all_seconds.iteritems())
+
+
+def _MeasureAll(benchmarks, num_rounds=10):
+  """ Returns {name -> the best seconds per call} of the benchmarks
+  {name -> (func, number of calls per round)}. The rounds of all benchmarks
+  take turns, so a busy moment of the machine does not spoil all rounds of
+  one benchmark.
+  """
+  results = {}
+  for i in range(num_rounds):
+    for name, (func, number) in benchmarks.iteritems():
+      seconds = timeit.timeit(func, number=number) / number
+      results[name] = min(results.get(name, seconds), seconds)
+  return results
+
+
+def _BenchmarkMicro():
+  """ Returns {name -> seconds per call} of the hot functions. """
+  FLAGS.stock_list = synthetic_data.Generate(FLAGS.synthetic_directory, 1)
+  stock = stock_info.LoadAllStocks().values()[0]
+  # the pages are read from a copy, where the parsed sidecars are saved.
+  directory = os.path.join(FLAGS.bench_directory, 'micro')
+  if os.path.exists(directory):
+    shutil.rmtree(directory)
+  os.makedirs(directory, 0755)
+  for page in synthetic_data.STATEMENT_PAGES + ['price_history']:
+    name = '%s.%s.csv' % (stock.code(), page)
+    shutil.copy(os.path.join(FLAGS.synthetic_directory, name), os.path.join(directory, name))
+
+  fetcher = data_fetcher.NeteaseSeasonFetcher(directory)
+  all_prices = fetcher._LoadPriceHistory(stock).GetTradedPrices('close')
+  seasons = fetcher._reporting_seasons
+  with open(os.path.join(directory, '%s.balance.csv' % stock.code())) as f:
+    balance_content = f.read()
+  fetcher._LoadPage('balance', stock)  # the sidecar is saved
+
+  insighter = data_insights.DataInsights(directory)
+  rnd = random.Random(0)
+  past_metrics = [rnd.uniform(1, 100) for i in range(12)]
+
+  today = datetime.date.today()
+  twelve_years_ago = datetime.date(today.year - 12, today.month, 1)
+  return _MeasureAll({
+    'micro.GetSeasonalAveragePrice': (
+        lambda: fetcher._GetSeasonalAveragePrice(all_prices, seasons), 200),
+    'micro.LoadPage': (lambda: fetcher._LoadPage('balance', stock), 200),
+    'micro.LoadPage_parse': (lambda: parsed_page.ParseCsv(balance_content), 50),
+    'micro.LoadPriceHistory': (lambda: fetcher._LoadPriceHistory(stock), 10),
+    'micro.PastAverageAndPercentInPast': (
+        lambda: insighter._PastAverageAndPercentInPast(50.0, past_metrics), 200),
+    'micro.date_util.GetLatestNSeasonsStart': (
+        lambda: date_util.GetLatestNSeasonsStart(today, 48), 2000),
+    'micro.date_util.GetLastSeasonEndDate': (
+        lambda: date_util.GetLastSeasonEndDate(today), 20000),
+    'micro.date_util.GetSeasonEndDates': (
+        lambda: date_util.GetSeasonEndDates(twelve_years_ago, today), 2000),
+  })
+
+
+def _GetBaselinePath():
+  return FLAGS.bench_baseline or os.path.join(FLAGS.bench_directory, 'baseline.json')
+
+
+def _LoadBaseline():
+  if not os.path.exists(_GetBaselinePath()):
+    return {}
+  with open(_GetBaselinePath()) as f:
+    return json.load(f)
+
+
+def _Report(results, baseline):
+  """ Prints the results against the baselines. Returns the regressions. """
+  regressions = []
+  print '%-45s %14s %14s %9s' % ('benchmark', 'seconds', 'baseline', 'change')
+  for name in sorted(results):
+    seconds = results[name]
+    base = baseline.get(name)
+    if base:
+      change = seconds / base - 1.0
+      flag = ''
+      if change > FLAGS.regression_tolerance:
+        flag = '  REGRESSION'
+        regressions.append(name)
+      print '%-45s %14.6g %14.6g %+8.1f%%%s' % (name, seconds, base, change * 100, flag)
+    else:
+      print '%-45s %14.6g %14s %9s' % (name, seconds, '-', '-')
+  return regressions
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+  # The per page logs of the stages are not part of what we measure.
+  logging.basicConfig(level=logging.WARNING)
+
+  benchmarks = [b.strip() for b in FLAGS.benchmarks.split(',') if b.strip()]
+  results = {}
+  if 'micro' in benchmarks:
+    results.update(_BenchmarkMicro())
+  if 'pipeline' in benchmarks:
+    # forked before the stub starts its thread.
+    cpu_pool = cpu_workers.CpuWorkerPool(FLAGS.num_cpu_workers)
+    stub = netease_stub.NeteaseStub(FLAGS.synthetic_directory)
+    stub.Start()
+    try:
+      for num_stocks in [int(n) for n in FLAGS.bench_sizes.split(',') if n.strip()]:
+        results.update(_BenchmarkPipeline(stub, cpu_pool, num_stocks))
+    finally:
+      stub.Stop()
+      cpu_pool.Close()
+
+  baseline = _LoadBaseline()
+  regressions = _Report(results, baseline)
+  if FLAGS.save_baseline:
+    baseline.update(results)
+    directory = os.path.dirname(os.path.abspath(_GetBaselinePath()))
+    if not os.path.exists(directory):
+      os.makedirs(directory, 0755)
+    with open(_GetBaselinePath(), 'w') as f:
+      json.dump(baseline, f, indent=2, sort_keys=True)
+    print 'Saved the baselines to %s' % _GetBaselinePath()
+    return
+  if regressions:
+    print '%d regressions: %s' % (len(regressions), ', '.join(regressions))
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,236 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Generates synthetic stocks in the Netease csv formats(GBK): the 8
+statement pages of the latest 48 seasons and 12 years of daily prices, plus
+a stock list csv in the format of stock_info.LoadAllStocks.
+
+The pages of stock <code> are saved as <code>.<page>.csv in the output
+directory, which the stand-in server serves.
+"""
+
+import argparse
+import csv
+import datetime
+import logging
+import math
+import os
+import random
+
+import flags
+import date_util
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--synthetic_directory', default='./data/synthetic',
+    help='The directory of the synthetic pages.')
+
+_NUM_SEASONS = 12 * 4
+_NUM_PRICE_YEARS = 12
+
+# The statement pages and their metrics, in the order of Netease. The pages
+# with fewer real names are padded to their usual numbers of rows.
+_PAGE_METRICS = {
+    'main_metrics': ([
+        u'基本每股收益(元)', u'每股净资产(元)', u'每股经营活动产生的现金流量净额(元)',
+        u'主营业务收入(万元)', u'主营业务利润(万元)', u'营业利润(万元)', u'投资收益(万元)',
+        u'营业外收支净额(万元)', u'利润总额(万元)', u'净利润(万元)',
+        u'净利润(扣除非经常性损益后)(万元)', u'经营活动产生的现金流量净额(万元)',
+        u'现金及现金等价物净增加额(万元)', u'总资产(万元)', u'流动资产(万元)',
+        u'总负债(万元)', u'流动负债(万元)', u'股东权益不含少数股东权益(万元)',
+        u'净资产收益率加权(%)'], 19),
+    'balance': ([
+        u'货币资金(万元)', u'结算备付金(万元)', u'交易性金融资产(万元)', u'应收票据(万元)',
+        u'应收账款(万元)', u'预付款项(万元)', u'其他应收款(万元)', u'存货(万元)',
+        u'流动资产合计(万元)', u'固定资产(万元)', u'无形资产(万元)', u'资产总计(万元)',
+        u'短期借款(万元)', u'应付账款(万元)', u'负债合计(万元)', u'实收资本(或股本)(万元)',
+        u'未分配利润(万元)', u'所有者权益(或股东权益)合计(万元)'], 108),
+    'income': ([
+        u'营业总收入(万元)', u'营业收入(万元)', u'营业总成本(万元)', u'营业成本(万元)',
+        u'销售费用(万元)', u'管理费用(万元)', u'财务费用(万元)', u'营业利润(万元)',
+        u'利润总额(万元)', u'所得税费用(万元)', u'净利润(万元)', u'基本每股收益'], 45),
+    'cash': ([
+        u'销售商品、提供劳务收到的现金(万元)', u'收到的税费返还(万元)',
+        u'经营活动现金流入小计(万元)', u'购买商品、接受劳务支付的现金(万元)',
+        u'经营活动现金流出小计(万元)', u'经营活动产生的现金流量净额(万元)',
+        u'投资活动产生的现金流量净额(万元)', u'筹资活动产生的现金流量净额(万元)'], 90),
+    'profit_metrics': ([
+        u'总资产利润率(%)', u'主营业务利润率(%)', u'总资产净利润率(%)', u'成本费用利润率(%)',
+        u'营业利润率(%)', u'主营业务成本率(%)', u'销售净利率(%)', u'净资产收益率(%)',
+        u'股本报酬率(%)', u'净资产报酬率(%)', u'资产报酬率(%)', u'销售毛利率(%)'], 12),
+    'liability_metrics': ([
+        u'流动比率', u'速动比率', u'现金比率(%)', u'利息支付倍数', u'资产负债率(%)',
+        u'长期债务与营运资金比率(%)', u'股东权益比率(%)', u'产权比率(%)'], 8),
+    'growth_metrics': ([
+        u'主营业务收入增长率(%)', u'净利润增长率(%)', u'净资产增长率(%)', u'总资产增长率(%)'], 4),
+    'operating_metrics': ([
+        u'应收账款周转率(次)', u'应收账款周转天数(天)', u'存货周转率(次)', u'固定资产周转率(次)',
+        u'总资产周转率(次)', u'存货周转天数(天)', u'总资产周转天数(天)', u'流动资产周转率(次)',
+        u'流动资产周转天数(天)', u'经营现金净流量对销售收入比率(%)'], 10),
+}
+
+STATEMENT_PAGES = sorted(_PAGE_METRICS.keys())
+
+_INDUSTRIES = [u'制造业', u'医药', u'信息技术', u'金融业', u'房地产业', u'批发和零售业',
+    u'交通运输', u'电力、热力生产和供应业', u'采矿业', u'建筑业']
+
+
+_CODE_PREFIXES = ['600', '000', '300', '601', '002', '603', '001', '301']
+
+def GetStockCode(index):
+  """ Returns the code of the index-th synthetic stock, spread over the
+  exchanges: 6xxxxx in Shanghai, 0xxxxx and 3xxxxx in Shenzhen.
+  """
+  assert index < len(_CODE_PREFIXES) * 1000, 'Too many synthetic stocks: %d' % index
+  return '%s%03d' % (_CODE_PREFIXES[index % len(_CODE_PREFIXES)], index / len(_CODE_PREFIXES))
+
+
+def _GetSeasons(today):
+  """ Returns the latest seasons in descending order. """
+  return [date_util.GetLastDay(d) for d in date_util.GetLatestNSeasonsStart(today, _NUM_SEASONS)]
+
+
+def _FormatValue(rnd, value):
+  # a few values are missing as in the real pages.
+  return '--' if rnd.random() < 0.02 else '%.2f' % value
+
+
+def _WritePage(path, seasons, rows):
+  """ rows is a list of (metrics name, list of value string). """
+  lines = [u'报告日期,' + ','.join(s.isoformat() for s in seasons) + ',']
+  for name, values in rows:
+    lines.append(name + ',' + ','.join(values) + ',')
+  with open(path, 'w') as f:
+    f.write(('\r\n'.join(lines) + '\r\n').encode('GBK'))
+
+
+def _GenerateStatements(rnd, directory, code, seasons, shares):
+  """ Writes the statement pages. The flows are year-to-date cumulated as in
+  the Netease reports, and grow year on year.
+  """
+  revenue_base = rnd.uniform(1e4, 1e6)  # the yearly revenue of the earliest year, in 10k
+  growth = rnd.uniform(-0.05, 0.3)
+  margin = rnd.uniform(-0.05, 0.3)
+  equity_ratio = rnd.uniform(0.3, 0.8)
+  main_values = {}
+  for name in _PAGE_METRICS['main_metrics'][0]:
+    main_values[name] = []
+  for season in seasons:
+    years = (seasons[0].year - season.year) + (12 - season.month) / 12.0
+    yearly_revenue = revenue_base * (1 + growth) ** (_NUM_SEASONS / 4 - years) * rnd.uniform(0.8, 1.2)
+    revenue = yearly_revenue * season.month / 12.0  # year to date
+    profit = revenue * margin * rnd.uniform(0.5, 1.5)
+    assets = yearly_revenue * rnd.uniform(1.5, 2.5)
+    equity = assets * equity_ratio
+    values = {
+      u'基本每股收益(元)': profit * 1e4 / shares,
+      u'每股净资产(元)': equity * 1e4 / shares,
+      u'每股经营活动产生的现金流量净额(元)': profit * 1.1 * 1e4 / shares,
+      u'主营业务收入(万元)': revenue,
+      u'主营业务利润(万元)': revenue * 0.3,
+      u'营业利润(万元)': profit * 1.2,
+      u'投资收益(万元)': profit * 0.05,
+      u'营业外收支净额(万元)': profit * 0.01,
+      u'利润总额(万元)': profit * 1.25,
+      u'净利润(万元)': profit,
+      u'净利润(扣除非经常性损益后)(万元)': profit * 0.95,
+      u'经营活动产生的现金流量净额(万元)': profit * 1.1,
+      u'现金及现金等价物净增加额(万元)': profit * 0.3,
+      u'总资产(万元)': assets,
+      u'流动资产(万元)': assets * 0.5,
+      u'总负债(万元)': assets - equity,
+      u'流动负债(万元)': (assets - equity) * 0.6,
+      u'股东权益不含少数股东权益(万元)': equity,
+      u'净资产收益率加权(%)': profit / equity * 100.0,
+    }
+    for name, value in values.iteritems():
+      main_values[name].append(_FormatValue(rnd, value))
+
+  for page, (names, num_rows) in _PAGE_METRICS.iteritems():
+    rows = []
+    for i in range(num_rows):
+      name = names[i] if i < len(names) else u'%s其他项目%d(万元)' % (page, i)
+      if page == 'main_metrics':
+        rows.append((name, main_values[name]))
+      else:
+        scale = rnd.uniform(1, 1e5)
+        rows.append((name, [_FormatValue(rnd, scale * rnd.uniform(0.5, 1.5)) for s in seasons]))
+    _WritePage(os.path.join(directory, '%s.%s.csv' % (code, page)), seasons, rows)
+
+
+def _GeneratePrices(rnd, directory, code, name, today, start_date, shares):
+  """ Writes the daily prices in descending order, with the suspended days
+  at price 0 as in the Netease data.
+  """
+  price = rnd.uniform(3, 50)
+  float_ratio = rnd.uniform(0.3, 1.0)
+  rows = []
+  day = start_date
+  one_day = datetime.timedelta(days=1)
+  while day <= today:
+    if day.weekday() < 5:
+      price = max(0.5, price * math.exp(rnd.gauss(0.0002, 0.025)))
+      close = 0.0 if rnd.random() < 0.01 else price
+      rows.append("%s,'%s,%s,%.2f,%.6e,%.6e" % (
+          day.isoformat(), code, name, close, close * shares, close * shares * float_ratio))
+    day += one_day
+  rows.reverse()
+  header = u'日期,股票代码,名称,收盘价,总市值,流通市值'
+  with open(os.path.join(directory, '%s.price_history.csv' % code), 'w') as f:
+    f.write(header.encode('GBK') + '\r\n' + '\r\n'.join(rows).decode('UTF8').encode('GBK') + '\r\n')
+
+
+def Generate(directory, num_stocks, seed=0):
+  """ Generates the pages of num_stocks synthetic stocks into the directory,
+  and the stock list as stocklist_<num_stocks>.csv in it. Returns the stock
+  list path. The stocks generated before are kept.
+  """
+  if not os.path.exists(directory):
+    os.makedirs(directory, 0755)
+  today = datetime.date.today()
+  seasons = _GetSeasons(today)
+  price_start = datetime.date(today.year - _NUM_PRICE_YEARS, 1, 1)
+
+  stock_rows = []
+  for i in range(num_stocks):
+    code = GetStockCode(i)
+    name = u'合成%d' % i
+    rnd = random.Random('%d-%d' % (seed, i))
+    ipo_date = price_start - datetime.timedelta(days=rnd.randint(0, 3000))
+    stock_rows.append({
+      u'A股代码'.encode('utf8'): code,
+      u'A股简称'.encode('utf8'): name.encode('utf8'),
+      u'上市日期'.encode('utf8'): ipo_date.isoformat(),
+      u'2012年行业名称'.encode('utf8'): rnd.choice(_INDUSTRIES).encode('utf8'),
+    })
+    if os.path.exists(os.path.join(directory, '%s.price_history.csv' % code)):
+      continue  # generated before
+    shares = rnd.uniform(1e8, 5e9)
+    _GenerateStatements(rnd, directory, code, seasons, shares)
+    _GeneratePrices(rnd, directory, code, name.encode('utf8'), today, price_start, shares)
+    if (i + 1) % 100 == 0:
+      logging.info('%d of %d synthetic stocks generated', i + 1, num_stocks)
+
+  stock_list = os.path.join(directory, 'stocklist_%d.csv' % num_stocks)
+  header = [
+      u'A股代码'.encode('utf8'),
+      u'A股简称'.encode('utf8'),
+      u'上市日期'.encode('utf8'),
+      u'2012年行业名称'.encode('utf8'),
+  ]
+  with open(stock_list, 'w') as f:
+    writer = csv.DictWriter(f, fieldnames=header)
+    writer.writeheader()
+    writer.writerows(stock_rows)
+  return stock_list
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+
+  logging.basicConfig(level=logging.INFO)
+  stock_list = Generate(FLAGS.synthetic_directory, 10)
+  logging.info('Stock list: %s', stock_list)
+
+if __name__ == "__main__":
+  main()
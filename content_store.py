@@ -0,0 +1,105 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" The raw pages shared by all data directories, e.g. of each quarter, and
+of the full and the portfolio runs.
+
+Each page content is kept once in <root>/<code>/<name>.<md5>, and
+<root>/<code>/<name>.latest records the md5 and the time of the latest fetch
+of that page. The data directories hold hardlinks to the contents instead of
+copies, so that a page which does not change is stored only once, and a page
+fetched by one run recently is not downloaded again by another.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import thread
+import time
+
+import flags
+import data_store
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--content_store', default='',
+    help='The directory of the pages shared by all data directories. Empty for no sharing.')
+flags.ArgParser().add_argument('--shared_page_max_age_hours', type=float, default=12,
+    help='A page fetched in these hours by any run is taken from the content store '
+    'instead of downloaded again.')
+
+
+class ContentStore(object):
+  """ The page contents keyed by (code, name, md5). """
+  def __init__(self, directory):
+    self.__directory = directory
+
+  def __GetPath(self, code, name, suffix):
+    return os.path.join(self.__directory, code, '%s.%s' % (name, suffix))
+
+  def __WriteFile(self, path, content):
+    # the runs in other processes may write the same file at the same time.
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), thread.get_ident())
+    with open(tmp_path, 'wb') as f:
+      f.write(content)
+    os.rename(tmp_path, path)
+
+  def GetLatest(self, code, name):
+    """ Returns (content path, fetch timestamp) of the latest fetch of the
+    page, or None if never fetched.
+    """
+    try:
+      with open(self.__GetPath(code, name, 'latest')) as f:
+        (content_hash, fetch_ts) = f.read().split('\t')
+    except (IOError, ValueError):
+      return None
+    path = self.__GetPath(code, name, content_hash)
+    if not os.path.exists(path):
+      return None
+    return (path, float(fetch_ts))
+
+  def Put(self, code, name, content):
+    """ Saves the content of a fetched page if it is new, and records it as
+    the latest. Returns the content path.
+    """
+    directory = os.path.join(self.__directory, code)
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory, 0755)
+      except OSError:
+        pass  # created by another thread
+    path = self.__GetPath(code, name, hashlib.md5(content).hexdigest())
+    if not os.path.exists(path):
+      self.__WriteFile(path, content)
+    self.__WriteFile(self.__GetPath(code, name, 'latest'),
+        '%s\t%r' % (os.path.basename(path).rsplit('.', 1)[1], time.time()))
+    return path
+
+  def LinkInto(self, store, code, name, path):
+    """ Puts the content at path into the data store, as a hardlink if the
+    store keeps files, otherwise as a copy.
+    """
+    if isinstance(store, data_store.FileDataStore):
+      target = store.GetPath(code, name)
+      tmp_path = '%s.%d.%d.tmp' % (target, os.getpid(), thread.get_ident())
+      try:
+        os.link(path, tmp_path)
+        os.rename(tmp_path, target)  # the old link, if any, is replaced
+        return
+      except OSError, e:  # e.g. on another file system
+        logging.warning('Failed to link %s to %s: %s', path, target, e)
+    with open(path, 'rb') as f:
+      store.Write(code, name, f.read())
+
+
+def OpenContentStore():
+  """ Returns the ContentStore of --content_store, or None if not set. """
+  if not FLAGS.content_store:
+    return None
+  directory = os.path.abspath(os.path.expanduser(FLAGS.content_store))
+  if not os.path.exists(directory):
+    try:
+      os.makedirs(directory, 0755)
+    except OSError:
+      pass  # created by another process
+  return ContentStore(directory)
@@ -0,0 +1,47 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import multiprocessing
+
+import flags
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--num_cpu_workers', type=int, default=0,
+    help='The number of worker processes for the CPU bound work, i.e. refining '
+    'and insights. If 0, the work runs in the calling thread.')
+
+
+class CpuWorkerPool(object):
+  """ Runs CPU bound functions in worker processes, so that they are not
+  serialized by the GIL. Run() blocks the calling thread till the result is
+  back, so that the network I/O stays on threads which share the pool.
+
+  The function must be a module level function, and the arguments and the
+  result must be picklable.
+  """
+  def __init__(self, num_workers):
+    assert 0 <= num_workers
+    self.__num_workers = num_workers
+    self.__pool = None
+    if num_workers > 0:
+      # Create the pool before starting any thread, since it forks.
+      self.__pool = multiprocessing.Pool(num_workers)
+      logging.info('%d cpu worker processes started', num_workers)
+
+  def num_workers(self):
+    return self.__num_workers
+
+  def Run(self, func, *args):
+    """ Returns func(*args). Exceptions are re-raised in the calling thread. """
+    if not self.__pool:
+      return func(*args)
+    return self.__pool.apply_async(func, args).get()
+
+  def Close(self):
+    """ Waits for all the workers to exit. """
+    if self.__pool:
+      self.__pool.close()
+      self.__pool.join()
+      self.__pool = None
@@ -4,14 +4,28 @@
 import argparse
 import csv
 import datetime
+import hashlib
 import logging
+import numpy
 import os
 import re
+import shutil
+import socket
+import StringIO
 import sys
+import threading
+import time
 import urllib2
+import Queue
 
+import async_http
+import content_store
+import data_store
 import flags
 import date_util
+import parsed_page
+import perf_metrics
+import rate_control
 import stock_info
 
 FLAGS = flags.FLAGS
@@ -23,24 +37,129 @@ flags.ArgParser().add_argument(
     '--refetch_price',
     default=False, action='store_true',
     help='If set, always refetch the price data even if it already exists.')
+flags.ArgParser().add_argument(
+    '--incremental_price',
+    default=False, action='store_true',
+    help='If set, only fetch the prices after the last day in the existing '
+    'price data and merge them into it.')
+flags.ArgParser().add_argument(
+    '--fetch_engine',
+    default='urllib2', choices=['urllib2', 'async'],
+    help='urllib2 opens a new connection for each page, while async keeps the '
+    'connections alive and runs them all on one event loop thread.')
+flags.ArgParser().add_argument(
+    '--netease_url_base',
+    default='http://quotes.money.163.com',
+    help='The base url of the Netease data pages, e.g. a local stand-in server.')
+flags.ArgParser().add_argument(
+    '--gzip_transfer',
+    default=False, action='store_true',
+    help='If set, ask the server to send the pages gzipped.')
+flags.ArgParser().add_argument(
+    '--compress_raw_data',
+    default=False, action='store_true',
+    help='If set, store the fetched pages gzipped. The pages are read '
+    'whether they are gzipped or not.')
+flags.ArgParser().add_argument(
+    '--page_fetch_threads',
+    type=int, default=1,
+    help='The max number of pages of a stock fetched at the same time by '
+    'urllib2, while the async engine sends all pages of a stock at once. The '
+    'requests of all stocks are bounded by --max_in_flight_requests.')
 flags.ArgParser().add_argument(
     '--force_refine',
     default=False, action='store_true',
-    help='If set, always refine the raw data even if the result already exists.')
+    help='If set, always refine the raw data even if the raw data does not change.')
+flags.ArgParser().add_argument(
+    '--refined_csv',
+    default=False, action='store_true',
+    help='If set, also export the refined data to <code>.refined.csv for reading.')
 
 Stock = stock_info.Stock
 
+# A price history starting this long after its expected first day misses the
+# earlier prices, rather than the holidays or a suspension of trading.
+_MAX_DAYS_WITHOUT_TRADING = datetime.timedelta(days=31)
+
+# The number of past years which the annual insights of a year look back on,
+# as the 12 past seasons of the seasonal insights. The seasonal prices cover
+# these years before the last year, so the earlier insight years may miss the
+# prices of their earliest past years.
+NUM_ANNUAL_PAST_YEARS = 12
+
+_FETCH_DECISIONS = perf_metrics.GetRegistry().GetCounter('fetch_decisions_total',
+    'The pages fetched, skipped or fetched incrementally.', ['page', 'decision'])
+_PAGE_FETCH_SECONDS = perf_metrics.GetRegistry().GetHistogram('page_fetch_seconds',
+    'The latency of each page request.', ['page'])
+_PAGE_FETCH_BYTES = perf_metrics.GetRegistry().GetHistogram('page_fetch_bytes',
+    'The size of each fetched page.', ['page'], perf_metrics.BYTES_BUCKETS)
+_PAGE_FETCH_STATUS = perf_metrics.GetRegistry().GetCounter('page_fetch_status_total',
+    'The http status of each page request, or error if no response.', ['page', 'status'])
+
+
+class PriceHistory(object):
+  """ The daily price history of a stock in columns sorted by date. """
+  def __init__(self, dates, close, total_cap, float_cap):
+    self.dates = dates          # numpy datetime64[D] array in ascending order
+    self.close = close          # the close price
+    self.total_cap = total_cap  # the total market value
+    self.float_cap = float_cap  # the floating market value
+    self._traded_prices = {}
+
+  def GetTradedPrices(self, column):
+    """ Returns (dates, prices) of a column, e.g. 'close'. A day without
+    price (e.g. the stock is suspended) takes the price of the previous day,
+    and the days before the first price are dropped.
+    """
+    traded_prices = self._traded_prices.get(column)
+    if traded_prices is None:
+      prices = getattr(self, column)
+      # forward fill the zero prices by the index of the last positive price.
+      last_index = numpy.where(prices > 1e-6, numpy.arange(len(prices)), -1)
+      last_index = numpy.maximum.accumulate(last_index)
+      traded = last_index >= 0
+      traded_prices = (self.dates[traded], prices[last_index[traded]])
+      self._traded_prices[column] = traded_prices
+    return traded_prices
+
 
 # The base class
 class DataFetcher(object):
   def __init__(self, directory):
     self._directory = directory
+    self._store = data_store.OpenDataStore(directory)
+    self._content_store = content_store.OpenContentStore()
 
   # Fetch data of a given stock from sources
   def Fetch(self, stock):
+    self.FetchRaw(stock)
+    self.Refine(stock)
+
+  # Fetch the raw data of a given stock, which is I/O bound.
+  def FetchRaw(self, stock):
+    pass
+
+  # Calculate the derived data from the raw data, which is CPU bound.
+  def Refine(self, stock):
     pass
 
 
+class _PageDownload(object):
+  """ The download of a page, in flight by the async engine or to be done
+  by urllib2.
+  """
+  def __init__(self, page_name, url, headers):
+    self.page_name = page_name
+    self.url = url
+    self.headers = headers
+    self.attempt = 0
+    # of the async request in flight.
+    self.request = None
+    self.body = None
+    self.latency = None
+    self.retryable = False
+
+
 # The base of Netease data fetcher
 class NeteaseFetcher(DataFetcher):
   _data_pages = [
@@ -55,8 +174,13 @@ class NeteaseFetcher(DataFetcher):
       'price_history',      # The price history page pattern
   ]
 
+  # The number of reporting seasons in a year, for the YoY growth.
+  _seasons_per_year = 4
+
   def __init__(self, directory):
     super(NeteaseFetcher, self).__init__(directory)
+    # where the raw pages are, and the refined data is always in _store.
+    self._raw_store = self._store
     self._reporting_seasons = self._GetReportingSeasons()
 
   def _GetReportingSeasons(self):
@@ -71,63 +195,369 @@ class NeteaseFetcher(DataFetcher):
     """
     assert False, 'Must override _SetupDataSources.';
 
-  def Fetch(self, stock):
+  def _GetPriceHistoryUrl(self, stock, start_date, end_date):
+    """ Returns the url of price history between the two dates.
+    must be overridden.
+    """
+    assert False, 'Must override _GetPriceHistoryUrl.';
+
+  def _GetPriceStartDate(self):
+    """ Returns the first day of the price history to fetch.
+    must be overridden.
+    """
+    assert False, 'Must override _GetPriceStartDate.';
+
+  def FetchRaw(self, stock):
     # setup the sources of a certain stock
     data_sources = self._SetupDataSources(stock)
     # fetch the raw data
     self._FetchFromSources(stock, data_sources)
+
+  def Refine(self, stock):
     # process and calculate some derived data
     self._RefineData(stock)
 
   def _FetchFromSources(self, stock, data_sources):
-    """ Fetch raw data from data sources."""
+    """ Fetch raw data from data sources. With the async engine all pages are
+    sent at once and fetched together by its event loop, otherwise up to
+    --page_fetch_threads pages are fetched at the same time.
+    """
     logging.info('Fetching %s(%s) ...', stock.code(), stock.name())
     for page_name in self._data_pages:
-      page_url = data_sources.get(page_name)
-      assert page_url
-      self._FetchUrl(stock, page_name, page_url)
+      assert data_sources.get(page_name)
+
+    if FLAGS.fetch_engine == 'async':
+      downloads = [(page_name, self._StartFetchUrl(stock, page_name, data_sources[page_name]))
+          for page_name in self._data_pages]
+      for page_name, download in downloads:
+        if download:
+          self._FinishFetchUrl(stock, page_name, download)
+      return
+
+    num_threads = min(FLAGS.page_fetch_threads, len(self._data_pages))
+    if num_threads <= 1:
+      for page_name in self._data_pages:
+        self._FetchUrl(stock, page_name, data_sources[page_name])
+      return
+
+    # the threads only live in this call, so that the fetcher can still be
+    # pickled into the cpu workers.
+    page_queue = Queue.Queue()
+    for page_name in self._data_pages:
+      page_queue.put(page_name)
+    errors = []
+
+    def Run():
+      while True:
+        try:
+          page_name = page_queue.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          self._FetchUrl(stock, page_name, data_sources[page_name])
+        except Exception, e:
+          logging.error('Error in fetching %s for %s(%s): %s',
+              page_name, stock.code(), stock.name(), e)
+          errors.append(e)
+
+    threads = [threading.Thread(target=Run, name=('PageFetch-%s-%d' % (stock.code(), i)))
+        for i in range(num_threads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise errors[0]  # the stock fails as in the sequential fetching
 
   def _FetchUrl(self, stock, page_name, page_url):
-    filename = '%s.%s.csv' % (stock.code(), page_name)
-    full_filepath = os.path.join(self._directory, filename)
+    download = self._StartFetchUrl(stock, page_name, page_url)
+    if download:
+      self._FinishFetchUrl(stock, page_name, download)
+
+  def _StartFetchUrl(self, stock, page_name, page_url):
+    """ Takes the page from the existing data if possible, otherwise starts
+    to download it. Returns the _PageDownload to finish, or None if done.
+    """
+    name = '%s.csv' % page_name
+    filename = '%s.%s' % (stock.code(), name)
+
+    # take the page fetched by another run, e.g. of the last quarter.
+    if (not FLAGS.force_refetch and not self._raw_store.Exists(stock.code(), name)
+        and self._LinkSharedPage(stock, page_name, name)):
+      _FETCH_DECISIONS.Inc((page_name, 'shared'))
+      if page_name != 'price_history' or not FLAGS.incremental_price:
+        return
+
+    # only fetch the missing days of the existing price history.
+    if (page_name == 'price_history' and FLAGS.incremental_price
+        and not FLAGS.force_refetch and self._raw_store.Exists(stock.code(), name)
+        and self._FetchIncrementalPrice(stock, name)):
+      _FETCH_DECISIONS.Inc((page_name, 'incremental'))
+      return
 
     # check if we want to skip the fetch.
     if (not FLAGS.force_refetch
         and (page_name != 'price_history' or not FLAGS.refetch_price)
-        and os.path.exists(full_filepath)):
+        and self._raw_store.Exists(stock.code(), name)):
       logging.info('%s exists. Skip fetching %s for %s(%s)',
-          full_filepath, page_name, stock.code(), stock.name())
+          filename, page_name, stock.code(), stock.name())
+      _FETCH_DECISIONS.Inc((page_name, 'skip'))
       return
 
     logging.info('Fetching %s for %s(%s) at %s',
         page_name, stock.code(), stock.name(), page_url)
-    try:
-      response = urllib2.urlopen(page_url, timeout=15)  # 15 seconds timeout
-      content = response.read()
-    except URLError, e:
-      if hasattr(e, 'code'):  # HTTPError
-        logging.error('Http error %d for url: %s', e.code, page_url)
-      elif hasattr(e, 'reason'):
-        logging.error('Url error: %s, with reason %s', page_url, str(e.reason))
+    _FETCH_DECISIONS.Inc((page_name, 'fetch'))
+    return self._StartDownload(page_name, page_url)
+
+  def _FinishFetchUrl(self, stock, page_name, download):
+    # the old data is replaced only on success.
+    sink = StringIO.StringIO()
+    if not self._FinishDownload(download, sink):
       return
 
-    logging.info('Saving %s to %s', page_name, filename)
-    f = open(full_filepath, 'w')
-    f.write(content)
-    f.close()
+    logging.info('Saving %s to %s.%s.csv', page_name, stock.code(), page_name)
+    self._WriteRaw(stock, '%s.csv' % page_name, sink.getvalue())
+
+  def _LinkSharedPage(self, stock, page_name, name):
+    """ Links the latest content of the page in the content store into the
+    data directory if it is fresh enough, or if it is the price history to
+    be fetched incrementally. Returns False if not linked.
+    """
+    if not self._content_store:
+      return False
+    latest = self._content_store.GetLatest(stock.code(), name)
+    if not latest:
+      return False
+    (path, fetch_ts) = latest
+    is_fresh = time.time() - fetch_ts < FLAGS.shared_page_max_age_hours * 3600
+    if page_name == 'price_history':
+      if FLAGS.refetch_price:
+        return False
+      # the missing days are fetched later.
+      is_fresh = is_fresh or FLAGS.incremental_price
+    if not is_fresh:
+      return False
+    logging.info('Linking the shared %s for %s(%s)', page_name, stock.code(), stock.name())
+    self._content_store.LinkInto(self._raw_store, stock.code(), name, path)
+    return True
+
+  def _GetRawStore(self, stock):
+    """ Returns the data store to read the raw pages of the stock from. """
+    return self._raw_store
+
+  def _ReadRaw(self, stock, name):
+    """ Returns the content of a raw page, unzipped if stored gzipped. """
+    return data_store.Decompress(self._GetRawStore(stock).Read(stock.code(), name))
+
+  def _WriteRaw(self, stock, name, content):
+    if FLAGS.compress_raw_data:
+      content = data_store.Compress(content)
+    if not self._content_store:
+      self._raw_store.Write(stock.code(), name, content)
+      return
+    path = self._content_store.Put(stock.code(), name, content)
+    self._content_store.LinkInto(self._raw_store, stock.code(), name, path)
+
+  def _Download(self, page_name, page_url, sink):
+    """ Writes the content of the url into sink, a file-like object.
+    Returns False on errors.
+    """
+    return self._FinishDownload(self._StartDownload(page_name, page_url), sink)
+
+  def _StartDownload(self, page_name, page_url):
+    """ Returns the _PageDownload of the url. The async engine sends the
+    request at once, while urllib2 sends it when the download is finished.
+    """
+    download = _PageDownload(page_name, page_url,
+        {'Accept-Encoding': 'gzip'} if FLAGS.gzip_transfer else {})
+    if FLAGS.fetch_engine == 'async':
+      self._SendAsync(download)
+    return download
+
+  def _SendAsync(self, download):
+    """ Sends the request of the download by the async engine, under the
+    limits of the shared controller.
+    """
+    controller = rate_control.GetSharedController()
+    controller.Acquire()
+    download.body = StringIO.StringIO()
+    start_ts = time.time()
+
+    def OnFinish(error):
+      # in the event loop thread, so the limits are released on completion
+      # even if nobody waits for it yet.
+      download.latency = time.time() - start_ts
+      download.retryable = controller.Release(download.latency, error)
+
+    download.request = async_http.GetSharedClient().Fetch(
+        download.url, download.body, download.headers, OnFinish)
+
+  def _FinishDownload(self, download, sink):
+    """ Waits for the download and writes its content into sink, retrying
+    the failed requests. Returns False on errors.
+    """
+    if FLAGS.fetch_engine != 'async':
+      return self._DownloadByUrllib2(download, sink)
+
+    controller = rate_control.GetSharedController()
+    while True:
+      status = 'error'
+      try:
+        try:
+          download.request.Wait()
+          status = 200
+        except urllib2.HTTPError, e:
+          status = e.code
+          raise
+        finally:
+          _PAGE_FETCH_SECONDS.Observe(download.latency, (download.page_name,))
+          _PAGE_FETCH_STATUS.Inc((download.page_name, status))
+        try:
+          self._WriteContent(download.page_name, download.body,
+              download.request.response_headers.get('content-encoding', ''), sink)
+          return True
+        except urllib2.URLError:
+          download.retryable = True  # a broken body is worth a retry
+          raise
+      except urllib2.URLError, e:
+        if not download.retryable or download.attempt >= controller.max_retries():
+          self._LogDownloadError(download.url, e)
+          return False
+      download.attempt += 1
+      controller.WaitForRetry(download.attempt)
+      self._SendAsync(download)
+
+  def _DownloadByUrllib2(self, download, sink):
+    def Request():
+      # each attempt is measured.
+      start_ts = time.time()
+      status = 'error'
+      body = StringIO.StringIO()
+      try:
+        try:
+          request = urllib2.Request(download.url, headers=download.headers)
+          response = urllib2.urlopen(request, timeout=15)  # 15 seconds timeout
+          shutil.copyfileobj(response, body)
+          encoding = response.info().get('Content-Encoding', '')
+        except socket.error, e:  # e.g. timeout in reading
+          raise urllib2.URLError(e)
+        status = 200
+      except urllib2.HTTPError, e:
+        status = e.code
+        raise
+      finally:
+        _PAGE_FETCH_SECONDS.Observe(time.time() - start_ts, (download.page_name,))
+        _PAGE_FETCH_STATUS.Inc((download.page_name, status))
+      self._WriteContent(download.page_name, body, encoding, sink)
+
+    def Reset():
+      sink.seek(0)
+      sink.truncate()
+
+    try:
+      # retried and throttled by the controller shared by all threads.
+      rate_control.GetSharedController().Call(Request, Reset)
+      return True
+    except urllib2.URLError, e:
+      self._LogDownloadError(download.url, e)
+      return False
+
+  def _WriteContent(self, page_name, body, encoding, sink):
+    """ Writes the downloaded body into sink, unzipped if gzipped. """
+    # the bytes on the wire.
+    _PAGE_FETCH_BYTES.Observe(body.tell(), (page_name,))
+    content = body.getvalue()
+    if encoding.strip().lower() == 'gzip':
+      try:
+        content = data_store.Decompress(content)
+      except (IOError, EOFError), e:  # a broken body is worth a retry
+        raise urllib2.URLError(e)
+    sink.write(content)
+
+  def _LogDownloadError(self, page_url, e):
+    if hasattr(e, 'code'):  # HTTPError
+      logging.error('Http error %d for url: %s', e.code, page_url)
+    elif hasattr(e, 'reason'):
+      logging.error('Url error: %s, with reason %s', page_url, str(e.reason))
+
+  def _FetchIncrementalPrice(self, stock, name):
+    """ Fetches the prices since the last day in the existing price history
+    and merges them into it, replacing the overlapping days, since the last
+    day may be saved in the trading hours. Returns False if the existing data
+    has no price at all or does not go back to the price start date, so that
+    the caller should fetch the full history instead.
+    """
+    lines = self._ReadRaw(stock, name).splitlines()
+    if len(lines) < 2:
+      return False
+    # The first column is the date(YYYY-MM-DD) and the rows are in descending order.
+    header = lines[0]
+    old_rows = [line for line in lines[1:] if line]
+    days = [row.split(',', 1)[0] for row in old_rows]
+    (first_day, last_day) = (min(days), max(days))
+    # not by strptime, whose lazy import in python2 races in the fetcher threads.
+    (first_date, start_date) = [datetime.date(*map(int, day.split('-')))
+        for day in (first_day, last_day)]
+    if first_date > self.__GetFirstTradingDate(stock) + _MAX_DAYS_WITHOUT_TRADING:
+      logging.info('%s of %s(%s) starts at %s. Fetch the full price history.',
+          name, stock.code(), stock.name(), first_day)
+      return False
+    end_date = datetime.date.today()
+
+    page_url = self._GetPriceHistoryUrl(stock, start_date, end_date)
+    logging.info('Fetching price since %s for %s(%s) at %s',
+        start_date.isoformat(), stock.code(), stock.name(), page_url)
+    sink = StringIO.StringIO()
+    if not self._Download('price_history', page_url, sink):
+      return True  # keep the existing prices
+
+    new_rows = [line for line in sink.getvalue().splitlines()[1:]
+        if line and line.split(',', 1)[0] >= last_day]
+    new_days = set(row.split(',', 1)[0] for row in new_rows)
+    rows = sorted(new_rows + [row for row, day in zip(old_rows, days) if day not in new_days],
+        reverse=True)  # the latest day first
+    if rows == old_rows:
+      logging.info('No new price since %s for %s(%s)', last_day, stock.code(), stock.name())
+      return True
+
+    logging.info('Merging %d days of price into %s of %s(%s)',
+        len(new_rows), name, stock.code(), stock.name())
+    self._WriteRaw(stock, name, '\r\n'.join([header] + rows) + '\r\n')
+    return True
+
+  def __GetFirstTradingDate(self, stock):
+    """ Returns the first day which the price history should have, i.e. the
+    price start date, or the IPO date if later.
+    """
+    start_date = self._GetPriceStartDate()
+    try:
+      ipo_date = datetime.date(*map(int, stock.ipo_date().split('-')))
+    except (AttributeError, TypeError, ValueError):
+      return start_date
+    return max(start_date, ipo_date)
 
   def _RefineData(self, stock):
     """ Calculate some derived data."""
-    refine_output = os.path.join(self._directory, '%s.refined.csv' % stock.code())
-    if not FLAGS.force_refine and os.path.exists(refine_output):
-      logging.info('%s exists. Skip refining %s(%s)',
-          refine_output, stock.code(), stock.name())
+    refine_outputs = ['refined.idx', 'refined.npy']
+    if FLAGS.refined_csv:
+      refine_outputs.append('refined.csv')
+    (recorded_dependencies, dependencies) = self._GetRefineDependencies(stock)
+    if (not FLAGS.force_refine
+        and all(self._store.Exists(stock.code(), name) for name in refine_outputs)
+        and self._IsSameDependencies(recorded_dependencies, dependencies)):
+      logging.info('No new data since the last refining. Skip refining %s(%s)',
+          stock.code(), stock.name())
+      # the versions may change, e.g. refetched with the same content.
+      self._SaveRefineDependencies(stock, dependencies)
       return
 
     logging.info('Refining %s(%s) ...', stock.code(), stock.name())
     seasons_in_string = [season.isoformat() for season in self._reporting_seasons]
-    # {seasons_end -> {metrics -> value} }
-    full_raw_data = self._LoadFullRawData(stock, self._reporting_seasons)
+    # {page -> ParsedPage}
+    full_raw_data = self._LoadFullRawData(stock)
+    self._CheckRawData(stock, full_raw_data)
+    # the prices are loaded once and shared by all calculations below.
+    price_history = self._LoadPriceHistory(stock)
 
     # {metrics_name -> {seasons_end -> value} }
     refined_metrics_data = {}
@@ -141,12 +571,12 @@ class NeteaseFetcher(DataFetcher):
         u'股东权益不含少数股东权益(万元)@main_metrics'.encode('UTF8'),
     ]
     for metrics_name in metrics_names_for_growth:
-      metrics_data = [full_raw_data[season].get(metrics_name)
-          for season in seasons_in_string]
+      (metrics_name_in_page, page) = metrics_name.split('@')
+      metrics_data = full_raw_data[page].GetSeries(metrics_name_in_page, seasons_in_string)
       size = len(metrics_data)
       growth_data = [None] * size
       for i in range(size):
-        last_year = i + 4  # YoY growth
+        last_year = i + self._seasons_per_year  # YoY growth
         if metrics_data[i] and last_year < size and metrics_data[last_year]:
           growth_data[i] = (metrics_data[i] - metrics_data[last_year]) / abs(metrics_data[last_year]) * 100.0
       # add to refined data
@@ -155,40 +585,98 @@ class NeteaseFetcher(DataFetcher):
       refined_metrics_data[refined_name + '_growth'] = dict(zip(seasons_in_string, growth_data))
 
     # calculate PE.
-    seasonal_pe = self._CalculatePeFromEps(stock, refined_metrics_data)
+    seasonal_pe = self._CalculatePeFromEps(price_history, refined_metrics_data)
     refined_metrics_data['PE'] = seasonal_pe
-    seasonal_pe = self._CalculatePeFromMarketValue(stock, refined_metrics_data)
+    seasonal_pe = self._CalculatePeFromMarketValue(price_history, refined_metrics_data)
     refined_metrics_data['PE_MV'] = seasonal_pe
 
     # calculate PB.
-    seasonal_pb = self._CalculatePbFromMarketValue(stock, refined_metrics_data)
+    seasonal_pb = self._CalculatePbFromMarketValue(price_history, refined_metrics_data)
     refined_metrics_data['PB_MV'] = seasonal_pb
 
     # calculate market value
-    seasonal_market_value = self._GetSeasonalMarketValue(stock)
+    seasonal_market_value = self._GetSeasonalMarketValue(price_history)
     refined_metrics_data['MV'] = seasonal_market_value
 
-    # write csv
-    metrics_column = u'指标'.encode('UTF8')
     latest_day = datetime.date.today().isoformat()
+    self._WriteRefinedData(stock, refined_metrics_data, latest_day, seasons_in_string)
+    if FLAGS.refined_csv:
+      self._WriteRefinedCsv(stock, refined_metrics_data, latest_day, seasons_in_string)
+    self._SaveRefineDependencies(stock, dependencies)
+
+  def _WriteRefinedData(self, stock, refined_metrics_data, latest_day, seasons_in_string):
+    """ Writes the refined data as the float64 matrix of metrics x days,
+    which data_insights.LoadRefinedData loads without parsing.
+    """
+    days = sorted([latest_day] + seasons_in_string, reverse=True)  # the latest day first
+    metrics_names = sorted(refined_metrics_data)
+    values = numpy.array([[numpy.nan if v is None else v
+        for v in map(refined_metrics_data[metrics_name].get, days)]
+        for metrics_name in metrics_names], dtype=numpy.float64).reshape(
+        (len(metrics_names), len(days)))
+    # The matrix is written last, since its version tells the readers that
+    # the refined data changes.
+    self._store.Write(stock.code(), 'refined.idx', '\n'.join([','.join(days)] + metrics_names))
+    self._store.WriteArray(stock.code(), 'refined.npy', values)
+
+  def _WriteRefinedCsv(self, stock, refined_metrics_data, latest_day, seasons_in_string):
+    """ Exports the refined data to csv for reading. """
+    metrics_column = u'指标'.encode('UTF8')
     # the columns are in this order.
     header = [metrics_column, latest_day] + seasons_in_string
-    writer = csv.DictWriter(open(refine_output, 'w'), fieldnames=header)
+    output = StringIO.StringIO()
+    writer = csv.DictWriter(output, fieldnames=header)
     writer.writeheader()
     for metrics_name, values in refined_metrics_data.iteritems():
       row = {metrics_column: metrics_name}
       row.update(values)
       writer.writerow(row)
+    self._store.Write(stock.code(), 'refined.csv', output.getvalue())
+
+  def _GetRefineDependencies(self, stock):
+    """ Returns (recorded, current) dependencies of refining, i.e. the
+    reporting seasons and the version and content hash of each raw page, as
+    {name -> [version, hash]}. The recorded one is saved by the last refining.
+    The content is only hashed when the version changes.
+    """
+    recorded = {}
+    if self._store.Exists(stock.code(), 'refined.deps'):
+      for line in self._store.Read(stock.code(), 'refined.deps').splitlines():
+        fields = line.split('\t')
+        recorded[fields[0]] = fields[1:]
 
-  def _CalculatePeFromEps(self, stock, refined_metrics_data):
-    price_column = u'收盘价'.encode('GBK')
-    price_history = self._LoadAllPrices(stock, price_column)
+    current = {'seasons': [','.join([s.isoformat() for s in self._reporting_seasons])]}
+    raw_store = self._GetRawStore(stock)
+    for page in self._data_pages:
+      name = '%s.csv' % page
+      version = str(raw_store.GetVersion(stock.code(), name))
+      (recorded_version, content_hash) = recorded.get(name, [None, None])
+      if version != recorded_version:
+        content_hash = 'None'
+        if raw_store.Exists(stock.code(), name):
+          content_hash = hashlib.md5(raw_store.Read(stock.code(), name)).hexdigest()
+      current[name] = [version, content_hash]
+    return (recorded, current)
+
+  def _IsSameDependencies(self, recorded, current):
+    """ Compares the reporting seasons and the content hashes. """
+    return (set(recorded.keys()) == set(current.keys())
+        and all(recorded[k][-1] == current[k][-1] for k in current))
+
+  def _SaveRefineDependencies(self, stock, dependencies):
+    content = '\n'.join(['\t'.join([k] + v) for k, v in sorted(dependencies.items())])
+    if (not self._store.Exists(stock.code(), 'refined.deps')
+        or self._store.Read(stock.code(), 'refined.deps') != content):
+      self._store.Write(stock.code(), 'refined.deps', content)
+
+  def _CalculatePeFromEps(self, price_history, refined_metrics_data):
+    all_prices = price_history.GetTradedPrices('close')
 
     # also calculate PE for the latest day.
     latest_day = datetime.date.today()
     seasons_to_report = self._reporting_seasons + [datetime.date.today()]
-    seasonal_price = self._GetSeasonalAveragePrice(price_history, self._reporting_seasons)
-    seasonal_price[latest_day.isoformat()] = self._GetPriceOnDay(price_history, latest_day)
+    seasonal_price = self._GetSeasonalAveragePrice(all_prices, self._reporting_seasons)
+    seasonal_price[latest_day.isoformat()] = self._GetPriceOnDay(all_prices, latest_day)
     seasonal_eps = self._GetSeasonalMetrics(
         refined_metrics_data.get(u'基本每股收益(元)'.encode('UTF8')),
         seasons_to_report,
@@ -206,9 +694,8 @@ class NeteaseFetcher(DataFetcher):
       seasonal_pe[day_string] = pe
     return seasonal_pe
 
-  def _CalculatePeFromMarketValue(self, stock, refined_metrics_data):
-    price_column = u'总市值'.encode('GBK')
-    mv_history = self._LoadAllPrices(stock, price_column)
+  def _CalculatePeFromMarketValue(self, price_history, refined_metrics_data):
+    mv_history = price_history.GetTradedPrices('total_cap')
 
     # also calculate PE for the latest day.
     latest_day = datetime.date.today()
@@ -232,9 +719,8 @@ class NeteaseFetcher(DataFetcher):
       seasonal_pe[day_string] = pe
     return seasonal_pe
 
-  def _CalculatePbFromMarketValue(self, stock, refined_metrics_data):
-    price_column = u'总市值'.encode('GBK')
-    mv_history = self._LoadAllPrices(stock, price_column)
+  def _CalculatePbFromMarketValue(self, price_history, refined_metrics_data):
+    mv_history = price_history.GetTradedPrices('total_cap')
 
     # also calculate PE for the latest day.
     latest_day = datetime.date.today()
@@ -279,7 +765,7 @@ class NeteaseFetcher(DataFetcher):
       n = 0
       while not metrics and n <= 2:
         # no metrics for that day, use the previous season
-        previous_season = date_util.GetLastSeasonEndDate(day)
+        previous_season = self._GetPreviousSeason(day)
         metrics = per_season_metrics.get(previous_season.isoformat())
         metrics_month = previous_season.month
         n += 1
@@ -289,94 +775,103 @@ class NeteaseFetcher(DataFetcher):
       seasonal_metrics[day.isoformat()] = metrics
     return seasonal_metrics
 
-  def _GetSeasonalMarketValue(self, stock):
+  def _GetSeasonalMarketValue(self, price_history):
     """ Retuns {season -> market value}. """
-    mv_column = u'总市值'.encode('GBK')
-    mv_history = self._LoadAllPrices(stock, mv_column)
+    mv_history = price_history.GetTradedPrices('total_cap')
     seasonal_mv = {}
-    if len(mv_history) > 0:
-      earliest_day = min(mv_history.keys())
-      for season in self._reporting_seasons:
-        mv = self._GetPriceOnDay(mv_history, season, earliest_day)
-        seasonal_mv[season.isoformat()] = mv
+    if len(price_history.dates) > 0:
       # Always get the latest market value.
-      today = datetime.date.today()
-      latest_mv = self._GetPriceOnDay(mv_history, today, earliest_day)
-      seasonal_mv[today.isoformat()] = latest_mv
+      days = self._reporting_seasons + [datetime.date.today()]
+      seasonal_mv = dict(zip([day.isoformat() for day in days],
+          self._GetPricesOnDays(mv_history, days)))
     return seasonal_mv
 
-  def _LoadFullRawData(self, stock, seasons_end):
-    full_data = {}  # {seasons_end -> {metrics -> value} }
+  def _CheckRawData(self, stock, full_raw_data):
+    """ Checks the parsed statement pages {page -> ParsedPage} before refining. """
+    pass
+
+  def _LoadFullRawData(self, stock):
+    full_data = {}  # {page -> ParsedPage}
     for page in self._data_pages:
       if page != 'price_history':
-        self._LoadPage(page, stock, seasons_end, full_data)
+        full_data[page] = self._LoadPage(page, stock)
     return full_data
 
-  def _LoadPage(self, page, stock, seasons_end, full_data):
-    datafile = os.path.join(self._directory, '%s.%s.csv' % (stock.code(), page))
-    reader = csv.DictReader(open(datafile))
-    # The first column is metrics name.
-    metrics_column_name_gbk = list(reader.fieldnames)[0]
-    for row in reader:
-      metrics_name = row[metrics_column_name_gbk]
-      # append "page" to differentiate metrics in different pages.
-      metrics_name = '%s@%s' % (metrics_name.decode('GBK').encode('UTF8'), page)
-      for season in seasons_end:
-        season_string = season.isoformat()
-        per_season_data = full_data.setdefault(season_string, {})
-        value = None
-        value_string = row.get(season_string)
-        if value_string and re.match(r'^-?\d+(\.\d+)?$', value_string):
-          value = float(value_string)
-        per_season_data.update({metrics_name: value})
-
-  def _LoadAllPrices(self, stock, price_column):
-    """ Retuns {date(string) -> price(float)}. """
-    pricefile = os.path.join(self._directory, '%s.price_history.csv' % stock.code())
-    reader = csv.DictReader(open(pricefile))
-    date_column = u'日期'.encode('GBK')
-    all_prices = {}
-    for row in reader:
-      all_prices[row[date_column]] = float(row[price_column])
-    return all_prices
+  def _LoadPage(self, page, stock):
+    """ Returns the ParsedPage, which is parsed only once after each fetch. """
+    return parsed_page.LoadPage(self._GetRawStore(stock), stock.code(), '%s.csv' % page)
+
+  def _LoadPriceHistory(self, stock):
+    """ Parses the price history once and returns a PriceHistory. """
+    content = self._ReadRaw(stock, 'price_history.csv')
+    reader = csv.reader(StringIO.StringIO(content))
+    header = next(reader, None)
+    if not header:
+      empty = numpy.array([], dtype=numpy.float64)
+      return PriceHistory(numpy.array([], dtype='datetime64[D]'), empty, empty, empty)
+    date_index = header.index(u'日期'.encode('GBK'))
+    close_index = header.index(u'收盘价'.encode('GBK'))
+    total_cap_index = header.index(u'总市值'.encode('GBK'))
+    float_cap_index = header.index(u'流通市值'.encode('GBK'))
+    rows = [row for row in reader if row]
+    rows.sort(key=lambda row: row[date_index])
+    return PriceHistory(
+        numpy.array([row[date_index] for row in rows], dtype='datetime64[D]'),
+        numpy.array([float(row[close_index]) for row in rows], dtype=numpy.float64),
+        numpy.array([float(row[total_cap_index]) for row in rows], dtype=numpy.float64),
+        numpy.array([float(row[float_cap_index]) for row in rows], dtype=numpy.float64))
 
   def _GetSeasonalAveragePrice(self, all_prices, seasons):
-    """ Retuns {season -> average price}. """
+    """ Retuns {season -> average price}.
+
+    Args:
+      all_prices: (dates, prices) from PriceHistory.GetTradedPrices().
+      seasons: a list of season end dates.
+    """
     seasonal_price = {}
-    if len(all_prices) == 0:
+    (dates, prices) = all_prices
+    if len(dates) == 0:
       return seasonal_price
 
-    earliest_day = min(all_prices.keys())
-    for season_end in seasons:
-      season_start = date_util.GetSeasonStartDate(season_end)
-      day = season_start
-      last_price = self._GetPriceOnDay(all_prices, day, earliest_day)
-      prices = []
-      while day <= season_end:
-        p = all_prices.get(day.isoformat())
-        if p is not None:  # only count weekdays, on weekends p is None.
-          p = p if p > 1e-6 else last_price
-          if p > 1e-6:
-            prices.append(p)
-            last_price = p
-        day += datetime.timedelta(days=1)
-      seasonal_price[season_end.isoformat()] = (sum(prices) / len(prices) if len(prices) else None)
+    season_starts = numpy.array(
+        [self._GetSeasonStart(season_end) for season_end in seasons], dtype='datetime64[D]')
+    season_ends = numpy.array(seasons, dtype='datetime64[D]')
+    # the prices of a season are in [lower, upper).
+    lower = numpy.searchsorted(dates, season_starts, side='left')
+    upper = numpy.searchsorted(dates, season_ends, side='right')
+    # reduceat sums prices[lower:upper] for each (lower, upper) pair, and the
+    # padding keeps upper a valid index.
+    boundaries = numpy.empty(2 * len(seasons), dtype=numpy.intp)
+    boundaries[0::2] = lower
+    boundaries[1::2] = upper
+    sums = numpy.add.reduceat(numpy.append(prices, 0.0), boundaries)[0::2]
+    counts = upper - lower
+    for i, season_end in enumerate(seasons):
+      seasonal_price[season_end.isoformat()] = (
+          float(sums[i]) / counts[i] if counts[i] > 0 else None)
     return seasonal_price
 
-  def _GetPriceOnDay(self, all_prices, day, earliest_day=None):
+  def _GetSeasonStart(self, season_end):
+    """ Returns the first day of the reporting season. """
+    return date_util.GetSeasonStartDate(season_end)
+
+  def _GetPreviousSeason(self, day):
+    """ Returns the end of the reporting season before the day. """
+    return date_util.GetLastSeasonEndDate(day)
+
+  def _GetPriceOnDay(self, all_prices, day):
     """ Returns the market price on a specific day. Use the price of previous
     days if the stock does not trade on that day.
     """
-    if len(all_prices) == 0:
-      return None
+    return self._GetPricesOnDays(all_prices, [day])[0]
 
-    if not earliest_day:
-      earliest_day = min(all_prices.keys())
-    p = all_prices.get(day.isoformat(), 0.0)
-    while p <= 1e-6 and day.isoformat() > earliest_day:
-      day -= datetime.timedelta(days=1)  # the previous day
-      p = all_prices.get(day.isoformat(), 0.0)
-    return p if p > 1e-6 else None
+  def _GetPricesOnDays(self, all_prices, days):
+    """ Returns a list of the market price on each of the days, by a binary
+    search of the latest traded day not after that day.
+    """
+    (dates, prices) = all_prices
+    indexes = numpy.searchsorted(dates, numpy.array(days, dtype='datetime64[D]'), side='right') - 1
+    return [float(prices[i]) if i >= 0 else None for i in indexes]
 
 
 # Netease per season data fetcher
@@ -393,27 +888,124 @@ class NeteaseSeasonFetcher(NeteaseFetcher):
 
   def _SetupDataSources(self, stock):
     # Always get the latest price.
-    price_end_date = datetime.date.today().strftime('%Y%m%d')
-    # The earliest reporting season is reporting_seasons[-1].
-    # So we need the price since that season's start date.
-    price_start_date = date_util.GetSeasonStartDate(self._reporting_seasons[-1]).strftime('%Y%m%d')
-    # the stock code in the price history url should be tranformed.
-    code = '0%s' % stock.code() if stock.code().startswith('6') else '1%s' % stock.code()
+    price_end_date = datetime.date.today()
+    price_start_date = self._GetPriceStartDate()
     return {
-        'balance': ('http://quotes.money.163.com/service/zcfzb_%s.html' % stock.code()),
-        'income': ('http://quotes.money.163.com/service/lrb_%s.html' % stock.code()),
-        'cash': ('http://quotes.money.163.com/service/xjllb_%s.html' % stock.code()),
+        'balance': (FLAGS.netease_url_base + '/service/zcfzb_%s.html' % stock.code()),
+        'income': (FLAGS.netease_url_base + '/service/lrb_%s.html' % stock.code()),
+        'cash': (FLAGS.netease_url_base + '/service/xjllb_%s.html' % stock.code()),
         # the 'type=report' means seasonal data
-        'main_metrics': ('http://quotes.money.163.com/service/zycwzb_%s.html?type=report' % stock.code()),
-        'profit_metrics': ('http://quotes.money.163.com/service/zycwzb_%s.html?type=report&part=ylnl' % stock.code()),
-        'liability_metrics': ('http://quotes.money.163.com/service/zycwzb_%s.html?type=report&part=chnl' % stock.code()),
-        'growth_metrics': ('http://quotes.money.163.com/service/zycwzb_%s.html?type=report&part=cznl' % stock.code()),
-        'operating_metrics': ('http://quotes.money.163.com/service/zycwzb_%s.html?type=report&part=yynl' % stock.code()),
-        # the price fields are: close price, total value and market value.
-        'price_history': ('http://quotes.money.163.com/service/chddata.html' +
-            '?code=%s&start=%s&end=%s&fields=TCLOSE;TCAP;MCAP' % (code, price_start_date, price_end_date)),
+        'main_metrics': (FLAGS.netease_url_base + '/service/zycwzb_%s.html?type=report' % stock.code()),
+        'profit_metrics': (FLAGS.netease_url_base + '/service/zycwzb_%s.html?type=report&part=ylnl' % stock.code()),
+        'liability_metrics': (FLAGS.netease_url_base + '/service/zycwzb_%s.html?type=report&part=chnl' % stock.code()),
+        'growth_metrics': (FLAGS.netease_url_base + '/service/zycwzb_%s.html?type=report&part=cznl' % stock.code()),
+        'operating_metrics': (FLAGS.netease_url_base + '/service/zycwzb_%s.html?type=report&part=yynl' % stock.code()),
+        'price_history': self._GetPriceHistoryUrl(stock, price_start_date, price_end_date),
     }
 
+  def _GetPriceStartDate(self):
+    # The earliest reporting season is reporting_seasons[-1].
+    # So we need the price since that season's start date, and since the
+    # past years of the last year, which the annual data is derived from.
+    return min(date_util.GetSeasonStartDate(self._reporting_seasons[-1]),
+        datetime.date(datetime.date.today().year - 1 - NUM_ANNUAL_PAST_YEARS, 1, 1))
+
+  def _GetPriceHistoryUrl(self, stock, start_date, end_date):
+    # the stock code in the price history url should be tranformed.
+    code = '0%s' % stock.code() if stock.code().startswith('6') else '1%s' % stock.code()
+    # the price fields are: close price, total value and market value.
+    return (FLAGS.netease_url_base + '/service/chddata.html' +
+        '?code=%s&start=%s&end=%s&fields=TCLOSE;TCAP;MCAP' % (
+            code, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d')))
+
+
+# Netease annual data fetcher, which derives the annual data from the raw
+# pages already fetched by NeteaseSeasonFetcher without any download.
+class NeteaseAnnualFetcher(NeteaseFetcher):
+  _seasons_per_year = 1
+
+  def __init__(self, directory, seasonal_directory, first_insight_year=None):
+    """ first_insight_year is the earliest year to do insights, the last year
+    by default.
+    """
+    self._first_insight_year = first_insight_year
+    super(NeteaseAnnualFetcher, self).__init__(directory)
+    self._seasonal_directory = os.path.normpath(seasonal_directory)
+    self._seasonal_store = data_store.OpenDataStore(seasonal_directory)
+
+  def _GetReportingSeasons(self):
+    """ Returns a list of the year ends in reverse order, e.g. [2016-12-31,
+    2015-12-31], from the last year to the past years of the first insight
+    year, and one more year for the YoY growth of the earliest.
+    """
+    last_year = datetime.date.today().year - 1
+    first_year = min(last_year, self._first_insight_year or last_year) - NUM_ANNUAL_PAST_YEARS - 1
+    return [datetime.date(year, 12, 31) for year in range(last_year, first_year - 1, -1)]
+
+  def FetchRaw(self, stock):
+    """ Nothing to download. The raw pages are the seasonal ones of this
+    quarter, or if any is missing, the latest ones in the content store or in
+    the seasonal data of the past quarters, taken into the annual directory.
+    """
+    if self._GetRawStore(stock) is self._seasonal_store:
+      return
+    missing = [page for page in self._data_pages
+        if not self.__TakeLatestPage(stock, '%s.csv' % page)]
+    if missing:
+      raise IOError('No seasonal %s of %s(%s). Fetch the seasonal data first.' % (
+          ','.join(missing), stock.code(), stock.name()))
+
+  def _GetRawStore(self, stock):
+    if all(self._seasonal_store.Exists(stock.code(), '%s.csv' % page)
+        for page in self._data_pages):
+      return self._seasonal_store
+    return self._raw_store
+
+  def __TakeLatestPage(self, stock, name):
+    """ Puts the latest page into the annual directory. Returns False if the
+    page is nowhere.
+    """
+    latest = self._content_store.GetLatest(stock.code(), name) if self._content_store else None
+    if latest:
+      self._content_store.LinkInto(self._raw_store, stock.code(), name, latest[0])
+      return True
+    if self._raw_store.Exists(stock.code(), name):
+      return True  # taken by the last run
+    (parent, current) = os.path.split(self._seasonal_directory)
+    for past in sorted(os.listdir(parent), reverse=True):
+      past_directory = os.path.join(parent, past)
+      if past >= current or not os.path.isdir(past_directory):
+        continue
+      past_store = data_store.OpenDataStore(past_directory)
+      if past_store.Exists(stock.code(), name):
+        logging.info('Taking %s of %s(%s) from %s', name, stock.code(), stock.name(), past_directory)
+        self._raw_store.Write(stock.code(), name, past_store.Read(stock.code(), name))
+        return True
+    return False
+
+  def _CheckRawData(self, stock, full_raw_data):
+    """ Warns if the statements start later than the past years of the
+    first insight year, while the stock was listed before, since the
+    12seasons columns are empty without them.
+    """
+    first_year = self._reporting_seasons[-1].year
+    years = [int(season[:4]) for season in full_raw_data['main_metrics'].seasons
+        if season.endswith('-12-31')]
+    if not years or min(years) <= first_year:
+      return
+    ipo_date = stock.ipo_date() or ''
+    if ipo_date[:4].isdigit() and int(ipo_date[:4]) >= min(years):
+      return  # no statement before the IPO
+    logging.warning('The annual statements of %s(%s) start in %d, later than %d, so '
+        'the insights before %d miss their %d past years.', stock.code(), stock.name(),
+        min(years), first_year, min(years) + NUM_ANNUAL_PAST_YEARS + 1, NUM_ANNUAL_PAST_YEARS)
+
+  def _GetSeasonStart(self, season_end):
+    return datetime.date(season_end.year, 1, 1)
+
+  def _GetPreviousSeason(self, day):
+    return datetime.date(day.year - 1, 12, 31)
+
 
 def main():
   # Parse command line flags into FLAGS.
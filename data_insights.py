@@ -9,11 +9,11 @@ import logging
 import math
 import numpy
 import os
-import re
 import sys
 from scipy import stats
 
 import flags
+import data_store
 import date_util
 import stock_info
 
@@ -23,6 +23,10 @@ FLAGS = flags.FLAGS
 flags.ArgParser().add_argument(
     '--insight_season',
     help='The season to do insights: YYYY-03-31, YYYY-06-30, YYYY-09-30, YYYY-12-31')
+flags.ArgParser().add_argument(
+    '--insight_seasons',
+    help='The seasons to do insights, which overrides --insight_season. Either comma '
+    'separated seasons, or a range of FROM:TO, e.g. 2016-03-31:2017-12-31.')
 
 
 class InsightData(object):
@@ -30,6 +34,7 @@ class InsightData(object):
   def __init__(self):
     self._columns = []  # the data can be output in columns order
     self._data = {}
+    self._exact_data = {}  # {metrics_name -> value before rounding}, not output
 
   def AddColumns(self, cols):
     for c in cols:
@@ -43,9 +48,17 @@ class InsightData(object):
     self._data.update(data_map)
     return self
 
+  def UpdateExactData(self, data_map):
+    """ Keeps the values of the columns before they are rounded in data. """
+    for k in data_map.keys():
+      assert k in self._columns  # column should be registered
+    self._exact_data.update(data_map)
+    return self
+
   def Merge(self, other):
     self.AddColumns(other.columns())
     self.UpdateData(other.data())
+    self.UpdateExactData(other.exact_data())
     return self
 
   def columns(self):
@@ -54,62 +67,159 @@ class InsightData(object):
   def data(self):
     return self._data
 
+  def exact_data(self):
+    return self._exact_data
+
+  def GetExactValue(self, metrics_name):
+    """ Returns the value before rounding, or the output one if not kept. """
+    return self._exact_data.get(metrics_name, self._data.get(metrics_name))
+
+
+class RefinedData(object):
+  """ The refined metrics of a stock. """
+  def __init__(self, seasons, metrics_names, values):
+    # the season strings in descending order, the latest day first.
+    self.seasons = seasons
+    self.metrics_names = metrics_names
+    # the float64 matrix of metrics x seasons, NaN for the missing values.
+    self.values = values
+    self.__metrics = None
+
+  def GetRow(self, metrics_name):
+    """ Returns the values of the metrics in the order of seasons, or None if
+    the metrics is missing.
+    """
+    if metrics_name not in self.metrics_names:
+      return None
+    return self.values[self.metrics_names.index(metrics_name)]
+
+  @property
+  def metrics(self):
+    """ {metrics_name -> list of value in the order of seasons}, value could be None. """
+    if self.__metrics is None:
+      # NaN is the only value not equal to itself.
+      self.__metrics = dict((metrics_name, [None if v != v else v for v in row.tolist()])
+          for metrics_name, row in zip(self.metrics_names, self.values))
+    return self.__metrics
+
+
+def LoadRefinedData(store, code, metrics_names=None):
+  """ Loads the refined data of a stock from the data store. If
+  metrics_names is given, only those metrics are loaded.
+
+  The refined data is two pieces of data, written by the data fetcher:
+    refined.idx: the days, i.e. the latest day and the seasons, in
+        descending order, then the metrics names(UTF8), one per line.
+    refined.npy: the float64 matrix of metrics x days, NaN for the missing
+        values, which is memory-mapped if the store is on files.
+  """
+  return _NewRefinedData(code, store.Read(code, 'refined.idx'),
+      store.ReadArray(code, 'refined.npy'), metrics_names)
+
+
+def LoadAllRefinedData(store, codes, metrics_names=None):
+  """ Loads the refined data of the stocks at once, e.g. in one query of the
+  sqlite store. Returns {code -> RefinedData} of the stocks which have it, and
+  logs the errors of the others.
+  """
+  indexes = dict(store.ReadAll('refined.idx', codes))
+  all_values = dict(store.ReadAllArrays('refined.npy', codes))
+  all_refined_data = {}
+  for code in codes:
+    try:
+      if code not in indexes or code not in all_values:
+        raise IOError('No refined data of %s' % code)
+      all_refined_data[code] = _NewRefinedData(
+          code, indexes[code], all_values[code], metrics_names)
+    except IOError, e:
+      logging.error('Error in loading refined data of %s: %s', code, e)
+  return all_refined_data
+
+
+def _NewRefinedData(code, index_content, values, metrics_names):
+  lines = index_content.split('\n')
+  seasons = lines[0].split(',') if lines[0] else []
+  all_metrics_names = lines[1:]
+  if values.shape != (len(all_metrics_names), len(seasons)):
+    raise IOError('Mismatched refined data of %s: %s of %d metrics x %d seasons' % (
+        code, values.shape, len(all_metrics_names), len(seasons)))
+  if metrics_names is None:
+    return RefinedData(seasons, all_metrics_names, values)
+  rows = [i for i, name in enumerate(all_metrics_names) if name in metrics_names]
+  return RefinedData(seasons, [all_metrics_names[i] for i in rows], values[rows])
+
+
+def ConvertMarketValue(mv):
+  """ Returns the market value in a readable string. """
+  if not mv:
+    return None
+  if mv >= 1e8:
+    mv = '%.1f亿' % (mv / 1e8)
+  else:
+    mv = '%.1f万' % (mv / 1e4)
+  return mv
+
+
+def GetInsightSeasons():
+  """ Returns the list of seasons(datetime.date) to do insights by
+  --insight_seasons or --insight_season, the last season by default.
+  """
+  def ParseDate(value):
+    return datetime.datetime.strptime(value.strip(), '%Y-%m-%d').date()
+
+  if FLAGS.insight_seasons:
+    if ':' in FLAGS.insight_seasons:
+      (start, end) = FLAGS.insight_seasons.split(':')
+      seasons = date_util.GetSeasonEndDates(ParseDate(start), ParseDate(end))
+    else:
+      seasons = [ParseDate(s) for s in FLAGS.insight_seasons.split(',') if s.strip()]
+    assert seasons, 'No season in --insight_seasons=%s' % FLAGS.insight_seasons
+    return seasons
+  if FLAGS.insight_season:
+    return [ParseDate(FLAGS.insight_season)]
+  return [date_util.GetLastSeasonEndDate(datetime.date.today())]
+
 
 # Calculate insights for each stock
 class DataInsights(object):
   def __init__(self, directory):
     self._directory = directory
-    # parse and check the insight season.
-    self._insight_season = date_util.GetLastSeasonEndDate(datetime.date.today())
-    if FLAGS.insight_season:
-      self._insight_season = datetime.datetime.strptime(FLAGS.insight_season, '%Y-%m-%d').date()
+    self._store = data_store.OpenDataStore(directory)
+    # parse and check the insight seasons.
+    self._insight_seasons = GetInsightSeasons()
 
   # Calculate statistical insights
   def DoStats(self, stock):
-    logging.info('Insighting %s(%s) on season %s ...',
-        stock.code(), stock.name(), self._insight_season.isoformat())
-    # revenue from main business
-    datafile = os.path.join(self._directory, '%s.refined.csv' % stock.code())
-    reader = csv.DictReader(open(datafile))
-
-    # column[1] is the latest day, columns[2:] are the seasons.
-    seasons = list(reader.fieldnames)[1:]
-    seasons.sort(reverse=True)  # the latest season first
-    if self._insight_season.isoformat() not in seasons:
-      logging.warning('%s(%s) has no data on season %s.',
-          stock.code(), stock.name(), self._insight_season.isoformat())
-
-    metrics_column_name = u'指标'.encode('UTF8')
-    metrics_functions = {
+    """ Returns a list of InsightData, one for each insight season. """
+    # The refined data is loaded once for all seasons.
+    refined_data = LoadRefinedData(self._store, stock.code(), self.metrics_names())
+    return self.DoStatsOnRefinedData(stock, refined_data)
+
+  def metrics_names(self):
+    """ Returns the names of the refined metrics which the insights need. """
+    return self._GetMetricsFunctions().keys()
+
+  def _GetMetricsFunctions(self):
+    """ Returns {metrics_name -> function doing the insight of the metrics}. """
+    return {
         u'主营业务收入(万元)_growth'.encode('UTF8'): self._DoRevenueGrowthStats,
         u'PE_MV'.encode('UTF8'): self._DoPEStats,
         u'PB_MV'.encode('UTF8'): self._DoPBStats,
         u'MV'.encode('UTF8'): self._GetMarketValue,
     }
 
-    # The insight data to return
-    insight_data = InsightData()
-    insight_data.AddColumns(['Code', 'Name', 'Industry', 'IPO', 'Season'])
-    insight_data.UpdateData({
-        'Season': self._insight_season.isoformat(),
-        'Code': stock.code(),
-        'Name': stock.name(),
-        'Industry': stock.industry(),
-        'IPO': stock.ipo_date(),
-    })
-
-    metrics_insight = {}  # The insight for each metrics
-    for row in reader:
-      metrics_name = row[metrics_column_name]
-      metrics_function = metrics_functions.get(metrics_name)
-      if not metrics_function:
-        continue
-
-      logging.info('Running stats for %s(%s) on %s', stock.code(), stock.name(), metrics_name)
-      # list of (season, value), value could be None.
-      seasonal_data = [(s, float(row[s])) if re.match(r'^-?\d+(\.\d+)?$', row[s]) else (s, None)
-          for s in seasons]
-      metrics_insight[metrics_name] = metrics_function(stock, seasonal_data)
+  def DoStatsOnRefinedData(self, stock, refined_data):
+    """ Returns a list of InsightData, one for each insight season, of the
+    RefinedData of the stock.
+    """
+    logging.info('Insighting %s(%s) on %d seasons ...',
+        stock.code(), stock.name(), len(self._insight_seasons))
+    metrics_functions = self._GetMetricsFunctions()
+    seasons = refined_data.seasons
+    season_index_map = self._GetSeasonIndexMap(seasons)
+    # {metrics_name -> list of (season, value)}, value could be None.
+    all_seasonal_data = dict((metrics_name, zip(seasons, values))
+        for metrics_name, values in refined_data.metrics.iteritems())
 
     insight_order = [
         u'MV'.encode('UTF8'),
@@ -117,44 +227,62 @@ class DataInsights(object):
         u'PE_MV'.encode('UTF8'),
         u'PB_MV'.encode('UTF8'),
     ]
-    for metrics in insight_order:
-      insight = metrics_insight.get(metrics)
-      if insight:
-        insight_data.Merge(insight)
+    insights = []
+    for insight_season in self._insight_seasons:
+      season = insight_season.isoformat()
+      season_index = season_index_map.get(season, -1)
+      if season_index < 0:
+        logging.warning('%s(%s) has no data on season %s.', stock.code(), stock.name(), season)
+
+      # The insight data of the season
+      insight_data = self._NewInsightData(stock, season)
+      for metrics in insight_order:
+        if metrics not in all_seasonal_data:
+          continue
+        logging.info('Running stats for %s(%s) on %s of season %s',
+            stock.code(), stock.name(), metrics, season)
+        insight_data.Merge(metrics_functions[metrics](
+            stock, all_seasonal_data[metrics], season_index, season))
+      insights.append(insight_data)
     logging.info('Insighting %s(%s) done.', stock.code(), stock.name())
+    return insights
+
+  def _NewInsightData(self, stock, season):
+    """ Returns the InsightData with the basic info of the stock. """
+    insight_data = InsightData()
+    insight_data.AddColumns(['Code', 'Name', 'Industry', 'IPO', 'Season'])
+    insight_data.UpdateData({
+        'Season': season,
+        'Code': stock.code(),
+        'Name': stock.name(),
+        'Industry': stock.industry(),
+        'IPO': stock.ipo_date(),
+    })
     return insight_data
 
-  def _GetMarketValue(self, stock, seasonal_data):
+  def _GetMarketValue(self, stock, seasonal_data, season_index, season):
     """ seasonal_data is list of (season, value), value could be None.
+    season_index is the index of season in it, or -1 if not found.
     """
     insight = InsightData()
     insight.AddColumns(['MarketValue_latest', 'MarketValue_at_season'])
 
-    season_index = self._GetInsightSeasonIndex(seasonal_data)
     if season_index < 0 or seasonal_data[season_index][1] is None:
       logging.info('No market value found for %s(%s) on %s',
-          stock.code(), stock.name(), self._insight_season.isoformat())
+          stock.code(), stock.name(), season)
       return insight
 
-    def ConvertMV(mv):
-      if not mv:
-        return None
-      if mv >= 1e8:
-        mv = '%.1f亿' % (mv / 1e8)
-      else:
-        mv = '%.1f万' % (mv / 1e4)
-      return mv
-
-    season_mv = ConvertMV(seasonal_data[season_index][1])
-    latest_mv = ConvertMV(seasonal_data[0][1])
+    season_mv = ConvertMarketValue(seasonal_data[season_index][1])
+    latest_mv = ConvertMarketValue(seasonal_data[0][1])
     insight.UpdateData({
       'MarketValue_latest': latest_mv,
       'MarketValue_at_season': season_mv,
     })
     return insight
 
-  def _DoRevenueGrowthStats(self, stock, seasonal_data):
-    """ seasonal_data is list of (season, value)
+  def _DoRevenueGrowthStats(self, stock, seasonal_data, season_index, season):
+    """ seasonal_data is list of (season, value), and season_index is the
+    index of season in it, or -1 if not found.
     """
     insight = InsightData()
     insight.AddColumns(['revenue_growth_at_season'])
@@ -167,20 +295,20 @@ class DataInsights(object):
         '%dseasons_revenue_growth_quantile' % num,
       ])
 
-    season_index = self._GetInsightSeasonIndex(seasonal_data)
     if season_index < 0 or seasonal_data[season_index][1] is None:
       logging.info('No revenue growth found for %s(%s) on %s',
-          stock.code(), stock.name(), self._insight_season.isoformat())
+          stock.code(), stock.name(), season)
       return insight
 
     data_at_season = seasonal_data[season_index][1]
     insight.UpdateData({'revenue_growth_at_season': round(data_at_season, 2)})
+    insight.UpdateExactData({'revenue_growth_at_season': data_at_season})
 
     for num in periods_configs:
       previous_seasons = [v[1] for v in seasonal_data[season_index + 1 : season_index + 1 + num] if v[1]]
       if len(previous_seasons) < num:
         logging.info('%s(%s) has no enough data for %d seasons revenue growth CI before %s',
-            stock.code(), stock.name(), num, self._insight_season.isoformat())
+            stock.code(), stock.name(), num, season)
       else:
         # CI by the previous seasons data
         (mean, lower, upper, quantile) = self._PastAverageAndPercentInPast(
@@ -194,8 +322,9 @@ class DataInsights(object):
 
     return insight
 
-  def _DoPEStats(self, stock, seasonal_data):
-    """ seasonal_data is list of (season, value)
+  def _DoPEStats(self, stock, seasonal_data, season_index, season):
+    """ seasonal_data is list of (season, value), and season_index is the
+    index of season in it, or -1 if not found.
     """
     insight = InsightData()
     insight.AddColumns(['PE_latest', 'PE_at_season'])
@@ -208,24 +337,24 @@ class DataInsights(object):
         '%dseasons_PE_quantile' % num,
       ])
 
-    season_index = self._GetInsightSeasonIndex(seasonal_data)
     if season_index < 0 or seasonal_data[season_index][1] is None:
       logging.info('No PE found for %s(%s) on %s',
-          stock.code(), stock.name(), self._insight_season.isoformat())
+          stock.code(), stock.name(), season)
       return insight
 
     pe_at_season = seasonal_data[season_index][1]
     pe_latest = seasonal_data[0][1]
     insight.UpdateData({
-      'PE_latest': round(pe_latest, 1),
+      'PE_latest': round(pe_latest, 1) if pe_latest is not None else None,
       'PE_at_season': round(pe_at_season, 1),
     })
+    insight.UpdateExactData({'PE_at_season': pe_at_season})
 
     for num in periods_configs:
       previous_seasons = [v[1] for v in seasonal_data[season_index + 1 : season_index + 1 + num] if v[1]]
       if len(previous_seasons) < num:
         logging.info('%s(%s) has no enough data for %d seasons PE CI before %s',
-            stock.code(), stock.name(), num, self._insight_season.isoformat())
+            stock.code(), stock.name(), num, season)
       else:
         # CI by previous seasons data
         (mean, lower, upper, quantile) = self._PastAverageAndPercentInPast(
@@ -239,8 +368,9 @@ class DataInsights(object):
 
     return insight
 
-  def _DoPBStats(self, stock, seasonal_data):
-    """ seasonal_data is list of (season, value)
+  def _DoPBStats(self, stock, seasonal_data, season_index, season):
+    """ seasonal_data is list of (season, value), and season_index is the
+    index of season in it, or -1 if not found.
     """
     insight = InsightData()
     insight.AddColumns(['PB_latest', 'PB_at_season'])
@@ -253,24 +383,24 @@ class DataInsights(object):
         '%dseasons_PB_quantile' % num,
       ])
 
-    season_index = self._GetInsightSeasonIndex(seasonal_data)
     if season_index < 0 or seasonal_data[season_index][1] is None:
       logging.info('No PB found for %s(%s) on %s',
-          stock.code(), stock.name(), self._insight_season.isoformat())
+          stock.code(), stock.name(), season)
       return insight
 
     pb_at_season = seasonal_data[season_index][1]
     pb_latest = seasonal_data[0][1]
     insight.UpdateData({
-      'PB_latest': round(pb_latest, 1),
+      'PB_latest': round(pb_latest, 1) if pb_latest is not None else None,
       'PB_at_season': round(pb_at_season, 1),
     })
+    insight.UpdateExactData({'PB_at_season': pb_at_season})
 
     for num in periods_configs:
       previous_seasons = [v[1] for v in seasonal_data[season_index + 1 : season_index + 1 + num] if v[1]]
       if len(previous_seasons) < num:
         logging.info('%s(%s) has no enough data for %d seasons PB CI before %s',
-            stock.code(), stock.name(), num, self._insight_season.isoformat())
+            stock.code(), stock.name(), num, season)
       else:
         # CI by previous seasons data
         (mean, lower, upper, quantile) = self._PastAverageAndPercentInPast(
@@ -310,23 +440,9 @@ class DataInsights(object):
     quantile = stats.t.cdf(point, size - 1) * 100.0
     return (mean, lower, upper, quantile)
 
-  def _GetInsightSeasonIndex(self, seasons):
-    if len(seasons) == 0:
-      return -1
-    # Season string format YYYY-MM-DD.
-    insight_season = self._insight_season.isoformat()
-    # assume seasons are in descending order.
-    start = 0
-    end = len(seasons) - 1
-    while start != end:
-      mid = (start + end) / 2
-      if insight_season < seasons[mid][0]:
-        start = mid + 1
-      else:
-        end = mid
-    if insight_season == seasons[start][0]:
-      return start
-    return -1
+  def _GetSeasonIndexMap(self, seasons):
+    """ Returns {season -> index} of the season strings, YYYY-MM-DD. """
+    return dict((season, i) for i, season in enumerate(seasons))
 
 
 def main():
@@ -337,12 +453,13 @@ def main():
   directory = './data/test'
   stock = Stock('000977', '浪潮信息', '医药', '2001-01-01')
   insighter = DataInsights(directory)
-  insight = insighter.DoStats(stock)
+  insights = insighter.DoStats(stock)
 
-  header = insight.columns()
+  header = insights[0].columns()
   writer = csv.DictWriter(sys.stdout, fieldnames=header)
   writer.writeheader()
-  writer.writerow(insight.data())
+  for insight in insights:
+    writer.writerow(insight.data())
 
 if __name__ == "__main__":
   main()
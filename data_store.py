@@ -0,0 +1,281 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Where the raw and refined data of the stocks are stored.
+
+Each piece of data is keyed by the stock code and a name, e.g. 'balance.csv'
+or 'refined.npy'. The files store keeps each one in <directory>/<code>.<name>,
+while the sqlite store keeps all of them in one database file.
+"""
+
+import argparse
+import datetime
+import gzip
+import logging
+import numpy
+import os
+import Queue
+import sqlite3
+import StringIO
+import threading
+import time
+
+import flags
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--data_store', default='files', choices=['files', 'sqlite'],
+    help='Store the data of each stock in separate files, or in one sqlite database.')
+
+_GZIP_MAGIC = '\x1f\x8b'
+
+
+def Compress(content):
+  """ Returns the gzipped content. The same content is always compressed to
+  the same bytes, i.e. no timestamp in the gzip header, so that the content
+  hashes still tell whether the data changes.
+  """
+  buf = StringIO.StringIO()
+  with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as f:
+    f.write(content)
+  return buf.getvalue()
+
+
+def Decompress(content):
+  """ Returns the content unzipped if it is gzipped, otherwise as is. """
+  if not content.startswith(_GZIP_MAGIC):
+    return content
+  with gzip.GzipFile(mode='rb', fileobj=StringIO.StringIO(content)) as f:
+    return f.read()
+
+
+class DataStore(object):
+  """ The interface of the data stores. """
+  def Exists(self, code, name):
+    """ Returns whether the data exists. """
+    assert False, 'Must override Exists.'
+
+  def Read(self, code, name):
+    """ Returns the content(str), or raises IOError if not exists. """
+    assert False, 'Must override Read.'
+
+  def Write(self, code, name, content):
+    """ Writes the content(str). It is visible to Read once returns. """
+    assert False, 'Must override Write.'
+
+  def GetVersion(self, code, name):
+    """ Returns a string which changes whenever the data changes, or None if
+    the data does not exist. It also changes when the same content is written
+    again, so only the content hashes, e.g. of refined.deps, can tell that the
+    content does not change.
+    """
+    assert False, 'Must override GetVersion.'
+
+  def ReadAll(self, name, codes):
+    """ Yields (code, content) of the data with that name of the stocks in
+    codes which have it.
+    """
+    for code in codes:
+      if self.Exists(code, name):
+        yield (code, self.Read(code, name))
+
+  def ReadArray(self, code, name):
+    """ Returns the numpy array saved by WriteArray. """
+    return numpy.load(StringIO.StringIO(self.Read(code, name)))
+
+  def ReadAllArrays(self, name, codes):
+    """ Yields (code, numpy array) as ReadAll. """
+    for (code, content) in self.ReadAll(name, codes):
+      yield (code, numpy.load(StringIO.StringIO(content)))
+
+  def WriteArray(self, code, name, array):
+    buf = StringIO.StringIO()
+    numpy.save(buf, array)
+    self.Write(code, name, buf.getvalue())
+
+
+class FileDataStore(DataStore):
+  """ Stores each piece of data in <directory>/<code>.<name>. """
+  def __init__(self, directory):
+    self.__directory = directory
+
+  def GetPath(self, code, name):
+    return os.path.join(self.__directory, '%s.%s' % (code, name))
+
+  def Exists(self, code, name):
+    return os.path.exists(self.GetPath(code, name))
+
+  def Read(self, code, name):
+    with open(self.GetPath(code, name)) as f:
+      return f.read()
+
+  def Write(self, code, name, content):
+    # write to a temp file first, so that readers never see a partial file.
+    path = self.GetPath(code, name)
+    with open(path + '.tmp', 'w') as f:
+      f.write(content)
+    os.rename(path + '.tmp', path)
+
+  def GetVersion(self, code, name):
+    try:
+      stat = os.stat(self.GetPath(code, name))
+    except OSError:
+      return None
+    return '%r %d' % (stat.st_mtime, stat.st_size)
+
+  def ReadArray(self, code, name):
+    # memory-map instead of reading it.
+    return numpy.load(self.GetPath(code, name), mmap_mode='r')
+
+  def ReadAllArrays(self, name, codes):
+    for code in codes:
+      if self.Exists(code, name):
+        yield (code, self.ReadArray(code, name))
+
+  def WriteArray(self, code, name, array):
+    path = self.GetPath(code, name)
+    with open(path + '.tmp', 'wb') as f:
+      numpy.save(f, array)
+    os.rename(path + '.tmp', path)
+
+
+class SqliteDataStore(DataStore):
+  """ Stores all data in one sqlite database in WAL mode, keyed by
+  (code, name, fetch date). Only the latest fetch of a piece of data is kept.
+
+  The writes of all threads are queued to a writer thread, which commits them
+  in batches. A write blocks till its batch is committed, so the threads
+  writing at the same time share one transaction.
+  """
+  _MAX_BATCH_SIZE = 500
+
+  def __init__(self, db_file):
+    self.__db_file = db_file
+    self.__pid = None
+    self.__Setup()
+    connection = self.__Connect()
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS pages ('
+        '  code TEXT NOT NULL,'
+        '  name TEXT NOT NULL,'
+        '  fetch_date TEXT NOT NULL,'
+        '  updated REAL NOT NULL,'
+        '  content BLOB NOT NULL,'
+        '  PRIMARY KEY (code, name, fetch_date))')
+    connection.commit()
+
+  def __reduce__(self):
+    # the copy in another process shares the store of that process.
+    return (_OpenSqliteDataStore, (self.__db_file,))
+
+  def __Setup(self):
+    """ (Re)creates the per process states, e.g. after fork. """
+    self.__pid = os.getpid()
+    self.__local = threading.local()  # a connection per thread
+    self.__write_queue = Queue.Queue()
+    self.__writer = None
+    self.__writer_lock = threading.Lock()
+
+  def __Connect(self):
+    if self.__pid != os.getpid():
+      self.__Setup()
+    connection = getattr(self.__local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.__db_file, timeout=60)
+      connection.text_factory = str
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      self.__local.connection = connection
+    return connection
+
+  def __GetLatest(self, code, name, columns):
+    return self.__Connect().execute(
+        'SELECT %s FROM pages WHERE code = ? AND name = ? '
+        'ORDER BY fetch_date DESC LIMIT 1' % columns, (code, name)).fetchone()
+
+  def Exists(self, code, name):
+    return self.__GetLatest(code, name, 'updated') is not None
+
+  def Read(self, code, name):
+    row = self.__GetLatest(code, name, 'content')
+    if row is None:
+      raise IOError('No %s of %s in %s' % (name, code, self.__db_file))
+    return str(row[0])
+
+  def GetVersion(self, code, name):
+    # the update time changes on every write, even of the same content.
+    row = self.__GetLatest(code, name, 'fetch_date, updated')
+    return '%s %r' % row if row else None
+
+  def ReadAll(self, name, codes):
+    """ Reads the data of all stocks in one query. """
+    codes = set(codes)
+    cursor = self.__Connect().execute(
+        'SELECT code, content FROM pages WHERE name = ? ORDER BY code, fetch_date', (name,))
+    last_code, last_content = None, None
+    for code, content in cursor:
+      if last_code is not None and code != last_code and last_code in codes:
+        yield (last_code, str(last_content))
+      last_code, last_content = code, content
+    if last_code is not None and last_code in codes:
+      yield (last_code, str(last_content))
+
+  def Write(self, code, name, content):
+    if self.__pid != os.getpid():
+      self.__Setup()
+    with self.__writer_lock:
+      if self.__writer is None:
+        self.__writer = threading.Thread(target=self.__RunWriter, name='SqliteWriter')
+        self.__writer.daemon = True
+        self.__writer.start()
+    done = threading.Event()
+    result = []  # the error if any
+    self.__write_queue.put((code, name, sqlite3.Binary(content), done, result))
+    done.wait()
+    if result:
+      raise IOError('Failed to write %s of %s: %s' % (name, code, result[0]))
+
+  def __RunWriter(self):
+    connection = self.__Connect()
+    while True:
+      batch = [self.__write_queue.get(block=True)]
+      while len(batch) < self._MAX_BATCH_SIZE:
+        try:
+          batch.append(self.__write_queue.get_nowait())
+        except Queue.Empty:
+          break
+
+      fetch_date = datetime.date.today().isoformat()
+      try:
+        with connection:  # one transaction
+          for (code, name, content, done, result) in batch:
+            connection.execute(
+                'DELETE FROM pages WHERE code = ? AND name = ? AND fetch_date < ?',
+                (code, name, fetch_date))
+            connection.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                (code, name, fetch_date, time.time(), content))
+      except sqlite3.Error, e:
+        logging.error('Failed to write %d items to %s: %s', len(batch), self.__db_file, e)
+        for item in batch:
+          item[4].append(e)
+      for item in batch:
+        item[3].set()
+
+
+__sqlite_stores = {}
+__sqlite_stores_lock = threading.Lock()
+
+def _OpenSqliteDataStore(db_file):
+  """ Returns the SqliteDataStore of the db file shared in this process. """
+  with __sqlite_stores_lock:
+    store = __sqlite_stores.get(db_file)
+    if store is None:
+      store = __sqlite_stores[db_file] = SqliteDataStore(db_file)
+    return store
+
+
+def OpenDataStore(directory):
+  """ Returns the data store of --data_store in that directory. """
+  if FLAGS.data_store == 'sqlite':
+    return _OpenSqliteDataStore(os.path.join(directory, 'data.sqlite'))
+  return FileDataStore(directory)
@@ -65,3 +65,27 @@ def GetLatestNSeasonsStart(day, last_n):
     year = start_year - (start_index + i) / 4
     result.append(datetime.date(year, month, 1))
   return result
+
+
+def GetSeasonEndDates(start_day, end_day):
+  """ Returns a list of the season end dates in [start_day, end_day],
+  ascending. E.g. for 2017-02-01 ~ 2017-10-01, it returns
+  2017-03-31, 2017-06-30, 2017-09-30.
+
+  Args:
+    start_day: datetime.date
+    end_day: datetime.date
+  """
+  result = []
+  # the season of start_day ends before the next season starts.
+  season_start = GetSeasonStartDate(start_day)
+  while True:
+    next_month = season_start.month + 3
+    next_start = datetime.date(season_start.year + (next_month > 12), (next_month - 1) % 12 + 1, 1)
+    season_end = GetLastDay(next_start)
+    if season_end > end_day:
+      break
+    if season_end >= start_day:
+      result.append(season_end)
+    season_start = next_start
+  return result
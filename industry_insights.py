@@ -0,0 +1,172 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" The cross-sectional insights within the industries: for every industry
+and season, the median and percentiles of PE, PB and revenue growth over its
+stocks, and the rank of each stock among its peers.
+
+The insights of all stocks are put into columns, and each metrics is grouped
+by (industry, season) in one sort, so there is no loop over the industries or
+the stocks.
+"""
+
+import argparse
+import csv
+import logging
+import numpy
+import os
+from scipy import stats
+import sys
+
+import flags
+import data_insights
+import stock_info
+
+Stock = stock_info.Stock
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--industry_output', default=None,
+    help='The output of the industry medians and percentiles. No industry insights if not set.')
+flags.ArgParser().add_argument('--industry_rank_output', default=None,
+    help='The output of the rank of each stock within its industry.')
+
+# (insight column, stats name)
+INDUSTRY_METRICS = [
+    ('PE_at_season', 'PE'),
+    ('PB_at_season', 'PB'),
+    ('revenue_growth_at_season', 'revenue_growth'),
+]
+
+PERCENTILES = [10, 25, 50, 75, 90]
+
+SUMMARY_COLUMNS = ['Industry', 'Season', 'Metrics', 'count'] + ['p%d' % p for p in PERCENTILES]
+RANK_COLUMNS = ['Code', 'Name', 'Industry', 'Season', 'Metrics', 'value', 'rank', 'peers', 'percentile']
+
+
+def _ToFloat(value):
+  return numpy.nan if value is None or value == '' else float(value)
+
+
+def GroupPercentiles(sorted_values, starts, counts, percent):
+  """ Returns the percentile of each group, interpolated as numpy.percentile.
+  The values of group i are sorted_values[starts[i] : starts[i] + counts[i]],
+  and the groups without values get NaN.
+  """
+  result = numpy.empty(len(starts))
+  result.fill(numpy.nan)
+  has_values = counts > 0
+  position = starts[has_values] + (counts[has_values] - 1) * (percent / 100.0)
+  lower = numpy.floor(position).astype(int)
+  upper = numpy.ceil(position).astype(int)
+  result[has_values] = (sorted_values[lower]
+      + (sorted_values[upper] - sorted_values[lower]) * (position - lower))
+  return result
+
+
+class IndustryTable(object):
+  """ The insights of all stocks in columns, grouped by (industry, season). """
+  def __init__(self, insights):
+    """ insights is a list of InsightData. The stats and the ranks are of the
+    values before rounding, and the rank rows show the rounded ones.
+    """
+    data = [insight.data() for insight in insights]
+    self.__codes = [d.get('Code') for d in data]
+    self.__names = [d.get('Name') for d in data]
+    keys = numpy.array(['%s\t%s' % (d.get('Industry') or '', d.get('Season')) for d in data])
+    # the groups are numbered in the order of (industry, season).
+    (self.__group_keys, self.__groups) = numpy.unique(keys, return_inverse=True) \
+        if len(keys) else (numpy.array([]), numpy.array([], dtype=int))
+    self.__values = dict((column, numpy.array([_ToFloat(insight.GetExactValue(column))
+        for insight in insights], dtype=numpy.float64)) for column, name in INDUSTRY_METRICS)
+    self.__rounded_values = dict((column, [d.get(column) for d in data])
+        for column, name in INDUSTRY_METRICS)
+
+  def Aggregate(self):
+    """ Returns (summary rows, rank rows) of all metrics, as maps of
+    SUMMARY_COLUMNS and RANK_COLUMNS. The rank 1 is the lowest value, and the
+    equal values share their average rank.
+    """
+    num_groups = len(self.__group_keys)
+    summary_rows = []
+    rank_rows = []
+    for column, name in INDUSTRY_METRICS:
+      values = self.__values[column]
+      rows = numpy.nonzero(~numpy.isnan(values))[0]
+      # sort by group, then by value in each group.
+      rows = rows[numpy.lexsort((values[rows], self.__groups[rows]))]
+      sorted_values = values[rows]
+      sorted_groups = self.__groups[rows]
+      counts = numpy.bincount(sorted_groups, minlength=num_groups)
+      starts = numpy.cumsum(counts) - counts
+
+      percentiles = [GroupPercentiles(sorted_values, starts, counts, p) for p in PERCENTILES]
+      for group in numpy.nonzero(counts)[0]:
+        (industry, season) = self.__group_keys[group].split('\t')
+        row = {'Industry': industry, 'Season': season, 'Metrics': name, 'count': counts[group]}
+        for p, percentile in zip(PERCENTILES, percentiles):
+          row['p%d' % p] = round(percentile[group], 2)
+        summary_rows.append(row)
+
+      # the runs of equal values in each group, ranked in the sorted order.
+      new_runs = numpy.ones(len(rows), dtype=bool)
+      new_runs[1:] = ((sorted_values[1:] != sorted_values[:-1])
+          | (sorted_groups[1:] != sorted_groups[:-1]))
+      ranks = (stats.rankdata(numpy.cumsum(new_runs), method='average')
+          - starts[sorted_groups])
+      peers = counts[sorted_groups]
+      percents = 100.0 * ranks / peers
+      for i, row in enumerate(rows):
+        (industry, season) = self.__group_keys[sorted_groups[i]].split('\t')
+        rank_rows.append({
+          'Code': self.__codes[row],
+          'Name': self.__names[row],
+          'Industry': industry,
+          'Season': season,
+          'Metrics': name,
+          'value': self.__rounded_values[column][row],
+          'rank': ranks[i] if ranks[i] % 1 else int(ranks[i]),
+          'peers': peers[i],
+          'percentile': round(percents[i], 1),
+        })
+    return (summary_rows, rank_rows)
+
+
+def _WriteRows(outfile, columns, rows):
+  writer = csv.DictWriter(outfile, fieldnames=columns)
+  writer.writeheader()
+  writer.writerows(rows)
+
+
+def WriteIndustryInsights(directory, insights):
+  """ Aggregates the insights, a list of InsightData, by industry
+  and writes --industry_output and --industry_rank_output in the directory.
+  """
+  (summary_rows, rank_rows) = IndustryTable(insights).Aggregate()
+  if FLAGS.industry_output:
+    with open(os.path.join(directory, FLAGS.industry_output), 'w') as outfile:
+      _WriteRows(outfile, SUMMARY_COLUMNS, summary_rows)
+  if FLAGS.industry_rank_output:
+    with open(os.path.join(directory, FLAGS.industry_rank_output), 'w') as outfile:
+      _WriteRows(outfile, RANK_COLUMNS, rank_rows)
+  logging.info('%d industry stats and %d ranks written', len(summary_rows), len(rank_rows))
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+  logging.basicConfig(level=logging.INFO)
+  directory = './data/test'
+  stocks = [
+      Stock('000977', '浪潮信息', '医药', '2001-01-01'),
+      Stock('300652', 'N雷迪克', '制造业', '2017-05-16'),
+  ]
+  insighter = data_insights.DataInsights(directory)
+  insights = []
+  for stock in stocks:
+    insights += insighter.DoStats(stock)
+  (summary_rows, rank_rows) = IndustryTable(insights).Aggregate()
+  _WriteRows(sys.stdout, SUMMARY_COLUMNS, summary_rows)
+  _WriteRows(sys.stdout, RANK_COLUMNS, rank_rows)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Parses a Netease statement page once, and caches the result in a binary
+sidecar next to the csv in the data store, which later loads memory-map
+directly if the store is on files.
+
+For <page>.csv the sidecar is two pieces of data:
+  <page>.parsed.npy: the float64 matrix of metrics x seasons, NaN for the
+      missing values.
+  <page>.parsed.idx: the version of the csv it was parsed from, the seasons
+      and the metrics names(UTF8), one per line.
+The sidecar is rebuilt once the csv changes.
+"""
+
+import argparse
+import csv
+import logging
+import math
+import numpy
+import re
+import StringIO
+
+import data_store
+import flags
+
+
+class ParsedPage(object):
+  """ The values of a statement page in a matrix of metrics x seasons. """
+  def __init__(self, metrics_names, seasons, values):
+    self.metrics_names = metrics_names  # in UTF8
+    self.seasons = seasons  # the season strings, YYYY-MM-DD
+    self.values = values    # numpy float64 matrix, NaN for missing values
+    # the later row wins if a metrics appears twice.
+    self.__metrics_index = dict((name, i) for i, name in enumerate(metrics_names))
+    self.__season_index = dict((season, i) for i, season in enumerate(seasons))
+
+  def GetSeries(self, metrics_name, seasons):
+    """ Returns a list of the metrics value, or None, on each of the seasons. """
+    row = self.__metrics_index.get(metrics_name)
+    if row is None:
+      return [None] * len(seasons)
+    values = self.values[row]
+    series = []
+    for season in seasons:
+      column = self.__season_index.get(season)
+      value = values[column] if column is not None else None
+      series.append(None if value is None or math.isnan(value) else float(value))
+    return series
+
+
+def ParseCsv(content):
+  """ Parses the content of a statement page csv(GBK) into a ParsedPage. """
+  reader = csv.reader(StringIO.StringIO(content))
+  header = next(reader, [])
+  # The first column is metrics name, and the others are seasons.
+  seasons = header[1:]
+  metrics_names = []
+  rows = []
+  number_pattern = re.compile(r'^-?\d+(\.\d+)?$')
+  for row in reader:
+    if not row:
+      continue
+    metrics_names.append(row[0].decode('GBK').encode('UTF8'))
+    values = [float(v) if number_pattern.match(v) else numpy.nan for v in row[1:len(seasons) + 1]]
+    values += [numpy.nan] * (len(seasons) - len(values))
+    rows.append(values)
+  values = numpy.array(rows, dtype=numpy.float64).reshape((len(rows), len(seasons)))
+  return ParsedPage(metrics_names, seasons, values)
+
+
+def _GetSidecarNames(name):
+  """ Returns the names of (index, matrix) of the sidecar of a csv. """
+  base = name[:-len('.csv')]
+  return (base + '.parsed.idx', base + '.parsed.npy')
+
+
+def _LoadSidecar(store, code, name, version):
+  """ Returns the cached ParsedPage, or None if it is missing or stale. """
+  (index_name, matrix_name) = _GetSidecarNames(name)
+  if not store.Exists(code, index_name) or not store.Exists(code, matrix_name):
+    return None
+  lines = store.Read(code, index_name).split('\n')
+  if lines[0] != version:
+    return None
+  seasons = lines[1].split(',') if lines[1] else []
+  metrics_names = lines[2:]
+  values = store.ReadArray(code, matrix_name)
+  if values.shape != (len(metrics_names), len(seasons)):
+    return None
+  return ParsedPage(metrics_names, seasons, values)
+
+
+def _SaveSidecar(store, code, name, page, version):
+  (index_name, matrix_name) = _GetSidecarNames(name)
+  # The index is written last, since it tells whether the matrix is valid.
+  store.WriteArray(code, matrix_name, page.values)
+  store.Write(code, index_name, '\n'.join([version, ','.join(page.seasons)] + page.metrics_names))
+
+
+def LoadPage(store, code, name):
+  """ Returns the ParsedPage of a statement page csv in the data store, from
+  its sidecar if it is up to date, otherwise parses the csv and saves the
+  sidecar.
+  """
+  version = store.GetVersion(code, name)
+  page = _LoadSidecar(store, code, name, version)
+  if page is not None:
+    return page
+  page = ParseCsv(data_store.Decompress(store.Read(code, name)))
+  try:
+    _SaveSidecar(store, code, name, page, version)
+  except (IOError, OSError), e:
+    logging.warning('Failed to cache the parsed %s of %s: %s', name, code, e)
+  return page
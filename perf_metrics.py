@@ -0,0 +1,274 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" The performance metrics of all stages, e.g. the page fetch latency, the
+refine and insight time of each stock.
+
+The metrics are counters and histograms, labeled by e.g. the page name, and
+can be updated by any thread. They are exported as a JSON summary with the
+percentiles and the throughput, or as the Prometheus text format.
+"""
+
+import argparse
+import BaseHTTPServer
+import bisect
+import json
+import logging
+import SocketServer
+import threading
+import time
+
+import flags
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--metrics_output', default=None,
+    help='The output of the JSON summary of the performance metrics.')
+flags.ArgParser().add_argument('--metrics_port', type=int, default=0,
+    help='Serve the metrics in Prometheus text format on this local port. 0 for no serving.')
+flags.ArgParser().add_argument('--progress_interval', type=float, default=30,
+    help='Seconds between the progress logs. 0 for no progress logs.')
+
+# The upper bounds of the histogram buckets.
+SECONDS_BUCKETS = [0.001 * (2 ** i) for i in range(18)]  # 1ms ~ 131s
+BYTES_BUCKETS = [256 * (2 ** i) for i in range(16)]  # 256B ~ 8MB
+
+
+class _Metric(object):
+  """ A metric whose values are keyed by the label values. """
+  def __init__(self, name, help, label_names):
+    self.name = name
+    self.help = help
+    self.label_names = tuple(label_names)
+    self._lock = threading.Lock()
+    self._values = {}  # {label values -> value}
+    self._start_ts = time.time()
+
+  def _GetLabels(self, label_values):
+    assert len(label_values) == len(self.label_names), (self.name, label_values)
+    return tuple(str(v) for v in label_values)
+
+  def _FormatLabels(self, label_values, extra=()):
+    pairs = zip(self.label_names, label_values) + list(extra)
+    if not pairs:
+      return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v.replace('"', '\\"')) for k, v in pairs)
+
+
+class Counter(_Metric):
+  def Inc(self, label_values=(), amount=1):
+    labels = self._GetLabels(label_values)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def GetValue(self, label_values=()):
+    with self._lock:
+      return self._values.get(self._GetLabels(label_values), 0)
+
+  def ToJson(self):
+    elapsed = max(time.time() - self._start_ts, 1e-6)
+    with self._lock:
+      return [dict(zip(self.label_names, labels), value=value, rate=value / elapsed)
+          for labels, value in sorted(self._values.iteritems())]
+
+  def ToPrometheus(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+    with self._lock:
+      for labels, value in sorted(self._values.iteritems()):
+        lines.append('%s%s %s' % (self.name, self._FormatLabels(labels), value))
+    return lines
+
+
+class Histogram(_Metric):
+  """ Counts the observed values in buckets, and estimates the percentiles
+  by the buckets.
+  """
+  def __init__(self, name, help, label_names, buckets):
+    _Metric.__init__(self, name, help, label_names)
+    self.__buckets = sorted(buckets)
+
+  def Observe(self, value, label_values=()):
+    labels = self._GetLabels(label_values)
+    with self._lock:
+      data = self._values.get(labels)
+      if data is None:
+        # [count of each bucket and +Inf, count, sum, max]
+        data = self._values[labels] = [[0] * (len(self.__buckets) + 1), 0, 0.0, value]
+      data[0][bisect.bisect_left(self.__buckets, value)] += 1
+      data[1] += 1
+      data[2] += value
+      data[3] = max(data[3], value)
+
+  def __GetPercentile(self, bucket_counts, count, max_value, percent):
+    """ Returns the estimated percentile, interpolated in its bucket. """
+    rank = count * percent / 100.0
+    accumulated = 0
+    for i, bucket_count in enumerate(bucket_counts):
+      if bucket_count and accumulated + bucket_count >= rank:
+        lower = self.__buckets[i - 1] if i > 0 else 0.0
+        upper = self.__buckets[i] if i < len(self.__buckets) else max_value
+        value = lower + (upper - lower) * (rank - accumulated) / bucket_count
+        return min(value, max_value)
+      accumulated += bucket_count
+    return max_value
+
+  def ToJson(self):
+    elapsed = max(time.time() - self._start_ts, 1e-6)
+    result = []
+    with self._lock:
+      for labels, (bucket_counts, count, total, max_value) in sorted(self._values.iteritems()):
+        item = dict(zip(self.label_names, labels))
+        item.update({
+          'count': count,
+          'sum': total,
+          'mean': total / count,
+          'max': max_value,
+          'rate': count / elapsed,
+        })
+        for percent in [50, 90, 99]:
+          item['p%d' % percent] = self.__GetPercentile(bucket_counts, count, max_value, percent)
+        result.append(item)
+    return result
+
+  def ToPrometheus(self):
+    lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+    with self._lock:
+      for labels, (bucket_counts, count, total, max_value) in sorted(self._values.iteritems()):
+        accumulated = 0
+        for bound, bucket_count in zip(self.__buckets + ['+Inf'], bucket_counts):
+          accumulated += bucket_count
+          lines.append('%s_bucket%s %d' % (self.name,
+              self._FormatLabels(labels, [('le', str(bound))]), accumulated))
+        lines.append('%s_sum%s %r' % (self.name, self._FormatLabels(labels), total))
+        lines.append('%s_count%s %d' % (self.name, self._FormatLabels(labels), count))
+    return lines
+
+
+class Registry(object):
+  """ All metrics of this process, each created at the first use. """
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__metrics = {}  # {name -> metric}
+
+  def GetCounter(self, name, help, label_names=()):
+    return self.__GetMetric(name, lambda: Counter(name, help, label_names))
+
+  def GetHistogram(self, name, help, label_names=(), buckets=SECONDS_BUCKETS):
+    return self.__GetMetric(name, lambda: Histogram(name, help, label_names, buckets))
+
+  def __GetMetric(self, name, create):
+    with self.__lock:
+      metric = self.__metrics.get(name)
+      if metric is None:
+        metric = self.__metrics[name] = create()
+      return metric
+
+  def ToJson(self):
+    with self.__lock:
+      metrics = sorted(self.__metrics.items())
+    return dict((name, {'help': metric.help, 'values': metric.ToJson()})
+        for name, metric in metrics)
+
+  def ToPrometheus(self):
+    with self.__lock:
+      metrics = sorted(self.__metrics.items())
+    lines = []
+    for name, metric in metrics:
+      lines += metric.ToPrometheus()
+    return '\n'.join(lines) + '\n'
+
+  def WriteJson(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.ToJson(), f, indent=2, sort_keys=True)
+
+
+__registry = Registry()
+
+def GetRegistry():
+  """ Returns the registry shared in this process. """
+  return __registry
+
+
+class Timer(object):
+  """ Observes the seconds of a with block into a histogram. """
+  def __init__(self, histogram, label_values=()):
+    self.__histogram = histogram
+    self.__label_values = label_values
+
+  def __enter__(self):
+    self.__start_ts = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.__histogram.Observe(time.time() - self.__start_ts, self.__label_values)
+    return False
+
+
+class ProgressReporter(object):
+  """ Logs the progress, the recent throughput and the ETA every interval
+  seconds, by get_progress() which returns the number of processed items.
+  """
+  def __init__(self, name, total, get_progress, interval):
+    self.__name = name
+    self.__total = total
+    self.__get_progress = get_progress
+    self.__interval = interval
+    self.__stopped = threading.Event()
+    self.__thread = None
+
+  def Start(self):
+    if self.__interval <= 0:
+      return
+    self.__thread = threading.Thread(target=self.__Run, name='ProgressReporter')
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  def Stop(self):
+    self.__stopped.set()
+    if self.__thread:
+      self.__thread.join()
+
+  def __Run(self):
+    start_ts = last_ts = time.time()
+    last_done = 0
+    while not self.__stopped.wait(self.__interval):
+      now = time.time()
+      done = self.__get_progress()
+      recent_rate = (done - last_done) / max(now - last_ts, 1e-6)
+      overall_rate = done / max(now - start_ts, 1e-6)
+      # the ETA by the overall rate, which is steadier than the recent one.
+      eta = (self.__total - done) / overall_rate if overall_rate > 0 else None
+      logging.info('%s progress: %d of %d, %.2f/s recently, %.2f/s overall, ETA %s',
+          self.__name, done, self.__total, recent_rate, overall_rate,
+          time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else 'unknown')
+      (last_ts, last_done) = (now, done)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_error(404)
+      return
+    body = GetRegistry().ToPrometheus()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug('%s', format % args)
+
+
+class _MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+def StartMetricsServer(port):
+  """ Serves /metrics on the local port in a background thread. """
+  server = _MetricsServer(('127.0.0.1', port), _MetricsHandler)
+  thread = threading.Thread(target=server.serve_forever, name='MetricsServer')
+  thread.daemon = True
+  thread.start()
+  logging.info('Serving metrics on http://127.0.0.1:%d/metrics', port)
+  return server
@@ -0,0 +1,247 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Controls how fast and how many requests we send to the data source.
+
+The concurrency is adapted in the AIMD way: it grows by one every round of
+healthy requests, and halves when the source throttles us, i.e. timeouts,
+connection resets or refusals, http 429 or 5xx. A failed request never
+raises the concurrency. The failed requests are retried after a jittered
+exponential backoff, and a token bucket caps the global request rate.
+"""
+
+import argparse
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+import urllib2
+
+import flags
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--adaptive_concurrency',
+    default=False, action='store_true',
+    help='If set, adapt the number of in-flight requests to the health of the source.')
+flags.ArgParser().add_argument('--max_request_rate', type=float, default=0,
+    help='The max number of requests per second. 0 means unlimited.')
+flags.ArgParser().add_argument('--max_fetch_retries', type=int, default=3,
+    help='The max number of retries of a failed request.')
+flags.ArgParser().add_argument('--max_in_flight_requests', type=int, default=0,
+    help='The max number of requests in flight of all stocks. 0 means unlimited.')
+
+
+class TokenBucket(object):
+  """ Allows `rate` requests per second on average, and bursts of at most
+  `burst` requests.
+  """
+  def __init__(self, rate, burst=None):
+    assert rate > 0
+    self.__rate = float(rate)
+    self.__burst = float(burst or max(1.0, rate))
+    self.__tokens = self.__burst
+    self.__last_ts = time.time()
+    self.__lock = threading.Lock()
+
+  def Acquire(self):
+    """ Blocks till a token is available. """
+    while True:
+      with self.__lock:
+        now = time.time()
+        self.__tokens = min(self.__burst, self.__tokens + (now - self.__last_ts) * self.__rate)
+        self.__last_ts = now
+        if self.__tokens >= 1.0:
+          self.__tokens -= 1.0
+          return
+        wait = (1.0 - self.__tokens) / self.__rate
+      time.sleep(wait)
+
+
+class AimdLimiter(object):
+  """ Limits the number of in-flight requests. The limit increases by one
+  after `limit` healthy requests, i.e. once per round, and halves on
+  throttling at most once per round.
+
+  A request is healthy if its latency is within `latency_tolerance` times of
+  the recent best latency.
+  """
+  def __init__(self, min_limit=1, max_limit=256, initial_limit=4, latency_tolerance=3.0):
+    assert 0 < min_limit and min_limit <= initial_limit and initial_limit <= max_limit
+    self.__min_limit = min_limit
+    self.__max_limit = max_limit
+    self.__limit = float(initial_limit)
+    self.__latency_tolerance = latency_tolerance
+    self.__in_flight = 0
+    self.__best_latency = None  # decays slowly so that it follows the source
+    self.__last_decrease_ts = 0
+    self.__condition = threading.Condition()
+
+  def limit(self):
+    return int(self.__limit)
+
+  def Acquire(self):
+    """ Blocks till the number of in-flight requests is under the limit. """
+    with self.__condition:
+      while self.__in_flight >= int(self.__limit):
+        self.__condition.wait()
+      self.__in_flight += 1
+
+  def Release(self, latency, throttled, failed=False):
+    """ Reports the latency(seconds) of a completed request, whether the
+    source throttled it and whether it failed.
+    """
+    with self.__condition:
+      self.__in_flight -= 1
+      if self.__best_latency is None or latency < self.__best_latency:
+        self.__best_latency = latency
+      else:
+        self.__best_latency *= 1.01
+
+      old_limit = int(self.__limit)
+      now = time.time()
+      if throttled or latency > self.__best_latency * self.__latency_tolerance:
+        # decrease at most once per round trip, since the requests in flight
+        # were sent under the old limit.
+        if throttled and now - self.__last_decrease_ts > latency:
+          self.__limit = max(self.__min_limit, self.__limit / 2.0)
+          self.__last_decrease_ts = now
+      elif not failed:
+        self.__limit = min(self.__max_limit, self.__limit + 1.0 / self.__limit)
+
+      if int(self.__limit) != old_limit:
+        logging.info('Request concurrency limit %s to %d',
+            'increased' if int(self.__limit) > old_limit else 'decreased', int(self.__limit))
+      self.__condition.notify_all()
+
+
+class FixedLimiter(object):
+  """ Limits the number of in-flight requests to a fixed number. """
+  def __init__(self, limit):
+    assert limit > 0
+    self.__limit = limit
+    self.__in_flight = 0
+    self.__condition = threading.Condition()
+
+  def limit(self):
+    return self.__limit
+
+  def Acquire(self):
+    """ Blocks till the number of in-flight requests is under the limit. """
+    with self.__condition:
+      while self.__in_flight >= self.__limit:
+        self.__condition.wait()
+      self.__in_flight += 1
+
+  def Release(self, latency, throttled, failed=False):
+    with self.__condition:
+      self.__in_flight -= 1
+      self.__condition.notify()
+
+
+# The socket errors by which an overloaded source drops us.
+_THROTTLING_ERRNOS = set([errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.EPIPE])
+_THROTTLING_MESSAGES = ['timed out', 'reset', 'refused', 'connection closed']
+
+
+def IsRetryable(error):
+  """ Returns (retryable, throttled) of a urllib2.URLError. """
+  code = getattr(error, 'code', None)
+  if code is not None:  # HTTPError
+    throttled = code == 429 or code >= 500
+    return (throttled, throttled)
+  reason = getattr(error, 'reason', None)
+  throttled = (isinstance(reason, socket.timeout)
+      or getattr(reason, 'errno', None) in _THROTTLING_ERRNOS
+      or any(message in str(reason).lower() for message in _THROTTLING_MESSAGES))
+  return (True, throttled)  # connection errors are worth a retry
+
+
+def GetBackoff(attempt, base=0.5, cap=30.0):
+  """ Returns the seconds to wait before the attempt-th retry: a random time
+  up to the exponential backoff, so that the retries do not come in waves.
+  """
+  return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RequestController(object):
+  """ Runs requests under the rate limit and the concurrency limit, and
+  retries them on failures.
+  """
+  def __init__(self, max_retries, token_bucket=None, limiter=None):
+    self.__max_retries = max_retries
+    self.__token_bucket = token_bucket
+    self.__limiter = limiter
+
+  def max_retries(self):
+    return self.__max_retries
+
+  def Acquire(self):
+    """ Blocks till a request can be sent under the limits. Each Acquire()
+    is paired with a Release() once the request completes.
+    """
+    if self.__token_bucket:
+      self.__token_bucket.Acquire()
+    if self.__limiter:
+      self.__limiter.Acquire()
+
+  def Release(self, latency, error=None):
+    """ Reports the latency(seconds) of a completed request, and the error if
+    it failed. Returns whether the error is worth a retry.
+    """
+    (retryable, throttled) = (False, False)
+    if isinstance(error, urllib2.URLError):
+      (retryable, throttled) = IsRetryable(error)
+    if self.__limiter:
+      self.__limiter.Release(latency, throttled, error is not None)
+    return retryable
+
+  def WaitForRetry(self, attempt):
+    """ Sleeps the backoff before the attempt-th retry, from 1. """
+    backoff = GetBackoff(attempt - 1)
+    logging.info('Retry #%d in %.1f seconds', attempt, backoff)
+    time.sleep(backoff)
+
+  def Call(self, request, reset=None):
+    """ Returns request(), retrying it on retryable urllib2.URLError.
+    reset() is called before each retry, e.g. to truncate the output.
+    """
+    attempt = 0
+    while True:
+      self.Acquire()
+      start_ts = time.time()
+      try:
+        result = request()
+      except Exception, e:
+        retryable = self.Release(time.time() - start_ts, e)
+        if not retryable or attempt >= self.__max_retries:
+          raise
+      else:
+        self.Release(time.time() - start_ts)
+        return result
+
+      attempt += 1
+      self.WaitForRetry(attempt)
+      if reset:
+        reset()
+
+
+__shared_controller = None
+__shared_controller_lock = threading.Lock()
+
+def GetSharedController():
+  """ Returns the controller shared by all fetchers in this process. """
+  global __shared_controller
+  with __shared_controller_lock:
+    if __shared_controller is None:
+      token_bucket = TokenBucket(FLAGS.max_request_rate) if FLAGS.max_request_rate > 0 else None
+      limiter = None
+      budget = FLAGS.max_in_flight_requests
+      if FLAGS.adaptive_concurrency:
+        # the budget caps how far the limit can grow.
+        limiter = AimdLimiter(initial_limit=min(4, budget or 4), max_limit=budget or 256)
+      elif budget > 0:
+        limiter = FixedLimiter(budget)
+      __shared_controller = RequestController(FLAGS.max_fetch_retries, token_bucket, limiter)
+    return __shared_controller
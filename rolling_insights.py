@@ -0,0 +1,162 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" The rolling statistics of the seasonal metrics: for every season and each
+window length, the mean, CI and quantile of the season in the window of its
+previous seasons, i.e. what DataInsights gives for the 12 seasons window
+before --insight_season.
+
+The windows come from the prefix sums of the values and squares, so a stock
+takes O(seasons) per window length however many seasons there are. The output
+is a panel of (code, metrics, season, window) rows which can be sliced later
+without recomputation.
+"""
+
+import argparse
+import csv
+import logging
+import numpy
+import sys
+import threading
+from scipy import stats
+
+import flags
+import data_insights
+import data_store
+import stock_info
+
+Stock = stock_info.Stock
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--rolling_windows', default='4,8,12,20',
+    help='Comma separated numbers of previous seasons for the rolling statistics.')
+flags.ArgParser().add_argument('--rolling_output', default=None,
+    help='The output of the rolling statistics panel. No rolling statistics if not set.')
+
+# (refined metrics name, stats name)
+_ROLLING_METRICS = [
+    (u'主营业务收入(万元)_growth'.encode('UTF8'), 'revenue_growth'),
+    (u'PE_MV'.encode('UTF8'), 'PE'),
+    (u'PB_MV'.encode('UTF8'), 'PB'),
+]
+
+PANEL_COLUMNS = ['Code', 'Metrics', 'Season', 'Window',
+    'value', 'mean', 'lower', 'upper', 'quantile']
+
+
+def GetRollingWindows():
+  """ Returns the window lengths of --rolling_windows. """
+  windows = sorted(set(int(w) for w in FLAGS.rolling_windows.split(',') if w.strip()))
+  for w in windows:
+    assert w > 1, 'A rolling window needs at least 2 seasons: %d' % w
+  return windows
+
+
+def RollingStats(values, window):
+  """ values is a float64 vector in descending season order, NaN for missing
+  values. Returns (mean, lower, upper, quantile) vectors, where item i is the
+  stats of values[i] in the window values[i+1 : i+1+window], or NaN if any
+  value in that window is missing or 0, the same as DataInsights.
+  """
+  n = len(values)
+  valid = ~numpy.isnan(values) & (values != 0)
+  # The variance does not change by a shift, and the shifted values keep the
+  # prefix sums small so that they do not lose precision.
+  shift = values[valid].mean() if valid.any() else 0.0
+  shifted = numpy.where(valid, values - shift, 0.0)
+
+  def PrefixSum(x):
+    return numpy.concatenate(([0], numpy.cumsum(x)))
+
+  count_sums = PrefixSum(valid.astype(numpy.intp))
+  sums = PrefixSum(shifted)
+  square_sums = PrefixSum(shifted ** 2)
+
+  result = [numpy.full(n, numpy.nan) for i in range(4)]
+  if n <= window:
+    return tuple(result)
+  begin = numpy.arange(1, n - window + 1)  # the window of season i starts at i+1
+  end = begin + window
+  full = (count_sums[end] - count_sums[begin]) == window
+
+  mean = (sums[end] - sums[begin]) / float(window)
+  square_mean = (square_sums[end] - square_sums[begin]) / float(window)
+  # the rounding errors could make it a tiny negative for the const windows.
+  s = numpy.sqrt(numpy.maximum(square_mean - mean ** 2, 0.0) * window / float(window - 1))
+
+  # assume subject to t distribution, df=window-1, 95% confidence
+  t = stats.t.ppf(0.975, window - 1)
+  season_metrics = values[:n - window] - shift
+  with numpy.errstate(invalid='ignore', divide='ignore'):
+    # s can be 0 when the window is const.
+    point = numpy.where(s > 1e-6,
+        (season_metrics - mean) / (s / numpy.sqrt(window)),
+        (season_metrics - mean) * 100.0)
+    quantile = stats.t.cdf(point, window - 1) * 100.0
+  full &= ~numpy.isnan(season_metrics)
+  for r, v in zip(result, [mean + shift, mean + shift - t * s / numpy.sqrt(window),
+      mean + shift + t * s / numpy.sqrt(window), quantile]):
+    r[:n - window] = numpy.where(full, v, numpy.nan)
+  return tuple(result)
+
+
+class RollingInsights(object):
+  def __init__(self, directory, windows):
+    self._directory = directory
+    self._store = data_store.OpenDataStore(directory)
+    self._windows = windows
+
+  def DoRollingStats(self, stock):
+    """ Returns the panel rows of the stock, a list of dict of PANEL_COLUMNS. """
+    logging.info('Rolling stats of %s(%s) ...', stock.code(), stock.name())
+    refined_data = data_insights.LoadRefinedData(
+        self._store, stock.code(), [m for (m, name) in _ROLLING_METRICS])
+    seasons = refined_data.seasons
+    rows = []
+    for (metrics_name, name) in _ROLLING_METRICS:
+      values = refined_data.GetRow(metrics_name)
+      if values is None:
+        continue
+      for window in self._windows:
+        (mean, lower, upper, quantile) = RollingStats(values, window)
+        for i in numpy.flatnonzero(~numpy.isnan(mean)):
+          rows.append({
+            'Code': stock.code(),
+            'Metrics': name,
+            'Season': seasons[i],
+            'Window': window,
+            'value': float(values[i]),
+            'mean': float(mean[i]),
+            'lower': float(lower[i]),
+            'upper': float(upper[i]),
+            'quantile': float(quantile[i]),
+          })
+    return rows
+
+
+class PanelWriter(object):
+  """ Writes the panel rows of many threads into one csv. """
+  def __init__(self, outfile):
+    self.__lock = threading.Lock()
+    self.__outfile = outfile
+    self.__writer = csv.DictWriter(outfile, fieldnames=PANEL_COLUMNS)
+    self.__writer.writeheader()
+
+  def Write(self, rows):
+    with self.__lock:
+      self.__writer.writerows(rows)
+      self.__outfile.flush()
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+
+  logging.basicConfig(level=logging.INFO)
+  directory = './data/test'
+  stock = Stock('000977', '浪潮信息', '医药', '2001-01-01')
+  roller = RollingInsights(directory, GetRollingWindows())
+  PanelWriter(sys.stdout).Write(roller.DoRollingStats(stock))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,385 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" Screens the insights by expressions over their columns, e.g.
+
+  --screen="12seasons_PE_quantile < 20 and revenue_growth_at_season > 30"
+  --screen_sort="PE_at_season / 12seasons_PE_mean" --screen_limit=20
+
+The insights are put into a columnar table once, i.e. a numpy array of each
+column, and every screen is evaluated on the whole columns. The top k rows
+are selected by a heap instead of sorting all rows.
+
+An expression has the columns, the numbers, the 'quoted' strings, + - * /,
+the comparisons < <= > >= == != and and/or/not with the parentheses. The
+missing values never match a comparison, nor its negation, and are sorted
+last.
+"""
+
+import argparse
+import csv
+import heapq
+import logging
+import numpy
+import re
+import sys
+
+import flags
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--screen_input', default='./data/test/insight.csv',
+    help='The insight csv to screen, e.g. the --insight_output of stock_seeker.')
+flags.ArgParser().add_argument('--screen', default='',
+    help='The expression which the screened insights match. All insights if empty.')
+flags.ArgParser().add_argument('--screen_sort', default='',
+    help='The expression to sort the screened insights by.')
+flags.ArgParser().add_argument('--screen_desc', default=False, action='store_true',
+    help='Sort in descending order.')
+flags.ArgParser().add_argument('--screen_limit', type=int, default=0,
+    help='Output only the top N insights. 0 for all.')
+
+_TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?(?![\w]))|
+    (?P<name>\w+)|
+    '(?P<string>[^']*)'|
+    (?P<op><=|>=|==|!=|<|>|=|\+|-|\*|/|\(|\)))""", re.VERBOSE | re.UNICODE)
+
+_COMPARISONS = {
+  '<': numpy.less,
+  '<=': numpy.less_equal,
+  '>': numpy.greater,
+  '>=': numpy.greater_equal,
+  '==': numpy.equal,
+  '=': numpy.equal,
+  '!=': numpy.not_equal,
+}
+
+_ARITHMETICS = {
+  '+': numpy.add,
+  '-': numpy.subtract,
+  '*': numpy.multiply,
+  '/': numpy.divide,
+}
+
+
+class _Condition(object):
+  """ The result of a condition on the rows: whether each row matches, and
+  whether it is known, i.e. not decided by the missing values.
+  """
+  def __init__(self, matched, known):
+    self.matched = matched
+    self.known = known
+
+
+def _GetKind(value):
+  """ Returns the kind of a value: condition, text or number. """
+  if isinstance(value, _Condition):
+    return 'condition'
+  if isinstance(value, basestring) or (
+      isinstance(value, numpy.ndarray) and value.dtype == object):
+    return 'text'
+  return 'number'
+
+
+def _ToCondition(value):
+  if not isinstance(value, _Condition):
+    raise ValueError('Not a condition of and/or/not')
+  return value
+
+
+def _Or(left, right):
+  matched = left.matched | right.matched
+  return _Condition(matched, (left.known & right.known) | matched)
+
+
+def _And(left, right):
+  # a known mismatch of either side is enough to decide.
+  return _Condition(left.matched & right.matched, (left.known & right.known)
+      | (left.known & ~left.matched) | (right.known & ~right.matched))
+
+
+def _Not(operand):
+  return _Condition(~operand.matched & operand.known, operand.known)
+
+
+def _Tokenize(expression):
+  """ Returns a list of (kind, value), kind is number, name, string or op. """
+  tokens = []
+  position = 0
+  expression = expression.strip()
+  while position < len(expression):
+    match = _TOKEN_PATTERN.match(expression, position)
+    if not match or match.end() == position:
+      raise ValueError('Bad expression at %d: %s' % (position, expression[position:]))
+    position = match.end()
+    kind = match.lastgroup
+    tokens.append((kind, match.group(kind)))
+  return tokens
+
+
+class _Parser(object):
+  """ Parses an expression into a function of the InsightTable which returns
+  a numpy array, by recursive descent.
+  """
+  def __init__(self, expression):
+    self.__tokens = _Tokenize(expression)
+    self.__position = 0
+
+  def Parse(self):
+    evaluate = self.__ParseOr()
+    if self.__position < len(self.__tokens):
+      raise ValueError('Unexpected %s' % self.__tokens[self.__position][1])
+    return evaluate
+
+  def __Peek(self):
+    if self.__position < len(self.__tokens):
+      return self.__tokens[self.__position]
+    return (None, None)
+
+  def __Next(self):
+    token = self.__Peek()
+    if token[0] is None:
+      raise ValueError('Unexpected end of expression')
+    self.__position += 1
+    return token
+
+  def __IsKeyword(self, word):
+    (kind, value) = self.__Peek()
+    return kind == 'name' and value.lower() == word
+
+  def __ParseOr(self):
+    left = self.__ParseAnd()
+    while self.__IsKeyword('or'):
+      self.__Next()
+      right = self.__ParseAnd()
+      left = (lambda l, r: lambda table: _Or(
+          _ToCondition(l(table)), _ToCondition(r(table))))(left, right)
+    return left
+
+  def __ParseAnd(self):
+    left = self.__ParseNot()
+    while self.__IsKeyword('and'):
+      self.__Next()
+      right = self.__ParseNot()
+      left = (lambda l, r: lambda table: _And(
+          _ToCondition(l(table)), _ToCondition(r(table))))(left, right)
+    return left
+
+  def __ParseNot(self):
+    if self.__IsKeyword('not'):
+      self.__Next()
+      operand = self.__ParseNot()
+      return lambda table: _Not(_ToCondition(operand(table)))
+    return self.__ParseComparison()
+
+  def __ParseComparison(self):
+    left = self.__ParseSum()
+    (kind, value) = self.__Peek()
+    if kind != 'op' or value not in _COMPARISONS:
+      return left
+    self.__Next()
+    right = self.__ParseSum()
+    compare = _COMPARISONS[value]
+
+    def Evaluate(table):
+      (l, r) = (left(table), right(table))
+      (left_kind, right_kind) = (_GetKind(l), _GetKind(r))
+      if left_kind != right_kind or left_kind == 'condition':
+        raise ValueError('Cannot compare %s with %s by %s' % (left_kind, right_kind, value))
+      with numpy.errstate(invalid='ignore'):
+        result = numpy.asarray(compare(l, r), dtype=bool)
+      # the missing values, i.e. NaN or None, never match.
+      known = table.IsPresent(l) & table.IsPresent(r)
+      return _Condition(result & known, known)
+    return Evaluate
+
+  def __ParseSum(self):
+    return self.__ParseArithmetic(self.__ParseProduct, ('+', '-'))
+
+  def __ParseProduct(self):
+    return self.__ParseArithmetic(self.__ParseUnary, ('*', '/'))
+
+  def __ParseArithmetic(self, parse_operand, operators):
+    left = parse_operand()
+    while self.__Peek()[0] == 'op' and self.__Peek()[1] in operators:
+      operate = _ARITHMETICS[self.__Next()[1]]
+      right = parse_operand()
+      left = (lambda l, r, f: lambda table: table.Arithmetic(f, l(table), r(table)))(
+          left, right, operate)
+    return left
+
+  def __ParseUnary(self):
+    if self.__Peek() == ('op', '-'):
+      self.__Next()
+      operand = self.__ParseUnary()
+      return lambda table: table.Arithmetic(numpy.subtract, 0.0, operand(table))
+    return self.__ParseOperand()
+
+  def __ParseOperand(self):
+    (kind, value) = self.__Next()
+    if kind == 'number':
+      number = float(value)
+      return lambda table: number
+    if kind == 'string':
+      return lambda table: value
+    if kind == 'name':
+      return lambda table: table.GetColumn(value)
+    if (kind, value) == ('op', '('):
+      evaluate = self.__ParseOr()
+      if self.__Next() != ('op', ')'):
+        raise ValueError('Missing )')
+      return evaluate
+    raise ValueError('Unexpected %s' % value)
+
+
+def Compile(expression):
+  """ Returns the function of the InsightTable which evaluates the
+  expression, or raises ValueError if the expression is bad. A condition is
+  evaluated to the bool array of the matched rows.
+  """
+  evaluate = _Parser(expression).Parse()
+
+  def Evaluate(table):
+    value = evaluate(table)
+    return value.matched if isinstance(value, _Condition) else value
+  return Evaluate
+
+
+# The columns of text even if they look like numbers, e.g. the codes.
+_TEXT_COLUMNS = set(['Code', 'Name', 'Industry', 'IPO', 'Season'])
+
+
+def _IsNumber(value):
+  try:
+    float(value)
+    return True
+  except ValueError:
+    return False
+
+
+class InsightTable(object):
+  """ The insights in columns: a float64 array of each numeric column with
+  NaN for the missing values, and an object array of each other column.
+  """
+  def __init__(self, insights):
+    """ insights is a list of the insight data maps, i.e. InsightData.data(). """
+    self.__insights = insights
+    self.__columns = {}
+    names = set()
+    for insight in insights:
+      names.update(insight.iterkeys())
+    for name in names:
+      values = [insight.get(name) for insight in insights]
+      values = [None if value == '' else value for value in values]
+      if name not in _TEXT_COLUMNS:
+        try:
+          self.__columns[name] = numpy.array(
+              [numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+          continue
+        except ValueError:
+          pass  # not numeric
+      self.__columns[name] = numpy.array(values, dtype=object)
+
+  def __len__(self):
+    return len(self.__insights)
+
+  def columns(self):
+    return sorted(self.__columns)
+
+  def GetColumn(self, name):
+    column = self.__columns.get(name)
+    if column is None:
+      raise ValueError('Unknown column: %s' % name)
+    return column
+
+  def IsPresent(self, values):
+    """ Returns the mask of the values which are not missing. """
+    if isinstance(values, numpy.ndarray):
+      if values.dtype == object:
+        return numpy.array([value is not None for value in values], dtype=bool)
+      if values.dtype.kind == 'f':
+        return ~numpy.isnan(values)
+      return numpy.ones(len(values), dtype=bool)
+    return numpy.ones(len(self), dtype=bool) if values is not None else numpy.zeros(len(self), dtype=bool)
+
+  def Arithmetic(self, operate, left, right):
+    for operand in (left, right):
+      if _GetKind(operand) != 'number':
+        raise ValueError('Arithmetic on non-numeric values')
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      result = operate(left, right)
+    # e.g. x / 0 is missing rather than infinite.
+    return numpy.where(numpy.isinf(result), numpy.nan, result)
+
+  def Select(self, where=None, sort=None, descending=False, limit=None):
+    """ Returns the insight data maps matching the where expression, sorted
+    by the sort expression with the missing last, at most limit of them.
+    Raises ValueError on bad expressions or a negative limit.
+    """
+    if limit is not None and limit < 0:
+      raise ValueError('Negative limit: %d' % limit)
+    rows = numpy.arange(len(self))
+    if where:
+      mask = Compile(where)(self)
+      if not isinstance(mask, numpy.ndarray) or mask.dtype != bool:
+        raise ValueError('Not a condition: %s' % where)
+      rows = rows[mask]
+
+    if sort:
+      keys = Compile(sort)(self)
+      if not isinstance(keys, numpy.ndarray):
+        keys = numpy.repeat(keys, len(self))
+      present = self.IsPresent(keys)
+      missing_rows = rows[~present[rows]]
+      rows = rows[present[rows]]
+      # the rows of equal keys keep their order in both ways.
+      if limit is not None and limit < len(rows):
+        select = heapq.nlargest if descending else heapq.nsmallest
+        rows = select(limit, rows, key=keys.__getitem__)
+      elif keys.dtype.kind == 'f':
+        rows = rows[numpy.argsort(-keys[rows] if descending else keys[rows], kind='mergesort')]
+      else:
+        rows = sorted(rows, key=keys.__getitem__, reverse=descending)
+      rows = list(rows) + list(missing_rows)
+
+    if limit is not None:
+      rows = rows[:limit]
+    return [self.__insights[row] for row in rows]
+
+
+def GetEqualityExpression(table, conditions):
+  """ Returns the expression of the conditions {column -> value string},
+  i.e. every column equals its value.
+  """
+  terms = []
+  for column, value in sorted(conditions.iteritems()):
+    if "'" in value:
+      raise ValueError('Bad value: %s' % value)
+    if table.GetColumn(column).dtype.kind == 'f':
+      if not _IsNumber(value):
+        raise ValueError('Not a number for %s: %s' % (column, value))
+      terms.append('%s == %s' % (column, value))
+    else:
+      terms.append("%s == '%s'" % (column, value))
+  return ' and '.join(terms)
+
+
+def main():
+  # Parse command line flags into FLAGS.
+  flags.ArgParser().parse_args(namespace=FLAGS)
+  logging.basicConfig(level=logging.INFO)
+
+  with open(FLAGS.screen_input) as f:
+    reader = csv.DictReader(f)
+    header = reader.fieldnames
+    insights = list(reader)
+  table = InsightTable(insights)
+  result = table.Select(FLAGS.screen or None, FLAGS.screen_sort or None, FLAGS.screen_desc,
+      FLAGS.screen_limit or None)
+  logging.info('%d of %d insights screened', len(result), len(table))
+  writer = csv.DictWriter(sys.stdout, fieldnames=header)
+  writer.writeheader()
+  writer.writerows(result)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,375 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+""" The daemon mode of stock_seeker: keeps the stocks, their parsed refined
+data and the latest insights in memory, serves queries over a local HTTP or
+unix socket endpoint, and refreshes the stocks in the background.
+
+The endpoints, all answered in JSON:
+  GET /stock?code=600000[&code=...]  the insights of the stocks.
+  GET /screen?[<column>=<value>...][&season=S][&where=<expr>][&sort=<expr>][&desc=1][&limit=N]
+      the insights whose columns equal the given values and which match the
+      screener expression, sorted by an expression, e.g.
+      where=12seasons_PE_quantile < 20 and revenue_growth_at_season > 30
+  GET /status                        the numbers of stocks and the refreshing.
+  GET /metrics                       the performance metrics in Prometheus text.
+  POST /refresh[?code=...]           refreshes the stocks, all by default.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+import urlparse
+
+import flags
+import batch_data_fetcher
+import data_fetcher
+import data_insights
+import data_store
+import perf_metrics
+import screener
+
+FLAGS = flags.FLAGS
+flags.ArgParser().add_argument('--serve', default=False, action='store_true',
+    help='Run as a daemon serving the insights instead of a one-off run.')
+flags.ArgParser().add_argument('--server_port', type=int, default=8800,
+    help='The local port to serve on.')
+flags.ArgParser().add_argument('--server_socket', default=None,
+    help='Serve on this unix socket instead of the port.')
+flags.ArgParser().add_argument('--refresh_interval', type=int, default=0,
+    help='Seconds between the background refreshes of all stocks. 0 to refresh only on request.')
+
+# Put into the refreshing queue to indicate that no more stock will come.
+_END_OF_STREAM = None
+
+
+class InsightCache(object):
+  """ The parsed refined data and the insights of the stocks, updated by the
+  refreshing threads and read by the serving threads.
+  """
+  def __init__(self, directory, stocks):
+    self.__directory = directory
+    self.__insight_seasons = data_insights.GetInsightSeasons()
+    self.__store = data_store.OpenDataStore(directory)
+    self.__insighter = data_insights.DataInsights(directory)
+    self.__metrics_names = self.__insighter.metrics_names()
+    self.__stocks = stocks  # {code -> Stock}
+    self.__lock = threading.Lock()
+    self.__refined = {}  # {code -> (version, RefinedData)}
+    self.__insights = {}  # {code -> list of insight data map}
+    self.__columns = []  # the columns of the insights in order
+    self.__table = None  # the screener.InsightTable of all insights, None if changed
+
+  def stocks(self):
+    return self.__stocks
+
+  def IsCurrent(self, directory):
+    """ Returns whether the cache is of the data directory and the insight
+    seasons of now, which change at the quarter boundaries.
+    """
+    return (directory == self.__directory and
+        data_insights.GetInsightSeasons() == self.__insight_seasons)
+
+  def WarmUp(self):
+    """ Loads the refined data already in the directory. """
+    start = time.time()
+    for stock in self.__stocks.values():
+      try:
+        self.Update(stock)
+      except Exception, e:
+        logging.error('Error in loading %s(%s): %s', stock.code(), stock.name(), e)
+    logging.info('Loaded %d stocks of %s in %.1f seconds.',
+        self.GetStatus()['insighted_stocks'], self.__directory, time.time() - start)
+
+  def Update(self, stock):
+    """ Reloads the refined data of the stock and does its insights if the
+    data changes. Returns whether it changes.
+    """
+    code = stock.code()
+    version = self.__store.GetVersion(code, 'refined.npy')
+    with self.__lock:
+      cached = self.__refined.get(code)
+    if version is None or (cached and cached[0] == version):
+      return False
+    refined_data = data_insights.LoadRefinedData(self.__store, code, self.__metrics_names)
+    insights = self.__insighter.DoStatsOnRefinedData(stock, refined_data)
+    with self.__lock:
+      self.__refined[code] = (version, refined_data)
+      self.__insights[code] = [insight.data() for insight in insights]
+      self.__table = None
+      for insight in insights:
+        if len(insight.columns()) > len(self.__columns):
+          self.__columns = list(insight.columns())
+    return True
+
+  def GetInsights(self, codes):
+    """ Returns {code -> list of insight data map} of the stocks. """
+    with self.__lock:
+      return dict((code, self.__insights[code]) for code in codes if code in self.__insights)
+
+  def __GetTable(self):
+    """ Returns the InsightTable, which is rebuilt only after the insights
+    change.
+    """
+    with self.__lock:
+      table = self.__table
+      if table is None:
+        all_insights = []
+        for code in sorted(self.__insights):
+          all_insights += self.__insights[code]
+        table = self.__table = screener.InsightTable(all_insights)
+      return table
+
+  def Screen(self, conditions, sort=None, descending=False, limit=None, where=None):
+    """ Returns the insight data maps whose columns equal the values in
+    conditions {column -> value} and which match the where expression,
+    sorted by the sort expression, the missing last. Raises ValueError on
+    bad expressions.
+    """
+    table = self.__GetTable()
+    expressions = []
+    if conditions:
+      expressions.append(screener.GetEqualityExpression(table, conditions))
+    if where:
+      screener.Compile(where)  # the errors are reported on the where alone
+      expressions.append('(%s)' % where)
+    return table.Select(' and '.join(expressions) or None, sort, descending, limit)
+
+  def GetStatus(self):
+    with self.__lock:
+      return {
+        'directory': self.__directory,
+        'insight_seasons': [s.isoformat() for s in self.__insight_seasons],
+        'stocks': len(self.__stocks),
+        'insighted_stocks': len(self.__insights),
+        'columns': self.__columns,
+      }
+
+
+class BackgroundRefresher(object):
+  """ Fetches and refines the stocks through BatchDataFetcher in the
+  background, and updates the cache as soon as each stock is refined.
+
+  Each refreshing starts by checking the data directory and the insight
+  seasons. When a quarter passes, it refreshes all stocks into a new cache of
+  the new directory, which replaces the old one once done.
+  """
+  def __init__(self, get_directory, cache, new_fetcher):
+    """ get_directory() returns the data directory of now, and
+    new_fetcher(directory) returns the data fetcher of a refreshing.
+    """
+    self.__get_directory = get_directory
+    self.__cache = cache
+    self.__new_fetcher = new_fetcher
+    self.__lock = threading.Lock()
+    self.__running = False
+    self.__last_refresh = None  # (start time, end time, number of stocks)
+
+  def cache(self):
+    """ Returns the InsightCache being served. """
+    with self.__lock:
+      return self.__cache
+
+  def Refresh(self, stock_list):
+    """ Starts refreshing the stocks. Returns False if a refreshing is running. """
+    with self.__lock:
+      if self.__running:
+        return False
+      self.__running = True
+    thread = threading.Thread(target=self.__Run, name='Refresher', args=(stock_list,))
+    thread.daemon = True
+    thread.start()
+    return True
+
+  def RunPeriodically(self, interval):
+    """ Refreshes all stocks every interval seconds in the background. """
+    def Run():
+      while True:
+        time.sleep(interval)
+        if not self.Refresh(self.cache().stocks().values()):
+          logging.info('Skip the periodic refreshing since one is running.')
+    thread = threading.Thread(target=Run, name='PeriodicRefresher')
+    thread.daemon = True
+    thread.start()
+
+  def GetStatus(self):
+    with self.__lock:
+      status = {'refreshing': self.__running}
+      if self.__last_refresh:
+        (start, end, num) = self.__last_refresh
+        status.update({'last_refresh_start': start, 'last_refresh_end': end,
+            'last_refresh_stocks': num})
+      return status
+
+  def __Run(self, stock_list):
+    start = time.time()
+    cache = self.cache()
+    directory = self.__get_directory()
+    if not cache.IsCurrent(directory):
+      logging.info('Switching to %s of insight seasons %s ...', directory,
+          ','.join(s.isoformat() for s in data_insights.GetInsightSeasons()))
+      cache = InsightCache(directory, cache.stocks())
+      cache.WarmUp()
+      stock_list = cache.stocks().values()
+    logging.info('Refreshing %d stocks ...', len(stock_list))
+    refined_queue = Queue.Queue()
+    updater = threading.Thread(target=self.__RunUpdater, name='CacheUpdater',
+        args=(cache, refined_queue))
+    updater.start()
+    try:
+      fetcher = self.__new_fetcher(directory)
+      schedule = batch_data_fetcher.FetchSchedule(
+          os.path.join(os.path.dirname(directory), 'fetch_history.json'))
+      batch = batch_data_fetcher.BatchDataFetcher(
+          fetcher, FLAGS.num_fetcher_threads, refined_queue, schedule=schedule)
+      batch.Fetch(stock_list)
+    except Exception, e:
+      logging.error('Error in refreshing %d stocks: %s', len(stock_list), e)
+    finally:
+      refined_queue.put(_END_OF_STREAM)
+      updater.join()
+      with self.__lock:
+        self.__cache = cache
+        self.__running = False
+        self.__last_refresh = (start, time.time(), len(stock_list))
+    logging.info('Refreshing %d stocks done in %.1f seconds.', len(stock_list), time.time() - start)
+
+  def __RunUpdater(self, cache, refined_queue):
+    while True:
+      stock = refined_queue.get(block=True)
+      if stock is _END_OF_STREAM:
+        break
+      try:
+        cache.Update(stock)
+      except Exception, e:
+        logging.error('Error in updating %s(%s): %s', stock.code(), stock.name(), e)
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """ Answers the queries by server.refresher and its cache. """
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    params = urlparse.parse_qs(url.query)
+    cache = self.server.refresher.cache()
+    if url.path == '/stock':
+      self.__Reply(200, cache.GetInsights(params.get('code', [])))
+    elif url.path == '/screen':
+      options = {}
+      for name in ['where', 'sort', 'desc', 'limit']:
+        if name in params:
+          options[name] = params.pop(name)[-1]
+      if 'season' in params:
+        params['Season'] = params.pop('season')
+      conditions = dict((k, v[-1]) for k, v in params.iteritems())
+      try:
+        limit = int(options['limit']) if 'limit' in options else None
+      except ValueError:
+        limit = -1
+      if limit is not None and limit < 0:
+        self.__Reply(400, {'error': 'Bad limit: %s' % options['limit']})
+        return
+      try:
+        result = cache.Screen(conditions, options.get('sort'),
+            options.get('desc', '0') not in ('', '0', 'false'), limit, options.get('where'))
+      except ValueError, e:
+        self.__Reply(400, {'error': str(e)})
+        return
+      self.__Reply(200, result)
+    elif url.path == '/status':
+      status = cache.GetStatus()
+      status.update(self.server.refresher.GetStatus())
+      self.__Reply(200, status)
+    elif url.path == '/metrics':
+      body = perf_metrics.GetRegistry().ToPrometheus()
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+    else:
+      self.__Reply(404, {'error': 'Unknown path: %s' % url.path})
+
+  def do_POST(self):
+    url = urlparse.urlparse(self.path)
+    if url.path != '/refresh':
+      self.__Reply(404, {'error': 'Unknown path: %s' % url.path})
+      return
+    stocks = self.server.refresher.cache().stocks()
+    codes = urlparse.parse_qs(url.query).get('code')
+    stock_list = [stocks[c] for c in codes if c in stocks] if codes else stocks.values()
+    started = self.server.refresher.Refresh(stock_list)
+    self.__Reply(202 if started else 409, {'refreshing_stocks': len(stock_list) if started else 0})
+
+  def __Reply(self, status, result):
+    body = json.dumps(result, ensure_ascii=False)
+    if isinstance(body, unicode):
+      body = body.encode('UTF8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug('%s', format % args)
+
+
+class _HttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class _UnixHttpServer(_HttpServer):
+  address_family = socket.AF_UNIX
+
+  def server_bind(self):
+    # no host name or port for a unix socket.
+    SocketServer.TCPServer.server_bind(self)
+    self.server_name = 'localhost'
+    self.server_port = 0
+
+  def get_request(self):
+    # the handler expects the client address to be (host, port).
+    (request, client_address) = _HttpServer.get_request(self)
+    return (request, ('local', 0))
+
+
+def Serve(get_directory, stocks, new_fetcher=data_fetcher.NeteaseSeasonFetcher):
+  """ Serves the insights of the stocks {code -> Stock} till interrupted.
+  get_directory() returns the data directory of now, which is checked again
+  on each refreshing.
+  """
+  cache = InsightCache(get_directory(), stocks)
+  refresher = BackgroundRefresher(get_directory, cache, new_fetcher)
+
+  # Warm up by the refined data already there.
+  cache.WarmUp()
+  if FLAGS.refresh_interval > 0:
+    refresher.RunPeriodically(FLAGS.refresh_interval)
+
+  if FLAGS.server_socket:
+    if os.path.exists(FLAGS.server_socket):
+      os.remove(FLAGS.server_socket)
+    server = _UnixHttpServer(FLAGS.server_socket, _RequestHandler)
+    logging.info('Serving on unix socket %s', FLAGS.server_socket)
+  else:
+    server = _HttpServer(('127.0.0.1', FLAGS.server_port), _RequestHandler)
+    logging.info('Serving on http://127.0.0.1:%d', FLAGS.server_port)
+  server.refresher = refresher
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    logging.info('Stopped serving.')
+  finally:
+    server.server_close()
+    if FLAGS.server_socket and os.path.exists(FLAGS.server_socket):
+      os.remove(FLAGS.server_socket)
@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import array
+import bisect
+import cPickle
 import csv
 import logging
 import os
@@ -18,12 +21,18 @@ flags.ArgParser().add_argument(
 
 
 class Stock(object):
+  __slots__ = ('__code', '__name', '__industry', '__ipo_date')
+
   def __init__(self, code, name, industry, ipo_date):
     self.__code = code
     self.__name = name
     self.__industry = industry
     self.__ipo_date = ipo_date
 
+  def __reduce__(self):
+    # the slots are not pickled by default.
+    return (Stock, (self.__code, self.__name, self.__industry, self.__ipo_date))
+
   def code(self):
     return self.__code
 
@@ -35,35 +44,197 @@ class Stock(object):
     return self.__ipo_date
 
 
-def LoadAllStocks():
-  """ Returns a map of {code -> Stock}.
+def GetExchange(code):
+  """ Returns 'sh' for 6xxxxx in Shanghai, 'sz' for 0xxxxx and 3xxxxx in Shenzhen. """
+  return 'sh' if code.startswith('6') else 'sz'
+
+
+class StockUniverse(object):
+  """ All stocks in columns, with the indexes by code, industry, exchange
+  and IPO date. It is also a map of {code -> Stock} as LoadAllStocks used to
+  return, whose Stock objects are created at the first access.
+  """
+  __slots__ = ('__codes', '__names', '__industry_ids', '__industries', '__ipo_dates',
+      '__stocks', '__code_index', '__industry_index', '__exchange_index', '__ipo_order',
+      '__ordered_ipo_dates')
+
+  def __init__(self, codes, names, industries, ipo_dates):
+    """ The columns are lists of the same length, without duplicate codes. """
+    self.__codes = codes
+    self.__names = names
+    self.__ipo_dates = ipo_dates
+    self.__stocks = [None] * len(codes)
+    self.__code_index = dict((code, i) for i, code in enumerate(codes))
+
+    # the industries are interned, and the column keeps their ids.
+    self.__industries = []
+    industry_ids = {}
+    self.__industry_ids = array.array('H')
+    self.__industry_index = {}  # {industry -> rows}
+    for i, industry in enumerate(industries):
+      industry_id = industry_ids.get(industry)
+      if industry_id is None:
+        industry_id = industry_ids[industry] = len(self.__industries)
+        self.__industries.append(intern(industry))
+        self.__industry_index[self.__industries[industry_id]] = array.array('I')
+      self.__industry_ids.append(industry_id)
+      self.__industry_index[self.__industries[industry_id]].append(i)
+
+    self.__exchange_index = {'sh': array.array('I'), 'sz': array.array('I')}
+    for i, code in enumerate(codes):
+      self.__exchange_index[GetExchange(code)].append(i)
+    # the rows in the order of IPO date(YYYY-MM-DD), the unknown ones first.
+    self.__ipo_order = sorted(range(len(codes)), key=lambda i: ipo_dates[i])
+    self.__ordered_ipo_dates = [ipo_dates[i] for i in self.__ipo_order]
+
+  def __GetStock(self, row):
+    stock = self.__stocks[row]
+    if stock is None:
+      stock = self.__stocks[row] = Stock(self.__codes[row], self.__names[row],
+          self.__industries[self.__industry_ids[row]], self.__ipo_dates[row])
+    return stock
+
+  def __GetStocks(self, rows):
+    return [self.__GetStock(row) for row in rows]
+
+  # The map of {code -> Stock}.
+  def __len__(self):
+    return len(self.__codes)
+
+  def __contains__(self, code):
+    return code in self.__code_index
+
+  def __getitem__(self, code):
+    return self.__GetStock(self.__code_index[code])
+
+  def __iter__(self):
+    return iter(self.__codes)
+
+  def get(self, code, default=None):
+    row = self.__code_index.get(code)
+    return default if row is None else self.__GetStock(row)
+
+  def keys(self):
+    return list(self.__codes)
+
+  def values(self):
+    return self.__GetStocks(range(len(self.__codes)))
+
+  def items(self):
+    return zip(self.keys(), self.values())
+
+  def iterkeys(self):
+    return iter(self.__codes)
+
+  def itervalues(self):
+    return (self.__GetStock(row) for row in xrange(len(self.__codes)))
+
+  def iteritems(self):
+    return ((self.__codes[row], self.__GetStock(row)) for row in xrange(len(self.__codes)))
+
+  # The selections by the indexes.
+  def industries(self):
+    return list(self.__industries)
+
+  def GetByIndustry(self, industry):
+    return self.__GetStocks(self.__industry_index.get(industry, ()))
+
+  def GetByExchange(self, exchange):
+    """ exchange is 'sh' or 'sz'. """
+    return self.__GetStocks(self.__exchange_index[exchange])
+
+  def GetByIpoDate(self, start=None, end=None):
+    """ Returns the stocks listed in [start, end], both YYYY-MM-DD and
+    optional, in the order of IPO date. The ones of unknown IPO dates are
+    excluded.
+    """
+    dates = self.__ordered_ipo_dates
+    begin = bisect.bisect_left(dates, start or '0')
+    finish = bisect.bisect_right(dates, end) if end else len(dates)
+    return self.__GetStocks(self.__ipo_order[begin:finish])
+
+
+_CACHE_VERSION = 1
+
+
+def _ParseStockFile(stock_file):
+  """ Returns the columns (codes, names, industries, ipo_dates) of a stock
+  list csv.
   """
   code_column = u'A股代码'.encode('utf8')
   name_column = u'A股简称'.encode('utf8')
   industry_column = u'2012年行业名称'.encode('utf8')
   ipo_date_column = u'上市日期'.encode('utf8')
-  all_stocks = {}
-  for stock_file in FLAGS.stock_list.split(','):
+  columns = ([], [], [], [])
+  reader = csv.DictReader(open(stock_file))
+  for row in reader:
+    code = row.get(code_column, '')
+    name = row.get(name_column, '')
+    industry = row.get(industry_column, '')
+    ipo_date = row.get(ipo_date_column, '')
+    code = code.strip()
+    name = name.replace(' ', '')
+    industry = industry.strip()
+    ipo_date = ipo_date.strip()
+    if not code or not name:
+      continue
+    # logging.info('stock: "%s", name: "%s"', code, name)
+    for column, value in zip(columns, (code, name, industry, ipo_date)):
+      column.append(value)
+  return columns
+
+
+def _LoadStockFile(stock_file):
+  """ Returns the columns of a stock list csv, from the parsed form cached
+  next to it if it is up to date, otherwise parses the csv and caches it.
+  """
+  stat = os.stat(stock_file)
+  version = (_CACHE_VERSION, stat.st_mtime, stat.st_size)
+  cache_file = stock_file + '.parsed'
+  try:
+    with open(cache_file, 'rb') as f:
+      (cached_version, columns) = cPickle.load(f)
+    if cached_version == version:
+      return columns
+  except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+    pass
+
+  columns = _ParseStockFile(stock_file)
+  try:
+    with open(cache_file + '.tmp', 'wb') as f:
+      cPickle.dump((version, columns), f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(cache_file + '.tmp', cache_file)
+  except (IOError, OSError), e:
+    logging.warning('Failed to cache the parsed %s: %s', stock_file, e)
+  return columns
+
+
+def LoadStocks(stock_files):
+  """ Returns the StockUniverse of the stock list csv files. A stock in more
+  than one file takes the last one.
+  """
+  rows = {}  # {code -> (name, industry, ipo_date)}
+  for stock_file in stock_files:
     stock_file = stock_file.strip()
     if stock_file.startswith('~'):
       stock_file = os.path.expanduser(stock_file)
+    (codes, names, industries, ipo_dates) = _LoadStockFile(stock_file)
+    rows.update(zip(codes, zip(names, industries, ipo_dates)))
+
+  codes = sorted(rows)
+  (names, industries, ipo_dates) = ([], [], [])
+  for code in codes:
+    (name, industry, ipo_date) = rows[code]
+    names.append(name)
+    industries.append(industry)
+    ipo_dates.append(ipo_date)
+  return StockUniverse(codes, names, industries, ipo_dates)
 
-    reader = csv.DictReader(open(stock_file))
-    for row in reader:
-      code = row.get(code_column, '')
-      name = row.get(name_column, '')
-      industry = row.get(industry_column, '')
-      ipo_date = row.get(ipo_date_column, '')
-      code = code.strip()
-      name = name.replace(' ', '')
-      industry = industry.strip()
-      ipo_date = ipo_date.strip()
-      if not code or not name:
-        continue
-      # logging.info('stock: "%s", name: "%s"', code, name)
-      stock = Stock(code, name, industry, ipo_date)
-      all_stocks[code] = stock
 
+def LoadAllStocks():
+  """ Returns the StockUniverse of --stock_list, i.e. a map of {code -> Stock}.
+  """
+  all_stocks = LoadStocks(FLAGS.stock_list.split(','))
   logging.info('Load %d stocks in all.', len(all_stocks))
   return all_stocks
 
@@ -9,35 +9,68 @@ import datetime
 import logging
 import os
 import sys
+import threading
+import Queue
 
 import flags
 import batch_data_fetcher
+import batch_insights
+import cpu_workers
 import data_fetcher
 import data_insights
 import date_util
+import industry_insights
+import perf_metrics
+import rolling_insights
+import seeker_server
 import stock_info
+import stocklist_generator
 
 FLAGS = flags.FLAGS
 flags.ArgParser().add_argument('--data_directory', default='./data',
     help='The base directory of output.')
 flags.ArgParser().add_argument('--insight_stocks', default='',
     help='Comma seperated stock codes to do insights.')
+flags.ArgParser().add_argument('--insight_industries', default='',
+    help='Comma seperated industries to do insights.')
+flags.ArgParser().add_argument('--insight_ipo_before', default='',
+    help='Only do insights on the stocks listed on or before this day, YYYY-MM-DD.')
 flags.ArgParser().add_argument('--annual', default=False, action='store_true',
-    help='Whether to run seasonal(default) or annual data.')
+    help='Whether to run seasonal(default) or annual data. The annual data is '
+    'derived from the seasonal data of this quarter without any download, or of '
+    'the latest pages in --content_store or the past quarters if missing, and '
+    'its insight seasons are the year ends, e.g. --insight_season=2025-12-31. '
+    'In the annual insights, the "seasons" in the column names are years, e.g. '
+    '12seasons_PE_mean is the mean PE of the 12 past years.')
 flags.ArgParser().add_argument('--insight_output', default=None,
     help='The output of insight data.')
+flags.ArgParser().add_argument('--pipeline_queue_size', type=int, default=100,
+    help='The max number of stocks waiting between two pipeline stages.')
+flags.ArgParser().add_argument('--batch_insights', default=False, action='store_true',
+    help='Do insights on all refined stocks at once instead of one by one.')
 
+# Put into a pipeline queue to indicate that no more stock will come.
+_END_OF_STREAM = None
 
-def _GetDataDirectory():
+_INSIGHT_SECONDS = perf_metrics.GetRegistry().GetHistogram('stock_insight_seconds',
+    'The time of the insights of each stock, or of all stocks in the batch mode.')
+
+
+def _GetDataDirectory(annual=None):
+  """ Returns the data directory of the annual or seasonal data, by --annual
+  if annual is None.
+  """
+  if annual is None:
+    annual = FLAGS.annual
   abs_base = FLAGS.data_directory
   if not os.path.isabs(FLAGS.data_directory):
     abs_base = os.path.abspath(FLAGS.data_directory)
 
-  sub_dir = 'annual' if FLAGS.annual else 'seasonal'
+  sub_dir = 'annual' if annual else 'seasonal'
 
   today = datetime.date.today()
   start_date = date_util.GetSeasonStartDate(today)
-  if FLAGS.annual:
+  if annual:
     start_date = datetime.date(today.year, 1, 1)
 
   full_path = os.path.join(abs_base, sub_dir, start_date.isoformat())
@@ -47,6 +80,14 @@ def _GetDataDirectory():
   return full_path
 
 
+def _NewFetcher(directory):
+  """ Returns the data fetcher of --annual in the directory. """
+  if FLAGS.annual:
+    return data_fetcher.NeteaseAnnualFetcher(directory, _GetDataDirectory(annual=False),
+        min(data_insights.GetInsightSeasons()).year)
+  return data_fetcher.NeteaseSeasonFetcher(directory)
+
+
 def _GetHeader(column_map):
   # special columns in order
   special = ['Code', 'Name', 'Industry', 'IPO', 'Season', 'MarketValue_at_season',]
@@ -64,40 +105,194 @@ def _GetHeader(column_map):
   return header
 
 
-def RunData():
-  # load a map of {code -> stock}
-  stocks = stock_info.LoadAllStocks()
-  # randomly pick 10 stocks
-  # stock_list = [stocks[c] for c in stocks.keys()[:10] ]
+def _DoStats(insighter, stock):
+  """ Runs in a cpu worker process. """
+  return insighter.DoStats(stock)
+
+
+def _DoRollingStats(roller, stock):
+  """ Runs in a cpu worker process. """
+  return roller.DoRollingStats(stock)
+
+
+def _WriteRollingStats(rolling, cpu_pool, stock):
+  """ Writes the rolling stats of the stock if rolling, i.e.
+  (RollingInsights, PanelWriter), is given.
+  """
+  if not rolling:
+    return
+  (roller, panel_writer) = rolling
+  try:
+    panel_writer.Write(cpu_pool.Run(_DoRollingStats, roller, stock))
+  except Exception, e:
+    logging.error('Error in rolling stats of %s(%s): %s', stock.code(), stock.name(), e)
+
+
+def _GetPortfolioCodes():
+  """ Returns the codes in --portfolio_list if it exists. """
+  if not FLAGS.portfolio_list or not os.path.exists(FLAGS.portfolio_list):
+    return []
+  return stocklist_generator.LoadPortfolio(FLAGS.portfolio_list)
+
+
+def _RunFetchStage(batch, stock_list, refined_queue, num_insight_threads):
+  """ Fetches and refines the stocks, then puts them into refined_queue. """
+  logging.info('Start batch data fetching')
+  try:
+    # the portfolio goes first, so that its insights come out early.
+    batch.Fetch(stock_list, _GetPortfolioCodes())
+  finally:
+    # one end for each insight thread.
+    for i in range(num_insight_threads):
+      refined_queue.put(_END_OF_STREAM)
+  logging.info('Batch data fetching completed')
+
+
+def _RunInsightStage(insighter, cpu_pool, refined_queue, insight_queue, rolling):
+  """ Does insights on the refined stocks, then puts the results into
+  insight_queue.
+  """
+  while True:
+    stock = refined_queue.get(block=True)
+    if stock is _END_OF_STREAM:
+      break
+    try:
+      # one insight for each insight season.
+      with perf_metrics.Timer(_INSIGHT_SECONDS):
+        insights = cpu_pool.Run(_DoStats, insighter, stock)
+      for insight in insights:
+        insight_queue.put(insight, block=True)
+    except Exception, e:
+      logging.error('Error in insighting %s(%s): %s', stock.code(), stock.name(), e)
+    _WriteRollingStats(rolling, cpu_pool, stock)
+  insight_queue.put(_END_OF_STREAM)
+
+
+def _RunBatchInsightStage(insighter, cpu_pool, refined_queue, insight_queue, rolling):
+  """ Collects all refined stocks, does insights on them at once, then puts
+  the results into insight_queue.
+  """
+  stocks = []
+  while True:
+    stock = refined_queue.get(block=True)
+    if stock is _END_OF_STREAM:
+      break
+    stocks.append(stock)
+    _WriteRollingStats(rolling, cpu_pool, stock)
+  try:
+    with perf_metrics.Timer(_INSIGHT_SECONDS):
+      insights = insighter.DoBatchStats(stocks)
+    for insight in insights:
+      insight_queue.put(insight, block=True)
+  except Exception, e:
+    logging.error('Error in insighting %d stocks: %s', len(stocks), e)
+  insight_queue.put(_END_OF_STREAM)
+
+
+def _RunOutputStage(insight_queue, directory, num_insight_threads, collected):
+  """ Writes each insight as soon as it comes, and appends it to collected
+  if it is a list.
+  """
+  writer = None
+  num_ended = 0
+  while num_ended < num_insight_threads:
+    insight = insight_queue.get(block=True)
+    if insight is _END_OF_STREAM:
+      num_ended += 1
+      continue
+    if not writer:
+      outfile = sys.stdout  # output to stdout by default
+      if FLAGS.insight_output:
+        outfile = open(os.path.join(directory, FLAGS.insight_output), 'w')
+      header = insight.columns()
+      writer = csv.DictWriter(outfile, fieldnames=header)
+      writer.writeheader()
+    writer.writerow(insight.data())
+    outfile.flush()
+    if collected is not None:
+      collected.append(insight)
+
+
+def _SelectStocks(stocks):
+  """ Returns the stocks in the StockUniverse selected by the flags. """
   stock_list = stocks.values() if not FLAGS.insight_stocks else [
       stocks[code.strip()] for code in FLAGS.insight_stocks.split(',')]
+  if FLAGS.insight_industries:
+    codes = set()
+    for industry in FLAGS.insight_industries.split(','):
+      codes.update(stock.code() for stock in stocks.GetByIndustry(industry.strip()))
+    stock_list = [stock for stock in stock_list if stock.code() in codes]
+  if FLAGS.insight_ipo_before:
+    codes = set(stock.code() for stock in stocks.GetByIpoDate(end=FLAGS.insight_ipo_before))
+    stock_list = [stock for stock in stock_list if stock.code() in codes]
+  return stock_list
+
+
+def RunData(cpu_pool):
+  """ Fetches, refines and does insights on the stocks. The refining and
+  insights run in the cpu workers of cpu_pool if any.
+  """
+  # load a map of {code -> stock}
+  stocks = stock_info.LoadAllStocks()
+  stock_list = _SelectStocks(stocks)
+  logging.info('%d stocks selected', len(stock_list))
 
   directory = _GetDataDirectory()
   logging.info('Data directory: %s', directory)
 
-  logging.info('Start batch data fetching')
-  fetcher = data_fetcher.NeteaseSeasonFetcher(directory)
-  batch = batch_data_fetcher.BatchDataFetcher(fetcher, FLAGS.num_fetcher_threads)
-  batch.Fetch(stock_list)
-  logging.info('Batch data fetching completed')
+  # The stages are connected by bounded queues:
+  # fetch & refine -> refined_queue -> insight -> insight_queue -> output
+  refined_queue = Queue.Queue(FLAGS.pipeline_queue_size)
+  insight_queue = Queue.Queue(FLAGS.pipeline_queue_size)
 
-  logging.info('Start data insights')
+  # Each insight thread keeps one cpu worker busy.
+  num_insight_threads = max(1, cpu_pool.num_workers())
+  if FLAGS.batch_insights:
+    num_insight_threads = 1  # all stocks go to one batch
+
+  fetcher = _NewFetcher(directory)
+  # the history is shared by the runs of all seasons.
+  schedule = batch_data_fetcher.FetchSchedule(
+      os.path.join(os.path.dirname(directory), 'fetch_history.json'))
+  batch = batch_data_fetcher.BatchDataFetcher(
+      fetcher, FLAGS.num_fetcher_threads, refined_queue, cpu_pool, schedule)
   insighter = data_insights.DataInsights(directory)
-  row_of_insights = []
-  for stock in stock_list:
-    row_of_insights.append(insighter.DoStats(stock))
+  if FLAGS.batch_insights:
+    insighter = batch_insights.BatchDataInsights(directory)
+  # the rolling stats panel if required.
+  rolling = None
+  if FLAGS.rolling_output:
+    rolling_file = open(os.path.join(directory, FLAGS.rolling_output), 'w')
+    rolling = (rolling_insights.RollingInsights(directory, rolling_insights.GetRollingWindows()),
+        rolling_insights.PanelWriter(rolling_file))
 
-  # output insighs
-  if len(row_of_insights) > 0:
-    outfile = sys.stdout  # output to stdout by default
-    if FLAGS.insight_output:
-      outfile = open(os.path.join(directory, FLAGS.insight_output), 'w')
+  stages = [threading.Thread(target=_RunFetchStage, name='FetchStage',
+      args=(batch, stock_list, refined_queue, num_insight_threads))]
+  if FLAGS.batch_insights:
+    stages.append(threading.Thread(target=_RunBatchInsightStage, name='InsightThread',
+        args=(insighter, cpu_pool, refined_queue, insight_queue, rolling)))
+  else:
+    for i in range(num_insight_threads):
+      stages.append(threading.Thread(target=_RunInsightStage, name=('InsightThread-%d' % i),
+          args=(insighter, cpu_pool, refined_queue, insight_queue, rolling)))
 
-    header = row_of_insights[0].columns()
-    writer = csv.DictWriter(outfile, fieldnames=header)
-    writer.writeheader()
-    for insight in row_of_insights:
-      writer.writerow(insight.data())
+  logging.info('Start data insights')
+  for stage in stages:
+    stage.start()
+  # the industry insights need the insights of all stocks.
+  collected = None
+  if FLAGS.industry_output or FLAGS.industry_rank_output:
+    collected = []
+  _RunOutputStage(insight_queue, directory, num_insight_threads, collected)
+  for stage in stages:
+    stage.join()
+  if collected is not None:
+    industry_insights.WriteIndustryInsights(directory, collected)
+  if rolling:
+    rolling_file.close()
+  logging.info('Data insights completed')
+  if FLAGS.metrics_output:
+    perf_metrics.GetRegistry().WriteJson(os.path.join(directory, FLAGS.metrics_output))
 
 
 def main():
@@ -105,8 +300,20 @@ def main():
   flags.ArgParser().parse_args(namespace=FLAGS)
   # Set logging level
   logging.basicConfig(level=logging.INFO)
+  # The cpu workers are forked before the metrics server starts its thread.
+  cpu_pool = None
+  if not FLAGS.serve:
+    cpu_pool = cpu_workers.CpuWorkerPool(FLAGS.num_cpu_workers)
+  if FLAGS.metrics_port:
+    perf_metrics.StartMetricsServer(FLAGS.metrics_port)
   # Run
-  RunData()
+  if FLAGS.serve:
+    seeker_server.Serve(_GetDataDirectory, stock_info.LoadAllStocks(), _NewFetcher)
+  else:
+    try:
+      RunData(cpu_pool)
+    finally:
+      cpu_pool.Close()
 
 if __name__ == "__main__":
   main()
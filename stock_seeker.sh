@@ -10,8 +10,14 @@ today=$(date +'%Y-%m-%d')
 
 ./stock_seeker.py \
   --stock_list="./data/stocklist_full.csv" \
-  --refetch_price \
-  --force_refine \
+  --incremental_price \
+  --adaptive_concurrency \
+  --gzip_transfer \
+  --compress_raw_data \
+  --content_store="./data/pages" \
+  --page_fetch_threads="9" \
+  --max_in_flight_requests="40" \
+  --portfolio_list="./data/portfolio.csv" \
   --num_fetcher_threads="20" \
   --data_directory="./data" \
   --insight_season="$insight_season" \
@@ -19,5 +25,15 @@ today=$(date +'%Y-%m-%d')
 
 # --force_refetch: always fetch the raw data
 # --refetch_price: always fetch the latest price
+# --incremental_price: only fetch the missing days of price
 # --force_refine: always refine the raw data
+# --refined_csv: also export the refined data to csv for reading
 # --annual: fetch seasonal or annual data
+# --adaptive_concurrency: adapt the in-flight requests to the health of the source
+# --portfolio_list: the stocks fetched before the others
+# --stale_hours: the stocks not fetched in these hours are fetched before the fresh ones
+# --page_fetch_threads: the max number of pages of a stock fetched at the same time
+# --max_in_flight_requests: the max number of requests in flight of all stocks
+# --gzip_transfer: ask the server to send the pages gzipped
+# --compress_raw_data: store the fetched pages gzipped
+# --content_store: the pages shared by all data directories, fetched and stored once